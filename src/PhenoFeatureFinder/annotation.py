@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+
+from phenofeaturefinder.feature_index import parse_feature_ids, FEATURE_ID_PATTERN
+
+
+# adduct name: (mass shift in Da, charge, number of molecules)
+PROTON_MASS = 1.007276
+POSITIVE_ADDUCTS = {
+    "[M+H]+": (PROTON_MASS, 1, 1),
+    "[M+NH4]+": (18.033823, 1, 1),
+    "[M+Na]+": (22.989218, 1, 1),
+    "[M+K]+": (38.963158, 1, 1),
+    "[M+2H]2+": (2 * PROTON_MASS, 2, 1),
+    "[2M+H]+": (PROTON_MASS, 1, 2),
+}
+NEGATIVE_ADDUCTS = {
+    "[M-H]-": (-PROTON_MASS, -1, 1),
+    "[M+Cl]-": (34.969402, -1, 1),
+    "[M+FA-H]-": (44.998201, -1, 1),
+    "[M-2H]2-": (-2 * PROTON_MASS, -2, 1),
+    "[2M-H]-": (-PROTON_MASS, -1, 2),
+}
+
+
+class CompoundLibraryIndex:
+    '''
+    A sorted index of the m/z values of the ions of a compound library, for the annotation of features by m/z.
+
+    The m/z of each compound and adduct ((n_molecules * monoisotopic mass + mass shift) / |charge|) is computed once
+    and sorted: a feature is annotated by a binary search of its ppm window, in O(log m) for m ions.
+    Annotating n features therefore costs O(n log m). The index can be saved to and loaded from a .npz file
+    (see load_compound_library() for the on-disk cache).
+
+    Parameters
+    ----------
+    compound_names: list-like, (n_compounds,)
+        The names of the compounds.
+    monoisotopic_masses: list-like, (n_compounds,)
+        The monoisotopic mass of each compound (Da).
+    adducts: dict, optional
+        Adduct names and (mass shift in Da, charge, number of molecules) (default is None: POSITIVE_ADDUCTS).
+
+    Example
+    -------
+    >>> library = CompoundLibraryIndex.from_csv("compounds.csv")
+    >>> library.annotate(mz=np.array([181.07066]), ppm=5)
+    '''
+    def __init__(self, compound_names, monoisotopic_masses, adducts=None):
+        if adducts is None:
+            adducts = POSITIVE_ADDUCTS
+        self.compound_names = pd.Index(compound_names)
+        self.monoisotopic_masses = np.asarray(monoisotopic_masses, dtype=np.float64)
+        self.adduct_names = pd.Index(list(adducts))
+        adduct_rules = np.array([adducts[name] for name in self.adduct_names], dtype=np.float64).reshape(-1, 3)
+        self.adduct_mass_shifts, self.adduct_charges, self.adduct_n_molecules = adduct_rules.T
+        # one ion per compound and adduct, sorted by m/z
+        ion_mz = (np.outer(self.monoisotopic_masses, self.adduct_n_molecules) + self.adduct_mass_shifts) / np.abs(self.adduct_charges)
+        order = np.argsort(ion_mz, axis=None, kind='stable')
+        order = order[~np.isnan(ion_mz.ravel()[order])]
+        self.ion_mz = ion_mz.ravel()[order]
+        self.ion_compounds, self.ion_adducts = np.unravel_index(order, ion_mz.shape)
+
+    @classmethod
+    def from_csv(cls, library_csv, adducts=None, name_col='name', mass_col='monoisotopic_mass'):
+        '''
+        Reads a compound library .csv file with one row per compound (name and monoisotopic mass columns).
+
+        Parameters
+        ----------
+        adducts: dict or str, optional
+            Adduct rules: a dictionary (see POSITIVE_ADDUCTS) or a path to a .csv file with the columns 'adduct', 'mass_shift',
+            'charge' and optionally 'n_molecules' (default 1). Default is None: POSITIVE_ADDUCTS.
+        '''
+        library = pd.read_csv(library_csv, usecols=[name_col, mass_col])
+        if library[mass_col].isna().any():
+            print("{0} compounds without monoisotopic mass are ignored.".format(library[mass_col].isna().sum()))
+        return cls(library[name_col].astype(str), library[mass_col], adducts=read_adduct_rules(adducts))
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Loads an index saved with save() (the ions are not sorted again).
+        '''
+        index = cls.__new__(cls)
+        with np.load(path, allow_pickle=False) as saved:
+            index.compound_names = pd.Index(saved["compound_names"])
+            index.monoisotopic_masses = saved["monoisotopic_masses"]
+            index.adduct_names = pd.Index(saved["adduct_names"])
+            index.adduct_mass_shifts, index.adduct_charges, index.adduct_n_molecules = saved["adduct_rules"]
+            index.ion_mz = saved["ion_mz"]
+            index.ion_compounds = saved["ion_compounds"]
+            index.ion_adducts = saved["ion_adducts"]
+        return index
+
+    def save(self, path):
+        '''
+        Saves the index to a .npz file.
+        '''
+        np.savez(
+            path,
+            compound_names=np.asarray(self.compound_names.astype(str), dtype=str),
+            monoisotopic_masses=self.monoisotopic_masses,
+            adduct_names=np.asarray(self.adduct_names.astype(str), dtype=str),
+            adduct_rules=np.vstack([self.adduct_mass_shifts, self.adduct_charges, self.adduct_n_molecules]),
+            ion_mz=self.ion_mz,
+            ion_compounds=self.ion_compounds,
+            ion_adducts=self.ion_adducts)
+
+    def __len__(self):
+        return self.ion_mz.size
+
+    def annotate(self, mz, ppm=5):
+        '''
+        Finds the ions within ppm of each m/z value (vectorized binary searches).
+
+        Returns
+        -------
+        `pandas.core.frame.DataFrame`
+            One row per match: 'position' (of the m/z value), 'compound', 'adduct', 'theoretical_mz', 'mz' and 'ppm_error'.
+            Sorted by position and absolute ppm error.
+        '''
+        mz = np.asarray(mz, dtype=np.float64)
+        mz_tolerance = mz * ppm * 1e-6
+        starts = np.searchsorted(self.ion_mz, mz - mz_tolerance, side='left')
+        stops = np.searchsorted(self.ion_mz, mz + mz_tolerance, side='right')
+        n_matches = np.where(np.isnan(mz), 0, stops - starts)
+        positions = np.repeat(np.arange(mz.size), n_matches)
+        offsets = np.arange(n_matches.sum()) - np.repeat(np.cumsum(n_matches) - n_matches, n_matches)
+        ions = np.repeat(starts, n_matches) + offsets
+        theoretical_mz = self.ion_mz[ions]
+        annotations = pd.DataFrame({
+            "position": positions,
+            "compound": self.compound_names[self.ion_compounds[ions]],
+            "adduct": self.adduct_names[self.ion_adducts[ions]],
+            "theoretical_mz": theoretical_mz,
+            "mz": mz[positions],
+            "ppm_error": (mz[positions] - theoretical_mz) / theoretical_mz * 1e6})
+        order = np.lexsort((np.abs(annotations["ppm_error"].to_numpy()), positions))
+        return annotations.iloc[order].reset_index(drop=True)
+
+    def annotate_feature_ids(self, feature_ids, ppm=5, pattern=FEATURE_ID_PATTERN):
+        '''
+        Annotates features from their identifiers (e.g. 'rt-0.06_mz-124.96631', or the feature names returned by
+        FeatureSelection.get_names_of_top_n_features_from_selected_pc()).
+        The 'position' column of annotate() is replaced by the 'feature_id' column.
+        '''
+        feature_ids = pd.Index(feature_ids)
+        _, mz = parse_feature_ids(feature_ids, pattern=pattern)
+        annotations = self.annotate(mz, ppm=ppm)
+        annotations.insert(0, "feature_id", feature_ids[annotations.pop("position").to_numpy()])
+        return annotations
+
+
+def read_adduct_rules(adducts=None):
+    '''
+    Returns the adduct rules as a dictionary: adduct name and (mass shift in Da, charge, number of molecules).
+    adducts can be a dictionary (returned as is), a path to a .csv file with the columns 'adduct', 'mass_shift', 'charge'
+    and optionally 'n_molecules', or None (POSITIVE_ADDUCTS).
+    '''
+    if adducts is None:
+        return POSITIVE_ADDUCTS
+    if isinstance(adducts, dict):
+        return adducts
+    rules = pd.read_csv(adducts)
+    missing_columns = [col for col in ("adduct", "mass_shift", "charge") if col not in rules.columns]
+    if len(missing_columns) > 0:
+        raise ValueError("The adduct rules file '{0}' should have the columns {1}.".format(os.path.basename(adducts), missing_columns))
+    if "n_molecules" not in rules.columns:
+        rules["n_molecules"] = 1
+    if (rules["charge"] == 0).any():
+        raise ValueError("Adduct charges should be different from 0.")
+    return {row.adduct: (row.mass_shift, row.charge, row.n_molecules) for row in rules.itertuples(index=False)}
+
+
+def load_compound_library(library_csv, adducts=None, cache_dir=None, name_col='name', mass_col='monoisotopic_mass'):
+    '''
+    Returns the CompoundLibraryIndex of a compound library .csv file, through an on-disk cache of built indexes.
+
+    With a cache directory, the built index is saved as a .npz file named after a fingerprint of the library file
+    (path, size and modification time), of the adduct rules and of the column names: later runs load it instead
+    of reading and sorting the library again. A changed library file gets a new fingerprint.
+
+    Parameters
+    ----------
+    library_csv: str
+        A path to a .csv file with one row per compound (name and monoisotopic mass columns).
+    adducts: dict or str, optional
+        Adduct rules (see read_adduct_rules()). Default is None: POSITIVE_ADDUCTS.
+    cache_dir: str, optional
+        Directory where built indexes are cached (default is None: no caching).
+    name_col: str, optional
+        The column with the compound names (default is 'name').
+    mass_col: str, optional
+        The column with the monoisotopic masses in Da (default is 'monoisotopic_mass').
+
+    Returns
+    -------
+    `phenofeaturefinder.annotation.CompoundLibraryIndex`
+    '''
+    adduct_rules = read_adduct_rules(adducts)
+    if cache_dir is None:
+        return CompoundLibraryIndex.from_csv(library_csv, adducts=adduct_rules, name_col=name_col, mass_col=mass_col)
+    cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+    os.makedirs(cache_dir, exist_ok=True)
+    stats = os.stat(library_csv)
+    key_content = {
+        "source": os.path.abspath(library_csv),
+        "size": stats.st_size,
+        "mtime_ns": stats.st_mtime_ns,
+        "adducts": {name: [float(value) for value in rule] for name, rule in adduct_rules.items()},
+        "columns": [name_col, mass_col]}
+    key = hashlib.blake2b(json.dumps(key_content, sort_keys=True).encode(), digest_size=16).hexdigest()
+    cache_path = os.path.join(cache_dir, "compound_library_{0}.npz".format(key))
+    if os.path.exists(cache_path):
+        try:
+            return CompoundLibraryIndex.load(cache_path)
+        except (OSError, ValueError, KeyError):
+            pass
+    index = CompoundLibraryIndex.from_csv(library_csv, adducts=adduct_rules, name_col=name_col, mass_col=mass_col)
+    # write then rename so that a partial file is never read
+    tmp_path = cache_path + ".tmp.npz"
+    index.save(tmp_path)
+    os.replace(tmp_path, cache_path)
+    return index
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+
+import os
+import numpy as np
+import pandas as pd
+
+from phenofeaturefinder.metabolome_io import load_metabolome
+from phenofeaturefinder.feature_index import parse_feature_ids, FEATURE_ID_PATTERN
+
+
+def match_features_across_batches(mz, rt, batches, ppm=10, rt_tolerance=0.05):
+    '''
+    Groups the features of several batches that are the same compound (m/z within ppm and RT within rt_tolerance)
+    with sorted sweeps, in O(n log n) for n features in total (features are never compared pair by pair).
+
+    Steps:
+      1. Features of all batches are sorted by m/z: a new m/z group starts where the gap between consecutive
+         m/z values is larger than the ppm tolerance. Within each m/z group, features are sorted by RT: a new group 
+         starts where the RT gap is larger than rt_tolerance.
+      2. Gaps alone can chain dense features into groups wider than the tolerances: such groups are split at their largest
+         gaps until each group spans at most ppm from its lowest m/z (its anchor), then at most rt_tolerance from its
+         earliest RT (see split_groups_by_anchor()). Groups within the tolerances are not changed.
+      3. A merged feature holds at most one feature per batch: in a group with several features of the same batch,
+         the features of the batch with the most features are the references and each other feature joins the reference 
+         nearest in RT that has no feature of its batch yet (closest pairs first), or a new merged feature.
+
+    Parameters
+    ----------
+    mz: `numpy.ndarray`, (n_features,)
+        The m/z of the features of all batches.
+    rt: `numpy.ndarray`, (n_features,)
+        The retention time of the features of all batches.
+    batches: `numpy.ndarray`, (n_features,)
+        The batch (integer code) of each feature.
+    ppm: float, optional
+        The m/z tolerance in parts per million (default is 10).
+    rt_tolerance: float, optional
+        The retention time tolerance, same unit as the retention times (default is 0.05).
+
+    Returns
+    -------
+    `numpy.ndarray`, (n_features,)
+        The merged feature (integer code, in order of m/z) of each feature.
+    '''
+    mz = np.asarray(mz, dtype=np.float64)
+    rt = np.asarray(rt, dtype=np.float64)
+    batches = np.asarray(batches)
+    if mz.size == 0:
+        return np.zeros(0, dtype=np.int64)
+    # 1. sweeps on m/z gaps, then on RT gaps within m/z groups
+    mz_order = np.argsort(mz, kind='stable')
+    sorted_mz = mz[mz_order]
+    mz_groups = np.empty(mz.size, dtype=np.int64)
+    mz_groups[mz_order] = np.concatenate([[0], np.cumsum(np.diff(sorted_mz) > sorted_mz[:-1] * ppm * 1e-6)])
+    order = np.lexsort((rt, mz_groups))
+    sorted_rt = rt[order]
+    sorted_mz_groups = mz_groups[order]
+    new_group = np.concatenate([[True], (np.diff(sorted_mz_groups) != 0) | (np.diff(sorted_rt) > rt_tolerance)])
+    groups = np.empty(mz.size, dtype=np.int64)
+    groups[order] = np.cumsum(new_group) - 1
+    # 2. groups bounded by their anchor in m/z, then in RT
+    order = np.lexsort((mz, groups))
+    groups[order] = split_groups_by_anchor(groups[order], mz[order], lambda anchor: anchor * (1 + ppm * 1e-6))
+    order = np.lexsort((rt, groups))
+    groups[order] = split_groups_by_anchor(groups[order], rt[order], lambda anchor: anchor + rt_tolerance)
+    # 3. one feature per batch in each merged feature, pairs by nearest RT
+    sorted_groups = groups[order]
+    occurrences = pd.DataFrame({"group": sorted_groups, "batch": batches[order]}).groupby(["group", "batch"], sort=False).cumcount().to_numpy()
+    for group in np.unique(sorted_groups[occurrences > 0]):
+        start, stop = np.searchsorted(sorted_groups, [group, group + 1])
+        occurrences[start:stop] = pair_by_nearest_rt(rt[order[start:stop]], batches[order[start:stop]])
+    sorted_merged = pd.MultiIndex.from_arrays([sorted_groups, occurrences]).factorize()[0]
+    merged_features = np.empty(mz.size, dtype=np.int64)
+    merged_features[order] = sorted_merged
+    return merged_features
+
+
+def split_groups_by_anchor(sorted_groups, sorted_values, upper_bound):
+    '''
+    Splits groups so that the values of each group are within the bound of its first value (its anchor): 
+    a group wider than upper_bound(anchor) is cut at its largest gap between consecutive values, and so on until
+    every group fits. Cutting at the largest gaps rather than at the bound keeps close features together.
+
+    Parameters
+    ----------
+    sorted_groups: `numpy.ndarray`, (n_features,)
+        The group of each feature, sorted.
+    sorted_values: `numpy.ndarray`, (n_features,)
+        The values (e.g. m/z), sorted within each group.
+    upper_bound: callable
+        Returns the highest value of a group from its anchor.
+
+    Returns
+    -------
+    `numpy.ndarray`, (n_features,)
+        The new group (integer code, in the order of the features) of each feature.
+    '''
+    new_group = np.concatenate([[True], np.diff(sorted_groups) != 0])
+    starts = np.flatnonzero(new_group)
+    stops = np.append(starts[1:], sorted_groups.size)
+    is_wide = sorted_values[stops - 1] > upper_bound(sorted_values[starts])
+    pieces = list(zip(starts[is_wide], stops[is_wide]))
+    while len(pieces) > 0:
+        start, stop = pieces.pop()
+        values = sorted_values[start:stop]
+        if values[-1] <= upper_bound(values[0]):
+            continue
+        cut = start + 1 + np.argmax(np.diff(values))
+        new_group[cut] = True
+        pieces.extend([(start, cut), (cut, stop)])
+    return np.cumsum(new_group) - 1
+
+
+def pair_by_nearest_rt(rt, batches):
+    '''
+    Splits the features of one group into merged features with at most one feature per batch.
+
+    The features of the batch with the most features are the references (one merged feature each). 
+    The other features are assigned to the reference nearest in RT whose merged feature has no feature of their batch yet,
+    closest pairs first. Features left without a reference get a new merged feature.
+
+    Returns
+    -------
+    `numpy.ndarray`, (n_features,)
+        The merged feature (integer code within the group) of each feature.
+    '''
+    batch_names, batch_codes, batch_counts = np.unique(batches, return_inverse=True, return_counts=True)
+    is_reference = batch_codes == np.argmax(batch_counts)
+    references = np.flatnonzero(is_reference)
+    merged = np.full(rt.size, -1, dtype=np.int64)
+    merged[references] = np.arange(references.size)
+    others = np.flatnonzero(~is_reference)
+    # all (feature, reference) pairs, closest first
+    distances = np.abs(rt[others][:, np.newaxis] - rt[references][np.newaxis, :])
+    pair_order = np.argsort(distances, axis=None, kind='stable')
+    is_taken = np.zeros((references.size, batch_names.size), dtype=bool)
+    for other, reference in zip(*np.unravel_index(pair_order, distances.shape)):
+        feature = others[other]
+        if merged[feature] >= 0 or is_taken[reference, batch_codes[feature]]:
+            continue
+        merged[feature] = reference
+        is_taken[reference, batch_codes[feature]] = True
+    unpaired = merged < 0
+    merged[unpaired] = references.size + np.arange(np.count_nonzero(unpaired))
+    return merged
+
+
+def merge_metabolome_tables(
+    metabolome_tables,
+    ppm=10,
+    rt_tolerance=0.05,
+    batch_names=None,
+    metabolome_feature_id_col='feature_id',
+    dtype='float32',
+    pattern=FEATURE_ID_PATTERN,
+    fill_value=0):
+    '''
+    Aligns the feature tables of several acquisition batches into one metabolome matrix.
+
+    Features are matched on the m/z and retention time parsed from their identifiers (e.g. 'rt-0.06_mz-124.96631')
+    within ppm and rt_tolerance (see match_features_across_batches()): the matching is O(n log n) in the total
+    number of features. The merged features are named after their average RT and m/z over the batches.
+    Features whose identifier holds no m/z or RT cannot be matched: they are kept as separate features.
+
+    Parameters
+    ----------
+    metabolome_tables: list
+        The paths to the .csv files of the batches (same format as the metabolome file) or dataframes
+        with the feature identifiers as index and one column per sample. Sample names should be unique across batches.
+    ppm: float, optional
+        The m/z tolerance in parts per million (default is 10).
+    rt_tolerance: float, optional
+        The retention time tolerance, same unit as the feature identifiers (default is 0.05).
+    batch_names: list, optional
+        The name of each batch (default is None: the file names, or 'batch_1', 'batch_2'... for dataframes).
+    metabolome_feature_id_col: str, optional
+        The name of the column that contains the feature identifiers in the .csv files (default is 'feature_id').
+    dtype: str, optional
+        The dtype of the values (default is 'float32').
+    pattern: str, optional
+        The regular expression used to parse the feature identifiers (see feature_index.parse_feature_ids()).
+    fill_value: float, optional
+        The value of a merged feature in the samples of a batch where it was not found (default is 0: not detected).
+
+    Returns
+    -------
+    metabolome: `pandas.core.frame.DataFrame`, (n_merged_features, n_samples)
+        The merged metabolome with the samples of all batches (in the order of the batches).
+    provenance: `pandas.core.frame.DataFrame`, (n_features,)
+        One row per feature of the batches: 'merged_feature_id', 'batch', 'feature_id' (identifier in the batch), 'rt' and 'mz'.
+
+    Example
+    -------
+    >>> metabolome, provenance = merge_metabolome_tables(["batch1.csv", "batch2.csv"], ppm=10, rt_tolerance=0.05)
+    '''
+    if batch_names is None:
+        batch_names = [
+            os.path.splitext(os.path.basename(table))[0] if isinstance(table, str) else "batch_{0}".format(position + 1)
+            for position, table in enumerate(metabolome_tables)]
+    if len(batch_names) != len(metabolome_tables) or len(set(batch_names)) != len(batch_names):
+        raise ValueError("Please provide one unique batch name per metabolome table.")
+    tables = [
+        load_metabolome(table, metabolome_feature_id_col=metabolome_feature_id_col, dtype=dtype) if isinstance(table, str) else table
+        for table in metabolome_tables]
+    sample_names = pd.Index([]).append([table.columns for table in tables])
+    if sample_names.has_duplicates:
+        raise ValueError("Sample names should be unique across batches: {0}".format(sample_names[sample_names.duplicated()].unique().tolist()))
+
+    feature_ids = pd.Index([]).append([table.index for table in tables])
+    batches = np.repeat(np.arange(len(tables)), [table.shape[0] for table in tables])
+    rt, mz = parse_feature_ids(feature_ids, pattern=pattern)
+    # features without m/z or RT are not matched: each one is a merged feature
+    parsed = ~(np.isnan(mz) | np.isnan(rt))
+    merged_features = np.empty(mz.size, dtype=np.int64)
+    merged_features[parsed] = match_features_across_batches(mz[parsed], rt[parsed], batches[parsed], ppm=ppm, rt_tolerance=rt_tolerance)
+    n_matched_features = merged_features[parsed].max() + 1 if parsed.any() else 0
+    n_unparsed = np.count_nonzero(~parsed)
+    merged_features[~parsed] = n_matched_features + np.arange(n_unparsed)
+    n_merged_features = n_matched_features + n_unparsed
+    if n_unparsed > 0:
+        print("{0} feature identifiers do not hold an m/z and a retention time: they are not matched across batches.".format(n_unparsed))
+
+    # names of the merged features: average RT and m/z (the identifier itself for unmatched identifiers)
+    n_per_merged_feature = np.bincount(merged_features[parsed], minlength=n_matched_features)
+    merged_rt = np.bincount(merged_features[parsed], weights=rt[parsed], minlength=n_matched_features) / n_per_merged_feature
+    merged_mz = np.bincount(merged_features[parsed], weights=mz[parsed], minlength=n_matched_features) / n_per_merged_feature
+    merged_ids = np.empty(n_merged_features, dtype=object)
+    merged_ids[:n_matched_features] = ["rt-{0:.2f}_mz-{1:.5f}".format(merged_rt_value, merged_mz_value) for merged_rt_value, merged_mz_value in zip(merged_rt, merged_mz)]
+    merged_ids[n_matched_features:] = feature_ids[~parsed]
+    merged_ids = _make_unique(merged_ids)
+    merged_ids.name = metabolome_feature_id_col
+
+    values = np.full((n_merged_features, len(sample_names)), fill_value, dtype=dtype)
+    start_feature, start_sample = 0, 0
+    for table in tables:
+        stop_feature, stop_sample = start_feature + table.shape[0], start_sample + table.shape[1]
+        values[merged_features[start_feature:stop_feature], start_sample:stop_sample] = table.to_numpy(dtype=dtype)
+        start_feature, start_sample = stop_feature, stop_sample
+    metabolome = pd.DataFrame(values, index=merged_ids, columns=sample_names)
+    provenance = pd.DataFrame({
+        "merged_feature_id": merged_ids[merged_features],
+        "batch": np.asarray(batch_names, dtype=object)[batches],
+        "feature_id": feature_ids,
+        "rt": rt,
+        "mz": mz})
+    print("{0} features of {1} batches merged into {2} features.".format(len(feature_ids), len(tables), n_merged_features))
+    return metabolome, provenance
+
+
+def _make_unique(names):
+    '''
+    Adds a suffix ('_2', '_3'...) to repeated names.
+    '''
+    occurrences = pd.Series(names).groupby(names).cumcount().to_numpy()
+    if not np.any(occurrences > 0):
+        return pd.Index(names, dtype=object)
+    return pd.Index([name if occurrence == 0 else "{0}_{1}".format(name, occurrence + 1) for name, occurrence in zip(names, occurrences)], dtype=object)
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+import warnings
+import numpy as np
+from scipy import sparse
+from scipy import stats
+
+
+STATISTICAL_TESTS = ("welch", "mann-whitney", "anova")
+
+
+def compute_block_statistical_tests(values, group_codes, n_groups, test="welch"):
+    '''
+    Tests the difference of abundance between groups of samples for all features of a block at once (vectorized over features).
+
+    Parameters
+    ----------
+    values: `numpy.ndarray` or `scipy.sparse.spmatrix`, (n_features, n_samples)
+        The values of a block of features.
+    group_codes: `numpy.ndarray`, (n_samples,)
+        Integer code of the group of each sample.
+    n_groups: int
+        Number of groups (2 for the 'welch' and 'mann-whitney' tests).
+    test: str, optional
+        'welch' (Welch t-test), 'mann-whitney' (Mann-Whitney U test, normal approximation with tie correction)
+        or 'anova' (one-way ANOVA). Default is 'welch'.
+
+    Returns
+    -------
+    `numpy.ndarray`, (n_features, n_groups + 2)
+        The mean of each group (missing values ignored), the statistic and the two-sided p-value.
+        Features with missing values in the tested groups get a NaN statistic and p-value.
+    '''
+    values = values.toarray() if sparse.issparse(values) else np.asarray(values)
+    values = values.astype(np.float64)
+    group_codes = np.asarray(group_codes)
+    samples = [values[:, group_codes == group_code] for group_code in range(n_groups)]
+    results = np.full((values.shape[0], n_groups + 2), np.nan)
+    if values.shape[0] == 0:
+        return results
+    with warnings.catch_warnings():
+        # constant features and groups with only missing values give NaN
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        for group_code, group_values in enumerate(samples):
+            results[:, group_code] = np.nanmean(group_values, axis=1)
+        if test == "welch":
+            statistic, p_value = stats.ttest_ind(samples[1], samples[0], axis=1, equal_var=False)
+        elif test == "mann-whitney":
+            statistic, p_value = stats.mannwhitneyu(samples[1], samples[0], axis=1, alternative='two-sided', method='asymptotic')
+        else:
+            statistic, p_value = stats.f_oneway(*samples, axis=1)
+    results[:, n_groups] = statistic
+    results[:, n_groups + 1] = p_value
+    return results
+
+
+def benjamini_hochberg(p_values):
+    '''
+    Benjamini-Hochberg adjusted p-values (false discovery rate). Missing p-values are ignored and stay NaN.
+    '''
+    p_values = np.asarray(p_values, dtype=np.float64)
+    adjusted = np.full(p_values.shape, np.nan)
+    is_tested = ~np.isnan(p_values)
+    n_tests = np.count_nonzero(is_tested)
+    if n_tests == 0:
+        return adjusted
+    tested = p_values[is_tested]
+    order = np.argsort(tested)
+    ranked = tested[order] * n_tests / np.arange(1, n_tests + 1)
+    # monotone: the adjusted p-value of a rank is the minimum over the higher ranks
+    ranked = np.minimum.accumulate(ranked[::-1])[::-1]
+    tested_adjusted = np.empty(n_tests)
+    tested_adjusted[order] = np.minimum(ranked, 1)
+    adjusted[is_tested] = tested_adjusted
+    return adjusted
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.spatial import cKDTree
+from scipy.sparse.csgraph import connected_components
+
+from phenofeaturefinder.parallel import map_feature_blocks
+
+
+# m/z differences (Da) between features of the same compound: 13C isotopes and common adducts of the [M+H]+ ion
+MASS_DIFFERENCES = {
+    "13C": 1.003355,
+    "13C2": 2.006710,
+    "NH4-H": 17.026549,
+    "Na-H": 21.981944,
+    "K-H": 37.955882,
+}
+
+
+def find_candidate_pairs(rt, mz, mass_differences=None, rt_tolerance=0.02, mz_tolerance=0.005):
+    '''
+    Finds the pairs of features that co-elute (RT within rt_tolerance) and whose m/z differ by one of the mass differences
+    (within mz_tolerance) with a KD-tree over the (RT, m/z) coordinates of the features.
+
+    The coordinates are divided by the tolerances so that a tolerance window is a box of size 1: for each mass difference,
+    the tree is queried at (RT, m/z + mass difference) for all features at once.
+
+    Parameters
+    ----------
+    rt: `numpy.ndarray`, (n_features,)
+        The retention time of each feature (features with NaN values are ignored).
+    mz: `numpy.ndarray`, (n_features,)
+        The m/z of each feature.
+    mass_differences: dict, optional
+        Names and m/z differences (Da) to search (default is None: MASS_DIFFERENCES).
+    rt_tolerance: float, optional
+        The retention time tolerance (default is 0.02).
+    mz_tolerance: float, optional
+        The m/z tolerance in Da (default is 0.005).
+
+    Returns
+    -------
+    `pandas.core.frame.DataFrame`
+        One row per candidate pair: 'feature_a' (lower m/z) and 'feature_b' (positions of the features) and 'relation'.
+    '''
+    if mass_differences is None:
+        mass_differences = MASS_DIFFERENCES
+    rt = np.asarray(rt, dtype=np.float64)
+    mz = np.asarray(mz, dtype=np.float64)
+    positions = np.flatnonzero(~(np.isnan(rt) | np.isnan(mz)))
+    coordinates = np.column_stack([rt[positions] / rt_tolerance, mz[positions] / mz_tolerance])
+    pairs = []
+    if positions.size > 0:
+        tree = cKDTree(coordinates)
+        for relation, mass_difference in mass_differences.items():
+            shifted = coordinates + np.array([0, mass_difference / mz_tolerance])
+            matches = tree.query_ball_point(shifted, r=1, p=np.inf)
+            n_matches = np.fromiter((len(match) for match in matches), dtype=np.int64, count=len(matches))
+            if n_matches.sum() == 0:
+                continue
+            feature_a = positions[np.repeat(np.arange(positions.size), n_matches)]
+            feature_b = positions[np.concatenate(matches).astype(np.int64)]
+            pairs.append(pd.DataFrame({"feature_a": feature_a, "feature_b": feature_b, "relation": relation}))
+    if len(pairs) == 0:
+        return pd.DataFrame({"feature_a": np.zeros(0, dtype=np.int64), "feature_b": np.zeros(0, dtype=np.int64), "relation": np.zeros(0, dtype=object)})
+    return pd.concat(pairs, ignore_index=True)
+
+
+def standardize_feature_block(values):
+    '''
+    Centres each feature (row) of a block and scales it to a unit norm, so that the dot product of two rows
+    is their Pearson correlation across samples. Missing values are set to the mean of the feature.
+    Features with a constant value get zeros (correlation 0 with every feature).
+
+    Returns
+    -------
+    `numpy.ndarray`, (n_features, n_samples) of float32
+    '''
+    values = values.toarray() if sparse.issparse(values) else np.asarray(values)
+    values = values.astype(np.float64)
+    with np.errstate(invalid='ignore'):
+        means = np.nanmean(values, axis=1, keepdims=True) if values.shape[1] > 0 else np.zeros((values.shape[0], 1))
+    centered = np.nan_to_num(values - means, nan=0.0)
+    norms = np.sqrt(np.sum(centered ** 2, axis=1, keepdims=True))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        standardized = np.where(norms > 0, centered / norms, 0.0)
+    return standardized.astype(np.float32)
+
+
+def standardize_features(store, block_size=50000, n_jobs=1):
+    '''
+    Standardized values of all features of a metabolome store (see standardize_feature_block()), computed by blocks of features.
+    '''
+    blocks = map_feature_blocks(store, standardize_feature_block, n_jobs=n_jobs, block_size=block_size)
+    if len(blocks) == 0:
+        return np.zeros((0, store.shape[1]), dtype=np.float32)
+    return np.concatenate(blocks)
+
+
+def correlate_feature_pairs(standardized, feature_a, feature_b, block_size=100000):
+    '''
+    Pearson correlation across samples of the pairs of features (feature_a[i], feature_b[i]), computed by blocks of pairs
+    from standardized values (see standardize_features()): only the rows of the pairs of one block are gathered at a time.
+    '''
+    feature_a = np.asarray(feature_a, dtype=np.int64)
+    feature_b = np.asarray(feature_b, dtype=np.int64)
+    correlations = np.zeros(feature_a.size, dtype=np.float64)
+    for start in range(0, feature_a.size, block_size):
+        stop = start + block_size
+        correlations[start:stop] = np.einsum(
+            "ij,ij->i", standardized[feature_a[start:stop]], standardized[feature_b[start:stop]], dtype=np.float64)
+    return correlations
+
+
+def group_features(n_features, feature_a, feature_b, scores):
+    '''
+    Groups features linked by pairs (connected components) and chooses the representative of each group:
+    the feature with the highest score (e.g. the mean intensity).
+
+    Returns
+    -------
+    groups: `numpy.ndarray`, (n_features,)
+        The group (integer code) of each feature. Features without pair are a group on their own.
+    representatives: `numpy.ndarray`, (n_groups,)
+        The position of the representative feature of each group.
+    '''
+    graph = sparse.coo_matrix((np.ones(len(feature_a), dtype=bool), (feature_a, feature_b)), shape=(n_features, n_features))
+    _, groups = connected_components(graph, directed=False)
+    # highest score first, then the first feature of each group
+    order = np.lexsort((-np.nan_to_num(np.asarray(scores, dtype=np.float64), nan=-np.inf), groups))
+    is_first = np.concatenate([[True], np.diff(groups[order]) != 0]) if n_features > 0 else np.zeros(0, dtype=bool)
+    representatives = np.empty(groups.max() + 1 if n_features > 0 else 0, dtype=np.int64)
+    representatives[groups[order][is_first]] = order[is_first]
+    return groups, representatives
+
+
+def project_feature_block(values, projection):
+    '''
+    Standardizes a block of features (see standardize_feature_block()) and projects it on random directions of the samples
+    (n_samples, sketch_size): dot products of the projected rows approximate the correlations of the features
+    (Johnson-Lindenstrauss). The projected rows are scaled back to a unit norm.
+    '''
+    projected = standardize_feature_block(values).astype(np.float64) @ projection
+    norms = np.sqrt(np.sum(projected ** 2, axis=1, keepdims=True))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        projected = np.where(norms > 0, projected / norms, 0.0)
+    return projected.astype(np.float32)
+
+
+def prune_correlated_features(standardized, priority, threshold=0.95, max_memory_mb=512):
+    '''
+    Greedy removal of redundant features: features are visited by decreasing priority and a feature is removed 
+    if its absolute correlation with a feature kept before it is >= threshold. 
+    
+    Correlations are computed by blocks of features against blocks of the kept features (dot products of the standardized values),
+    so the (n_features, n_features) correlation matrix is never built: the blocks are sized so that the standardized values
+    and the correlation blocks fit in max_memory_mb.
+
+    Parameters
+    ----------
+    standardized: `numpy.ndarray`, (n_features, n_dimensions)
+        Standardized values (see standardize_features()) or their random projection (see project_feature_block()).
+    priority: `numpy.ndarray`, (n_features,)
+        Features with a higher priority are kept first (e.g. the total intensity).
+    threshold: float, optional
+        Absolute correlation above which a feature is redundant (default is 0.95).
+    max_memory_mb: float, optional
+        Memory budget in megabytes (default is 512).
+
+    Returns
+    -------
+    representatives: `numpy.ndarray`, (n_features,)
+        For a removed feature, the position of the kept feature that replaced it (the most correlated one). -1 for kept features.
+    correlations: `numpy.ndarray`, (n_features,)
+        For a removed feature, its correlation with its representative (NaN for kept features).
+    '''
+    n_features = standardized.shape[0]
+    available_bytes = max_memory_mb * 1024**2 - standardized.nbytes
+    if available_bytes <= 0:
+        raise ValueError("The standardized values ({0:.0f} MB) do not fit in max_memory_mb: increase it or use a random projection sketch.".format(
+            standardized.nbytes / 1024**2))
+    # a block of candidates, a block of kept features and their correlations (float32)
+    block_size = int(max(1, min(n_features, (np.sqrt(standardized.shape[1] ** 2 + available_bytes / 4) - standardized.shape[1]))))
+    order = np.argsort(-np.nan_to_num(np.asarray(priority, dtype=np.float64), nan=-np.inf), kind='stable')
+    representatives = np.full(n_features, -1, dtype=np.int64)
+    correlations = np.full(n_features, np.nan)
+    kept = []
+    for start in range(0, n_features, block_size):
+        candidates = order[start:start + block_size]
+        candidate_values = standardized[candidates]
+        # best correlation with the features kept in previous blocks
+        best_correlation = np.zeros(candidates.size)
+        best_kept = np.full(candidates.size, -1, dtype=np.int64)
+        kept_positions = np.asarray(kept, dtype=np.int64)
+        for kept_start in range(0, kept_positions.size, block_size):
+            kept_block = kept_positions[kept_start:kept_start + block_size]
+            block_correlations = candidate_values @ standardized[kept_block].T
+            np.abs(block_correlations, out=block_correlations)
+            block_best = np.argmax(block_correlations, axis=1)
+            block_best_correlation = block_correlations[np.arange(candidates.size), block_best]
+            is_better = block_best_correlation > best_correlation
+            best_correlation[is_better] = block_best_correlation[is_better]
+            best_kept[is_better] = kept_block[block_best[is_better]]
+        is_redundant = best_correlation >= threshold
+        representatives[candidates[is_redundant]] = best_kept[is_redundant]
+        correlations[candidates[is_redundant]] = best_correlation[is_redundant]
+        # greedy selection within the block, in order of priority
+        remaining = np.flatnonzero(~is_redundant)
+        within_correlations = candidate_values[remaining] @ candidate_values[remaining].T
+        np.abs(within_correlations, out=within_correlations)
+        is_removed = np.zeros(remaining.size, dtype=bool)
+        for position in range(remaining.size):
+            if is_removed[position]:
+                continue
+            kept.append(candidates[remaining[position]])
+            newly_removed = np.flatnonzero((within_correlations[position] >= threshold) & ~is_removed)
+            newly_removed = newly_removed[newly_removed > position]
+            is_removed[newly_removed] = True
+            representatives[candidates[remaining[newly_removed]]] = candidates[remaining[position]]
+            correlations[candidates[remaining[newly_removed]]] = within_correlations[position, newly_removed]
+    return representatives, correlations
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import pandas as pd
+
+
+# feature identifiers such as 'rt-0.06_mz-124.96631'
+FEATURE_ID_PATTERN = r"rt-(?P<rt>[-+]?[0-9]*\.?[0-9]+(?:[eE][-+]?[0-9]+)?)_mz-(?P<mz>[-+]?[0-9]*\.?[0-9]+(?:[eE][-+]?[0-9]+)?)"
+
+
+def parse_feature_ids(feature_ids, pattern=FEATURE_ID_PATTERN):
+    '''
+    Parses the retention time and m/z of feature identifiers (e.g. 'rt-0.06_mz-124.96631') in one vectorized pass.
+
+    Parameters
+    ----------
+    feature_ids: list-like
+        The feature identifiers.
+    pattern: str, optional
+        A regular expression with the named groups 'rt' and 'mz' (default is FEATURE_ID_PATTERN).
+
+    Returns
+    -------
+    rt: `numpy.ndarray`, (n_features,)
+        The retention time of each feature (NaN if the identifier does not match the pattern).
+    mz: `numpy.ndarray`, (n_features,)
+        The m/z of each feature (NaN if the identifier does not match the pattern).
+    '''
+    parsed = pd.Index(feature_ids).astype(str).str.extract(pattern)
+    if "rt" not in parsed.columns or "mz" not in parsed.columns:
+        raise ValueError("The pattern should have the named groups 'rt' and 'mz' e.g. {0}".format(FEATURE_ID_PATTERN))
+    return parsed["rt"].astype(np.float64).to_numpy(), parsed["mz"].astype(np.float64).to_numpy()
+
+
+class FeatureIndex:
+    '''
+    An index of the features on their m/z and retention time (RT) for range and tolerance-window queries.
+
+    The m/z and RT values are kept sorted (with the positions of the features): a query finds the features of an
+    m/z window (or an RT window) by binary search in O(log n) and only the k features of the window are then checked
+    for the other dimension. Features without m/z or RT (identifiers that could not be parsed) are never returned.
+
+    Parameters
+    ----------
+    feature_ids: list-like, (n_features,)
+        The feature identifiers, in the order of the metabolome.
+    rt: `numpy.ndarray`, (n_features,)
+        The retention time of each feature.
+    mz: `numpy.ndarray`, (n_features,)
+        The m/z of each feature.
+
+    Example
+    -------
+    >>> index = FeatureIndex.from_feature_ids(metabolome.index)
+    >>> index.query(mz_range=(124.9, 125.0), rt_range=(0, 0.1))
+    >>> index.query_tolerance(mz=124.96631, ppm=10, rt=0.06, rt_tolerance=0.02)
+    '''
+    def __init__(self, feature_ids, rt, mz):
+        self.feature_ids = pd.Index(feature_ids)
+        self.rt = np.asarray(rt, dtype=np.float64)
+        self.mz = np.asarray(mz, dtype=np.float64)
+        if not len(self.feature_ids) == self.rt.size == self.mz.size:
+            raise ValueError("The number of retention times and m/z values should be equal to the number of features.")
+        # NaN values are sorted last: they are excluded by the binary searches
+        self._mz_order = np.argsort(self.mz, kind='stable')
+        self._sorted_mz = self.mz[self._mz_order]
+        self._rt_order = np.argsort(self.rt, kind='stable')
+        self._sorted_rt = self.rt[self._rt_order]
+
+    @classmethod
+    def from_feature_ids(cls, feature_ids, pattern=FEATURE_ID_PATTERN):
+        '''
+        Builds the index from feature identifiers holding the RT and m/z (see parse_feature_ids()).
+        '''
+        rt, mz = parse_feature_ids(feature_ids, pattern=pattern)
+        if len(rt) > 0 and np.all(np.isnan(rt) | np.isnan(mz)):
+            raise ValueError("No feature identifier matches the pattern {0} (e.g. 'rt-0.06_mz-124.96631').".format(pattern))
+        return cls(feature_ids, rt, mz)
+
+    def __len__(self):
+        return len(self.feature_ids)
+
+    @property
+    def n_unparsed(self):
+        '''
+        Number of features without m/z or RT.
+        '''
+        return int(np.count_nonzero(np.isnan(self.rt) | np.isnan(self.mz)))
+
+    def query(self, mz_range=None, rt_range=None):
+        '''
+        Positions of the features with min <= m/z <= max and min <= RT <= max, in the order of the features.
+        A range set to None (or a bound set to None) is not restricted.
+
+        Returns
+        -------
+        `numpy.ndarray`
+            The positions of the selected features.
+        '''
+        mz_min, mz_max = _get_bounds(mz_range)
+        rt_min, rt_max = _get_bounds(rt_range)
+        if mz_range is not None or rt_range is None:
+            start, stop = np.searchsorted(self._sorted_mz, mz_min, side='left'), np.searchsorted(self._sorted_mz, mz_max, side='right')
+            positions = self._mz_order[start:stop]
+            if rt_range is not None:
+                rt = self.rt[positions]
+                positions = positions[(rt >= rt_min) & (rt <= rt_max)]
+        else:
+            start, stop = np.searchsorted(self._sorted_rt, rt_min, side='left'), np.searchsorted(self._sorted_rt, rt_max, side='right')
+            positions = self._rt_order[start:stop]
+            mz = self.mz[positions]
+            positions = positions[(mz >= mz_min) & (mz <= mz_max)]
+        return np.sort(positions)
+
+    def query_tolerance(self, mz, ppm=10, rt=None, rt_tolerance=None):
+        '''
+        Positions of the features within ppm of mz (and within rt_tolerance of rt if both are specified).
+        '''
+        mz_tolerance = mz * ppm * 1e-6
+        rt_range = None if rt is None or rt_tolerance is None else (rt - rt_tolerance, rt + rt_tolerance)
+        return self.query(mz_range=(mz - mz_tolerance, mz + mz_tolerance), rt_range=rt_range)
+
+    def query_many(self, mz, ppm=10, rt=None, rt_tolerance=None):
+        '''
+        Tolerance-window queries for arrays of m/z (and RT) values at once (vectorized binary searches).
+
+        Returns
+        -------
+        query_positions: `numpy.ndarray`
+            For each match, the position of the query.
+        feature_positions: `numpy.ndarray`
+            For each match, the position of the feature.
+        '''
+        mz = np.asarray(mz, dtype=np.float64)
+        mz_tolerance = mz * ppm * 1e-6
+        starts = np.searchsorted(self._sorted_mz, mz - mz_tolerance, side='left')
+        stops = np.searchsorted(self._sorted_mz, mz + mz_tolerance, side='right')
+        n_matches = stops - starts
+        query_positions = np.repeat(np.arange(mz.size), n_matches)
+        # positions in the sorted m/z array: start of each query window + rank within the window
+        offsets = np.arange(n_matches.sum()) - np.repeat(np.cumsum(n_matches) - n_matches, n_matches)
+        feature_positions = self._mz_order[np.repeat(starts, n_matches) + offsets]
+        if rt is not None and rt_tolerance is not None:
+            rt = np.broadcast_to(np.asarray(rt, dtype=np.float64), mz.shape)
+            in_window = np.abs(self.rt[feature_positions] - rt[query_positions]) <= rt_tolerance
+            query_positions, feature_positions = query_positions[in_window], feature_positions[in_window]
+        return query_positions, feature_positions
+
+    def get_mask(self, mz_range=None, rt_range=None):
+        '''
+        Boolean mask (in the order of the features) of the features of an m/z and RT region (see query()).
+        '''
+        mask = np.zeros(len(self.feature_ids), dtype=bool)
+        mask[self.query(mz_range=mz_range, rt_range=rt_range)] = True
+        return mask
+
+    def select_features(self, features_to_keep):
+        '''
+        Returns the index of the features selected by the boolean array features_to_keep (no parsing needed).
+        '''
+        positions = np.flatnonzero(features_to_keep)
+        return FeatureIndex(self.feature_ids[positions], self.rt[positions], self.mz[positions])
+
+    def to_frame(self):
+        '''
+        Returns a dataframe with the 'rt' and 'mz' columns indexed by feature identifiers.
+        '''
+        return pd.DataFrame({"rt": self.rt, "mz": self.mz}, index=self.feature_ids)
+
+
+def _get_bounds(value_range):
+    if value_range is None:
+        return -np.inf, np.inf
+    lower, upper = value_range
+    return (-np.inf if lower is None else lower), (np.inf if upper is None else upper)
@@ -23,7 +23,9 @@ from sklearn.tree import DecisionTreeClassifier
 from tpot import TPOTClassifier
 from tpot.export_utils import set_param_recursive
 
+from phenofeaturefinder.metabolome_io import load_metabolome
 from phenofeaturefinder.utils import compute_metrics_classification 
+from phenofeaturefinder.feature_index import FeatureIndex, FEATURE_ID_PATTERN
 
 
 # TPOT automated ML custom configuration dictionary
@@ -154,6 +156,15 @@ class FeatureSelection:
     phenotype_sample_id: string, default='sample_id'
         The name of the column that contains the sample identifiers.
         Sample identifiers should be unique (=not duplicated).
+    dtype: string, default='float32'
+        The dtype used to parse the metabolite values. 
+    chunksize: int, default=100000
+        Number of features parsed at once when reading the metabolome .csv file.
+    cache_dir: string, default=None
+        Opt-in directory where the parsed metabolome matrix is cached in binary format.
+        Later loads of the same unchanged .csv file are near-instant memory-mapped reads. 
+    cache_max_size_gb: float, default=10
+        Maximum size of the cache directory in gigabytes (least recently used matrices are removed first).
 
 
     Attributes
@@ -243,6 +254,7 @@ class FeatureSelection:
     phenotype_validated=False
     baseline_performance=None
     best_ensemble_models_searched=False
+    feature_index=None
 
     # Class constructor method
     def __init__(
@@ -250,14 +262,20 @@ class FeatureSelection:
         metabolome_csv, 
         phenotype_csv,
         metabolome_feature_id_col='feature_id', 
-        phenotype_sample_id='sample_id'):
+        phenotype_sample_id='sample_id',
+        dtype='float32',
+        chunksize=100000,
+        cache_dir=None,
+        cache_max_size_gb=10):
         
-        # Import metabolome dataframe and verify presence of feature id column
-        self.metabolome = pd.read_csv(metabolome_csv)
-        if metabolome_feature_id_col not in self.metabolome.columns:
-            raise ValueError("The specified column with feature identifiers '{0}' is not present in your '{1}' file.".format(metabolome_feature_id_col,os.path.basename(metabolome_csv)))
-        else:
-            self.metabolome.set_index(metabolome_feature_id_col, inplace=True)
+        # Import metabolome dataframe with an explicit schema (verifies presence of feature id column)
+        self.metabolome = load_metabolome(
+            metabolome_csv, 
+            metabolome_feature_id_col=metabolome_feature_id_col, 
+            dtype=dtype, 
+            chunksize=chunksize,
+            cache_dir=cache_dir,
+            cache_max_size_gb=cache_max_size_gb)
 
         # Import phenotype dataframe and verify presence of sample id column
         self.phenotype = pd.read_csv(phenotype_csv)
@@ -625,7 +643,16 @@ class FeatureSelection:
          pass
 
     
-    def get_names_of_top_n_features_from_selected_pc(self, selected_pc=1, top_n=5):
+    def get_feature_index(self, pattern=FEATURE_ID_PATTERN):
+        '''
+        Returns the m/z and retention time index of the metabolome features (parsed once from the feature identifiers).
+        See feature_index.FeatureIndex.
+        '''
+        if self.feature_index is None or not self.feature_index.feature_ids.equals(self.metabolome.index):
+            self.feature_index = FeatureIndex.from_feature_ids(self.metabolome.index, pattern=pattern)
+        return self.feature_index
+
+    def get_names_of_top_n_features_from_selected_pc(self, selected_pc=1, top_n=5, mz_range=None, rt_range=None):
         """
         Get the names of features with highest loading scores on selected PC  
 
@@ -643,6 +670,13 @@ class FeatureSelection:
           The top_n features with the highest absolute loadings will be selected from the selected_pc PC. 
           For instance, the top 5 features from PC1 will be selected with selected_pc=1 and top_n=5.
           Default is 5.
+        mz_range: tuple, optional
+          Only select among the features with a m/z within (min, max), bounds included. 
+          The m/z and retention time are parsed from feature identifiers such as 'rt-0.06_mz-124.96631' (see get_feature_index()).
+          Default is None (all m/z values).
+        rt_range: tuple, optional
+          Only select among the features with a retention time within (min, max), bounds included.
+          Default is None (all retention times).
 
         Returns:
           A list of feature names. 
@@ -661,7 +695,11 @@ class FeatureSelection:
         zero_off_selected_pc = selected_pc - 1 # avoid 1-off error
 
         loadings_of_selected_pc = self.loadings[zero_off_selected_pc]
-        loadings_indices_top_n_of_selected_pc = np.argsort(loadings_of_selected_pc)[::-1][:top_n] # argsort returns the indices
+        loadings_indices_top_n_of_selected_pc = np.argsort(loadings_of_selected_pc)[::-1] # argsort returns the indices
+        if mz_range is not None or rt_range is not None:
+          in_region = self.get_feature_index().get_mask(mz_range=mz_range, rt_range=rt_range)
+          loadings_indices_top_n_of_selected_pc = loadings_indices_top_n_of_selected_pc[in_region[loadings_indices_top_n_of_selected_pc]]
+        loadings_indices_top_n_of_selected_pc = loadings_indices_top_n_of_selected_pc[:top_n]
         loadings_values_top_n_of_selected_pc = loadings_of_selected_pc[loadings_indices_top_n_of_selected_pc]
         top_features_selected_pc = metabolite_df.iloc[:, loadings_indices_top_n_of_selected_pc].columns.tolist()
         names_loadings_top_features = pd.DataFrame({'feature_name': top_features_selected_pc, 
@@ -0,0 +1,405 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import pandas as pd
+
+from phenofeaturefinder.utils import calculate_percentile, count_detections_per_group
+from phenofeaturefinder.utils import sum_per_feature, max_per_group, has_negative_values
+from phenofeaturefinder.quantile_sketch import sketch_per_group, merge_sketches
+from phenofeaturefinder.quantile_sketch import bracket_percentile, count_in_bracket, percentile_from_bracket
+from phenofeaturefinder.parallel import map_feature_blocks
+
+
+# size parameter of the quantile sketches that bracket exact percentiles (rank error bound of about 0.18% of the values)
+EXACT_PERCENTILE_SKETCH_K = 2048
+
+
+class FilterPlan:
+    '''
+    A lazy plan of the OmicsAnalysis cleaning chain (blank, percentile and reliability filters).
+
+    Filters are only recorded when they are added to the plan.
+    When the plan is executed, all per-feature statistics needed by the recorded filters
+    (sum in blank samples, maximum and number of detections per group, quantile sketches of the groups) are computed 
+    in a single pass over blocks of features of the store. Exact percentiles need one more pass (see compute_exact_percentiles()). The filters are then resolved in the order they were recorded
+    to give one combined mask of features to keep and the list of samples to drop.
+    The result is identical to calling the filters one after the other.
+
+    Parameters
+    ----------
+    columns: `pandas.core.indexes.base.Index`
+        The sample names of the metabolome when the plan is created.
+
+    Attributes
+    ----------
+    steps: list
+        The recorded filters (one dictionary per filter).
+    columns: `pandas.core.indexes.base.Index`
+        The sample names that will remain after the recorded filters.
+    '''
+    def __init__(self, columns):
+        self.steps = []
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.steps)
+
+    def add_blank_filter(self, blank_sample_contains='blank', validate=False):
+        '''
+        Records the removal of features detected in blank samples and of the blank samples.
+        If validate is True, the metabolite values are checked for negative values during the pass.
+        '''
+        blank_cols = [col for col in self.columns.tolist() if blank_sample_contains in col]
+        self.steps.append(dict(name="discard_features_detected_in_blanks", columns=self.columns, blank_cols=blank_cols, validate=validate))
+        self.columns = self.columns[~self.columns.isin(blank_cols)]
+
+    def add_percentile_filter(self, sample_sheet, percentile=50, sketch_k=None):
+        '''
+        Records the removal of features lower than the percentile value of every group.
+        sample_sheet gives the groups of the samples remaining at this step (see sample_sheet.SampleSheet).
+        With sketch_k, the percentiles are approximated with quantile sketches built during the pass (see quantile_sketch.KLLSketch).
+        Without sketch_k, the exact percentiles need one more pass over the store that only keeps the values near
+        each percentile (see compute_exact_percentiles()): the values are never gathered in memory.
+        The sketches of a percentile filter recorded after another one are built by an extra pass (they depend on its result).
+        '''
+        self.steps.append(dict(name="filter_features_per_group_by_percentile", columns=self.columns, sample_sheet=sample_sheet, percentile=percentile, sketch_k=sketch_k))
+
+    def add_reliability_filter(self, sample_sheet, nb_times_detected=4):
+        '''
+        Records the removal of features not detected nb_times_detected times in at least one group.
+        sample_sheet gives the groups of the samples remaining at this step (see sample_sheet.SampleSheet).
+        '''
+        self.steps.append(dict(name="filter_out_unreliable_features", columns=self.columns, sample_sheet=sample_sheet, nb_times_detected=nb_times_detected))
+
+    def execute(self, store, block_size=50000, n_jobs=1):
+        '''
+        Computes the statistics of all recorded filters in one pass over the store and resolves the filters.
+
+        Parameters
+        ----------
+        store: object
+            A metabolome store (see metabolome_storage) with the sample names the plan was created with.
+        block_size: int, optional
+            Number of features read at once (default is 50000).
+        n_jobs: int, optional
+            Number of worker processes computing the statistics of blocks of features (default is 1). 
+            See parallel.map_feature_blocks().
+
+        Returns
+        -------
+        features_to_keep: `numpy.ndarray`, (n_features,)
+            Boolean mask of the features that pass all recorded filters.
+        columns_to_drop: list
+            The sample names removed by the recorded filters (blank samples).
+        report: `pandas.core.frame.DataFrame`
+            Number of features removed and remaining after each filter.
+        '''
+        n_features = store.shape[0]
+        store_columns = store.columns
+
+        ### Column positions and group codes of each step (O(n_samples))
+        block_steps = []
+        for step in self.steps:
+            if step["name"] == "discard_features_detected_in_blanks":
+                block_steps.append(dict(name=step["name"], positions=store_columns.get_indexer(step["blank_cols"])))
+            else:
+                block_steps.append(dict(
+                    name=step["name"], 
+                    positions=store_columns.get_indexer(step["columns"]), 
+                    group_codes=step["sample_sheet"].group_codes, 
+                    n_groups=step["sample_sheet"].n_groups,
+                    nb_times_detected=step.get("nb_times_detected")))
+
+        # The percentile of a group depends on the features that remain before the filter.
+        # The first percentile filter uses quantile sketches of the features that pass the filters recorded before it,
+        # built block by block during the pass and merged. The following ones need the result of the previous filters:
+        # their sketches are built by another pass over the features that remain. No values are gathered:
+        # exact percentiles are selected from the values near each percentile (see compute_exact_percentiles()).
+        percentile_steps = [i for i, step in enumerate(self.steps) if step["name"] == "filter_features_per_group_by_percentile"]
+        if len(percentile_steps) > 0:
+            first_percentile_step = percentile_steps[0]
+            block_steps[first_percentile_step]["sketch_k"] = _get_sketch_k(self.steps[first_percentile_step]["sketch_k"])
+
+        ### Single pass over blocks of features
+        block_statistics = map_feature_blocks(
+            store, 
+            _compute_block_statistics, 
+            n_jobs=n_jobs, 
+            block_size=block_size,
+            steps=block_steps, 
+            validate=any(step.get("validate", False) for step in self.steps))
+        if any(has_negative_block for has_negative_block, _, _ in block_statistics):
+            raise ValueError("Sorry, metabolite values have to be zero or positive integers (>=0)")
+        step_statistics = []
+        for i, step in enumerate(block_steps):
+            statistics = [block_step_statistics[i] for _, block_step_statistics, _ in block_statistics]
+            if step["name"] == "filter_features_per_group_by_percentile":
+                step_statistics.append(np.concatenate(statistics) if len(statistics) > 0 else np.zeros((0, step["n_groups"])))
+            else:
+                step_statistics.append(np.concatenate(statistics) if len(statistics) > 0 else np.zeros(0, dtype=bool))
+
+        ### Resolve the filters in the order they were recorded
+        features_to_keep = np.ones(n_features, dtype=bool)
+        columns_to_drop = []
+        report = []
+        for i, (step, block_step, statistics) in enumerate(zip(self.steps, block_steps, step_statistics)):
+            if step["name"] == "filter_features_per_group_by_percentile":
+                group_positions = [block_step["positions"][block_step["group_codes"] == group_code] for group_code in range(block_step["n_groups"])]
+                if i == percentile_steps[0]:
+                    group_sketches = merge_sketches([sketches for _, _, sketches in block_statistics])
+                else:
+                    group_sketches = merge_sketches(map_feature_blocks(
+                        store, _sketch_block, n_jobs=n_jobs, block_size=block_size, pass_bounds=True, features=features_to_keep,
+                        positions=block_step["positions"], group_codes=block_step["group_codes"], n_groups=block_step["n_groups"],
+                        sketch_k=_get_sketch_k(step["sketch_k"])))
+                if step["sketch_k"] is not None:
+                    group_percentiles = [calculate_percentile(sketch, my_percentile=step["percentile"]) for sketch in group_sketches]
+                else:
+                    remaining_features = features_to_keep.copy()
+                    queries = [
+                        dict(features=remaining_features, positions=positions, sketch=sketch, percentiles=[step["percentile"]])
+                        for positions, sketch in zip(group_positions, group_sketches)]
+                    group_percentiles = [percentiles[0] for percentiles in compute_exact_percentiles(store, queries, block_size=block_size, n_jobs=n_jobs)]
+                step_features_to_keep = np.zeros(n_features, dtype=bool)
+                for group_code, group_percentile in enumerate(group_percentiles):
+                    step_features_to_keep |= statistics[:, group_code] > group_percentile
+            else:
+                step_features_to_keep = statistics
+            if step["name"] == "discard_features_detected_in_blanks":
+                columns_to_drop += step["blank_cols"]
+            n_removed = int(np.count_nonzero(features_to_keep & ~step_features_to_keep))
+            features_to_keep &= step_features_to_keep
+            report.append((step["name"], n_removed, int(np.count_nonzero(features_to_keep))))
+
+        report = pd.DataFrame(report, columns=["filter", "features_removed", "features_remaining"])
+        return features_to_keep, columns_to_drop, report
+
+
+def _get_sketch_k(sketch_k):
+    # exact percentiles use large sketches to bracket the percentile (see compute_exact_percentiles())
+    return EXACT_PERCENTILE_SKETCH_K if sketch_k is None else sketch_k
+
+def _compute_block_statistics(values, steps, validate):
+    '''
+    Statistics of all steps of a plan for one block of features (run in worker processes with n_jobs > 1).
+
+    Returns whether the block has negative values, the statistic of each step (mask of features to keep for the blank 
+    and reliability filters, maximum per group for the percentile filters) and the quantile sketches of each group
+    for the first percentile filter (features that pass the previous steps).
+    '''
+    has_negative_block = validate and has_negative_values(values)
+    statistics = []
+    sketches = None
+    for step in steps:
+        if step.get("sketch_k") is not None:
+            # values of the features that pass the previous steps of the block
+            passing_previous_steps = np.ones(values.shape[0], dtype=bool)
+            for step_statistics in statistics:
+                passing_previous_steps &= step_statistics
+            sketches = sketch_per_group(
+                values[:, step["positions"]], step["group_codes"], step["n_groups"], k=step["sketch_k"], random_state=0, features=passing_previous_steps)
+        step_values = values[:, step["positions"]]
+        if step["name"] == "discard_features_detected_in_blanks":
+            statistics.append(sum_per_feature(step_values) == 0)
+        elif step["name"] == "filter_out_unreliable_features":
+            detections_per_group = count_detections_per_group(step_values, step["group_codes"], n_groups=step["n_groups"])
+            max_detections_across_all_groups = detections_per_group.max(axis=1, initial=0)
+            statistics.append((max_detections_across_all_groups >= step["nb_times_detected"]) & (max_detections_across_all_groups > 0))
+        else:
+            statistics.append(max_per_group(step_values, step["group_codes"], step["n_groups"]))
+    return has_negative_block, statistics, sketches
+
+def _sketch_block(values, start, stop, features, positions, group_codes, n_groups, sketch_k):
+    '''
+    Quantile sketches of each group for the selected features (mask of all features) of one block of features.
+    '''
+    return sketch_per_group(values[:, positions], group_codes, n_groups, k=sketch_k, random_state=0, features=features[start:stop])
+
+
+def compute_exact_percentiles(store, queries, block_size=50000, n_jobs=1):
+    '''
+    Exact percentiles of groups of values of a store, without gathering the values.
+
+    The quantile sketch of each group of values gives a narrow bracket around each percentile (see quantile_sketch.bracket_percentile()).
+    One pass over blocks of features counts the values below each bracket and only collects the values inside it
+    (about 0.7% of the values with sketches of size EXACT_PERCENTILE_SKETCH_K), then the order statistics of the percentile
+    are selected among them. A bracket that misses the percentile (unlikely, see quantile_sketch.KLLSketch) is widened 
+    to all values and the pass is repeated for this percentile only.
+
+    Parameters
+    ----------
+    store: object
+        A metabolome store (see metabolome_storage).
+    queries: list of dict
+        One dictionary per group of values: 'features' (boolean mask of the features), 'positions' (column positions of the samples),
+        'sketch' (a KLLSketch of these values, see quantile_sketch.sketch_per_group()) and 'percentiles' (list of percentiles).
+    block_size: int, optional
+        Number of features read at once (default is 50000).
+    n_jobs: int, optional
+        Number of worker processes (default is 1). See parallel.map_feature_blocks().
+
+    Returns
+    -------
+    list of `numpy.ndarray`
+        The percentiles of each query (NaN for values with missing values, like numpy.percentile()).
+    '''
+    results = [np.full(len(query["percentiles"]), np.nan) for query in queries]
+    brackets = {
+        (i, j): bracket_percentile(query["sketch"], percentile)
+        for i, query in enumerate(queries) if not query["sketch"].has_nan
+        for j, percentile in enumerate(query["percentiles"])}
+    for is_widened in (False, True):
+        if len(brackets) == 0:
+            break
+        keys = list(brackets)
+        block_counts = map_feature_blocks(
+            store, _count_in_brackets, n_jobs=n_jobs, block_size=block_size, pass_bounds=True,
+            queries=[(queries[i]["features"], queries[i]["positions"]) + brackets[(i, j)] for i, j in keys])
+        missed = {}
+        for position, (i, j) in enumerate(keys):
+            counts = sum(block[position][0] for block in block_counts)
+            inside = np.concatenate([block[position][1] for block in block_counts])
+            lower, upper = brackets[(i, j)]
+            value = percentile_from_bracket(queries[i]["sketch"].n, queries[i]["percentiles"][j], lower, upper, counts, inside)
+            if value is None:
+                if is_widened:
+                    raise RuntimeError("The values of the store changed while computing their percentiles.")
+                missed[(i, j)] = (queries[i]["sketch"].min_value, queries[i]["sketch"].max_value)
+            else:
+                results[i][j] = value
+        brackets = missed
+    return results
+
+def _count_in_brackets(values, start, stop, queries):
+    '''
+    count_in_bracket() of each query (features, positions, lower, upper) for one block of features.
+    '''
+    selected_rows = {}
+    counts = []
+    for features, positions, lower, upper in queries:
+        # queries on the same features share the selection of the rows of the block
+        if id(features) not in selected_rows:
+            selected_rows[id(features)] = values[np.flatnonzero(features[start:stop])]
+        counts.append(count_in_bracket(selected_rows[id(features)][:, positions], lower, upper))
+    return counts
+
+
+def sweep_filter_parameters(store, sample_sheets, percentiles, nb_times_detected, blank_policies, block_size=50000, n_jobs=1, sketch_k=None):
+    '''
+    Number of features retained by the cleaning chain (blank filter, percentile filter, reliability filter)
+    for every combination of blank policy, percentile and number of detections, and their overlaps.
+
+    The sufficient statistics are computed once, in a single pass over blocks of features of the store:
+    features detected in blank samples, maximum and number of detections per group for each blank policy
+    and the quantile sketches of each group after the blank filter. With sketch_k, the percentiles of all grid points 
+    are approximated from the sketches. Otherwise one more pass selects the exact percentiles of all blank policies at once 
+    from the values near each percentile (see compute_exact_percentiles()). No copy of the values is made for a blank policy.
+    Every grid point is then resolved from boolean masks, without filtering copies of the metabolome.
+
+    Parameters
+    ----------
+    store: object
+        A metabolome store (see metabolome_storage).
+    sample_sheets: list of `sample_sheet.SampleSheet`
+        For each blank policy, the sample sheet of the samples that remain after its blank filter.
+    percentiles: list-like
+        The percentile thresholds (see OmicsAnalysis.filter_features_per_group_by_percentile()).
+    nb_times_detected: list-like
+        The detection thresholds (see OmicsAnalysis.filter_out_unreliable_features()).
+    blank_policies: list
+        For each blank policy, the blank sample names (features detected in them are removed and they are dropped)
+        or None (no blank filter).
+    block_size: int, optional
+        Number of features read at once (default is 50000).
+    n_jobs: int, optional
+        Number of worker processes (default is 1). See parallel.map_feature_blocks().
+    sketch_k: int, optional
+        Approximate the percentiles with quantile sketches of size parameter sketch_k (default is None: exact percentiles).
+
+    Returns
+    -------
+    sweep: `pandas.core.frame.DataFrame`
+        One row per grid point: 'blank_policy' (position in blank_policies), 'percentile', 'nb_times_detected' and 'features_retained'.
+    overlaps: `numpy.ndarray`, (n_grid_points, n_grid_points)
+        Number of features retained by both grid points.
+    '''
+    columns = store.columns
+    policies = []
+    for blank_cols, sample_sheet in zip(blank_policies, sample_sheets):
+        policies.append(dict(
+            blank_positions=None if blank_cols is None else columns.get_indexer(list(blank_cols)),
+            positions=columns.get_indexer(sample_sheet.sample_names),
+            group_codes=sample_sheet.group_codes,
+            n_groups=sample_sheet.n_groups))
+
+    ### Single pass over blocks of features
+    block_statistics = map_feature_blocks(
+        store, _compute_sweep_block_statistics, n_jobs=n_jobs, block_size=block_size, policies=policies, sketch_k=_get_sketch_k(sketch_k))
+
+    ### Per-feature statistics and quantile sketches of the groups of each blank policy
+    policy_statistics = []
+    queries = []
+    for i, policy in enumerate(policies):
+        blocks = [block[i] for block in block_statistics]
+        keep = np.concatenate([block_keep for block_keep, _, _, _ in blocks]) if len(blocks) > 0 else np.zeros(0, dtype=bool)
+        maximum = np.concatenate([block_maximum for _, block_maximum, _, _ in blocks]) if len(blocks) > 0 else np.zeros((0, policy["n_groups"]))
+        detections = np.concatenate([block_detections for _, _, block_detections, _ in blocks]) if len(blocks) > 0 else np.zeros(0, dtype=int)
+        group_sketches = merge_sketches([block_sketches for _, _, _, block_sketches in blocks])
+        for group_code in range(policy["n_groups"]):
+            queries.append(dict(
+                features=keep, 
+                positions=policy["positions"][policy["group_codes"] == group_code], 
+                sketch=group_sketches[group_code], 
+                percentiles=list(percentiles)))
+        policy_statistics.append([keep, maximum, detections, None])
+
+    ### Percentile of each group (one column per percentile)
+    if sketch_k is not None:
+        query_percentiles = [
+            np.array([calculate_percentile(query["sketch"], my_percentile=percentile) for percentile in percentiles]) for query in queries]
+    else:
+        query_percentiles = compute_exact_percentiles(store, queries, block_size=block_size, n_jobs=n_jobs)
+    first_query = 0
+    for statistics, policy in zip(policy_statistics, policies):
+        statistics[3] = np.array(query_percentiles[first_query:first_query + policy["n_groups"]]).reshape(policy["n_groups"], len(percentiles))
+        first_query += policy["n_groups"]
+
+    ### Resolve every grid point from the masks, block by block of features
+    grid = [(i, j, n) for i in range(len(policies)) for j in range(len(percentiles)) for n in nb_times_detected]
+    features_retained = np.zeros(len(grid), dtype=np.int64)
+    overlaps = np.zeros((len(grid), len(grid)), dtype=np.int64)
+    for start in range(0, store.shape[0], block_size):
+        stop = min(start + block_size, store.shape[0])
+        masks = np.zeros((len(grid), stop - start), dtype=bool)
+        for g, (i, j, n) in enumerate(grid):
+            keep, maximum, detections, group_percentiles = policy_statistics[i]
+            masks[g] = (keep[start:stop] 
+                        & (maximum[start:stop] > group_percentiles[:, j]).any(axis=1) 
+                        & (detections[start:stop] >= n) & (detections[start:stop] > 0))
+        masks = masks.astype(np.float32)
+        features_retained += masks.sum(axis=1).astype(np.int64)
+        overlaps += np.rint(masks @ masks.T).astype(np.int64)
+
+    sweep = pd.DataFrame(grid, columns=["blank_policy", "percentile", "nb_times_detected"])
+    sweep["percentile"] = np.asarray(percentiles)[sweep["percentile"].to_numpy()] if len(grid) > 0 else []
+    sweep["features_retained"] = features_retained
+    return sweep, overlaps
+
+def _compute_sweep_block_statistics(values, policies, sketch_k):
+    '''
+    Statistics of each blank policy of a sweep for one block of features (run in worker processes with n_jobs > 1):
+    mask of the features not detected in the blank samples, maximum and maximum number of detections per group 
+    and the quantile sketches of each group for the features not detected in the blank samples.
+    '''
+    statistics = []
+    for policy in policies:
+        if policy["blank_positions"] is None:
+            keep = np.ones(values.shape[0], dtype=bool)
+        else:
+            keep = sum_per_feature(values[:, policy["blank_positions"]]) == 0
+        policy_values = values[:, policy["positions"]]
+        maximum = max_per_group(policy_values, policy["group_codes"], policy["n_groups"])
+        detections = count_detections_per_group(policy_values, policy["group_codes"], n_groups=policy["n_groups"]).max(axis=1, initial=0)
+        sketches = sketch_per_group(policy_values, policy["group_codes"], policy["n_groups"], k=sketch_k, random_state=0, features=keep)
+        statistics.append((keep, maximum, detections, sketches))
+    return statistics
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+import warnings
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+
+IMPUTATION_STRATEGIES = ("median", "group_median", "min_fraction", "knn")
+
+
+def is_missing(values, missing_values=np.nan):
+    '''
+    Boolean mask of the missing values of a dense numpy array.
+    Missing values are NaN when missing_values is NaN (or the string 'np.nan'/'nan'), otherwise the values equal to missing_values.
+    '''
+    if is_nan_value(missing_values):
+        return np.isnan(values)
+    return values == missing_values
+
+def is_nan_value(missing_values):
+    '''
+    Does missing_values represent NaN? The strings 'np.nan' and 'nan' are accepted for backward compatibility.
+    '''
+    if isinstance(missing_values, str):
+        if missing_values.lower() in ("np.nan", "nan"):
+            return True
+        raise ValueError("The missing values of the metabolome are expected to be numerical. Got missing_values={0}.".format(repr(missing_values)))
+    return bool(pd.isna(missing_values))
+
+def _to_dense(values):
+    if sparse.issparse(values):
+        return values.toarray()
+    return np.asarray(values)
+
+
+######################################################
+### Imputation of one block of features (worker tasks)
+######################################################
+# Each function returns (rows, cols, fill_values, n_rows) for the missing cells of the block that could be imputed:
+# rows are relative to the block, in row-major order (sorted by row then by column).
+
+def impute_block_with_sample_values(values, sample_values, missing_values=np.nan):
+    '''
+    Imputes the missing values of each sample (column) with one value per sample (e.g. the median of the sample).
+    '''
+    values = _to_dense(values)
+    rows, cols = np.nonzero(is_missing(values, missing_values))
+    fill_values = np.asarray(sample_values)[cols]
+    is_imputed = ~np.isnan(fill_values)
+    return rows[is_imputed], cols[is_imputed], fill_values[is_imputed], values.shape[0]
+
+def impute_block_with_group_medians(values, group_codes, n_groups, missing_values=np.nan):
+    '''
+    Imputes the missing values of a feature with the median of the feature in the samples of the same group.
+    '''
+    values = _to_dense(values).astype(np.float64)
+    missing = is_missing(values, missing_values)
+    values[missing] = np.nan
+    group_codes = np.asarray(group_codes)
+    group_medians = np.full((values.shape[0], n_groups), np.nan)
+    with warnings.catch_warnings():
+        # groups with only missing values give NaN (not imputed)
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        for group_code in range(n_groups):
+            group_positions = np.flatnonzero(group_codes == group_code)
+            if group_positions.size > 0:
+                group_medians[:, group_code] = np.nanmedian(values[:, group_positions], axis=1)
+    rows, cols = np.nonzero(missing)
+    fill_values = group_medians[rows, group_codes[cols]]
+    is_imputed = ~np.isnan(fill_values)
+    return rows[is_imputed], cols[is_imputed], fill_values[is_imputed], values.shape[0]
+
+def impute_block_with_min_fraction(values, min_value_fraction=0.2, missing_values=np.nan):
+    '''
+    Imputes the missing values of a feature with a fraction of its minimum detected (> 0) value.
+    '''
+    values = _to_dense(values).astype(np.float64)
+    missing = is_missing(values, missing_values)
+    detected_values = np.where(~missing & (values > 0), values, np.inf)
+    min_detected_values = detected_values.min(axis=1, initial=np.inf)
+    rows, cols = np.nonzero(missing)
+    fill_values = min_detected_values[rows] * min_value_fraction
+    is_imputed = np.isfinite(fill_values)
+    return rows[is_imputed], cols[is_imputed], fill_values[is_imputed], values.shape[0]
+
+def compute_block_sample_distances(values, missing_values=np.nan):
+    '''
+    Sums over a block of features of the squared differences between samples (columns) and numbers of features
+    present in both samples. Summed over all blocks, they give the nan-euclidean distances between samples
+    (see compute_nan_euclidean_distances()).
+    '''
+    values = _to_dense(values).astype(np.float64)
+    present = (~is_missing(values, missing_values)).astype(np.float64)
+    values = np.where(present > 0, values, 0.0)
+    squared_values = values**2
+    squared_differences = squared_values.T @ present + present.T @ squared_values - 2 * values.T @ values
+    return np.maximum(squared_differences, 0), present.T @ present
+
+def compute_nan_euclidean_distances(squared_differences, n_present, n_features):
+    '''
+    Euclidean distances between samples ignoring missing values, weighted by the fraction of features present
+    in both samples (same definition as scikit-learn nan_euclidean_distances). Infinite if no feature is shared.
+    '''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        distances = np.sqrt(squared_differences * n_features / n_present)
+    distances[n_present == 0] = np.inf
+    return distances
+
+def impute_block_with_knn(values, neighbor_order, n_neighbors=5, missing_values=np.nan):
+    '''
+    Imputes the missing values of a sample with the mean value of the feature in the n_neighbors nearest samples
+    in which the feature is present (same as scikit-learn KNNImputer with uniform weights, on samples).
+
+    Parameters
+    ----------
+    neighbor_order: `numpy.ndarray`, (n_samples, n_samples - 1)
+        For each sample, the other samples sorted by increasing distance.
+    '''
+    values = _to_dense(values).astype(np.float64)
+    missing = is_missing(values, missing_values)
+    present = ~missing
+    fill_values = np.full(values.shape, np.nan)
+    for sample in np.flatnonzero(missing.any(axis=0)):
+        rows = np.flatnonzero(missing[:, sample])
+        donors = neighbor_order[sample]
+        donor_present = present[np.ix_(rows, donors)]
+        # the n_neighbors nearest donors in which the feature is present
+        is_neighbor = donor_present & (np.cumsum(donor_present, axis=1) <= n_neighbors)
+        n_donors = is_neighbor.sum(axis=1)
+        donor_values = np.where(is_neighbor, values[np.ix_(rows, donors)], 0.0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            fill_values[rows, sample] = np.where(n_donors > 0, donor_values.sum(axis=1) / n_donors, np.nan)
+    rows, cols = np.nonzero(missing)
+    fill_values = fill_values[rows, cols]
+    is_imputed = ~np.isnan(fill_values)
+    return rows[is_imputed], cols[is_imputed], fill_values[is_imputed], values.shape[0]
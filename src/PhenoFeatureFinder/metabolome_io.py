@@ -0,0 +1,428 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+import pandas as pd
+
+# pyarrow provides a multi-threaded csv parser
+# it is optional: the chunked pandas parser is used when it is not installed
+try:
+    import pyarrow as pa
+    from pyarrow import csv as pa_csv
+except ImportError:
+    pa = None
+    pa_csv = None
+
+# pyarrow csv blocks (bytes) and largest file parsed at once by the multi-threaded reader
+_MIN_BLOCK_BYTES = 1 << 20
+_MAX_BLOCK_BYTES = 64 << 20
+_MAX_THREADED_READ_BYTES = 1 << 30
+
+def read_metabolome_csv(
+    metabolome_csv,
+    metabolome_feature_id_col='feature_id',
+    dtype='float32',
+    chunksize=100000,
+    blank_sample_contains=None,
+    discard_features_detected_in_blanks=False,
+    row_filter=None,
+    use_threads=True):
+    '''
+    Reads a metabolome .csv file chunk by chunk with an explicit schema.
+
+    Instead of inferring the type of every column, all sample columns are parsed with the same numeric dtype
+    (float32 by default, which halves the memory used compared to float64) and the feature identifiers are used as index.
+    Columns and rows can be pruned while reading so that they never reach memory:
+      - blank columns (selected by blank_sample_contains) are dropped at read time.
+      - a row filter can be applied on each chunk e.g. to discard features detected in blank samples.
+
+    When pyarrow is installed and no row is filtered, files of up to 1 GB are parsed at once by its multi-threaded csv reader:
+    the whole table is held in memory next to the returned dataframe (a higher peak than the pandas parser).
+    With a row filter, or for larger files, the file is streamed block by block (single-threaded, only one block
+    of at most 64 MB in memory) so that the rejected features and the columns only read for the filter never
+    reach memory as a whole. Without pyarrow, the pandas C parser reads the file in chunks of 'chunksize' rows.
+
+    Parameters
+    ----------
+    metabolome_csv: str
+        A path to a .csv file with the metabolome data.
+    metabolome_feature_id_col: str, optional
+        The name of the column that contains the feature identifiers (default is 'feature_id').
+    dtype: str or numpy.dtype, optional
+        The dtype of the sample columns (default is 'float32').
+    chunksize: int, optional
+        Number of rows (features) parsed at once (default is 100000).
+    blank_sample_contains: str, optional
+        Column names with this name will be considered blank samples and will not be part of the returned dataframe.
+        Default is None (no column is dropped).
+    discard_features_detected_in_blanks: `bool`, optional
+        If True, features with a positive summed abundance in the blank samples are discarded while reading.
+        Requires blank_sample_contains. Default is False.
+    row_filter: callable, optional
+        A function that takes a chunk (pandas dataframe with feature identifiers in index, including blank columns)
+        and returns a boolean array with True for the features to keep.
+        Default is None (all features are kept).
+    use_threads: `bool`, optional
+        Use the pyarrow parser when it is available (default is True). Without row filter, files of up to 1 GB
+        are then parsed at once (see above): use False to keep the peak memory of a chunked read.
+
+    Returns
+    -------
+    metabolome: `pandas.core.frame.DataFrame`, (n_features, n_samples)
+        The metabolome dataframe with the feature identifiers as index.
+
+    Example
+    -------
+    >>> df = read_metabolome_csv(
+        metabolome_csv='my_metabolome_data.csv',
+        blank_sample_contains='blank',
+        discard_features_detected_in_blanks=True)
+    '''
+    chunks = list(iter_metabolome_csv(
+        metabolome_csv,
+        metabolome_feature_id_col=metabolome_feature_id_col,
+        dtype=dtype,
+        chunksize=chunksize,
+        blank_sample_contains=blank_sample_contains,
+        discard_features_detected_in_blanks=discard_features_detected_in_blanks,
+        row_filter=row_filter,
+        use_threads=use_threads))
+    if len(chunks) == 1:
+        return chunks[0]
+    return pd.concat(chunks[1:], axis=0, copy=False)
+
+
+def iter_metabolome_csv(
+    metabolome_csv,
+    metabolome_feature_id_col='feature_id',
+    dtype='float32',
+    chunksize=100000,
+    blank_sample_contains=None,
+    discard_features_detected_in_blanks=False,
+    row_filter=None,
+    use_threads=True):
+    '''
+    Generator version of read_metabolome_csv(): yields the metabolome chunk by chunk, after column pruning and row filtering.
+    The first chunk is always empty (no features) and carries the column names. 
+    See read_metabolome_csv() for the parameters.
+    '''
+    header = pd.read_csv(metabolome_csv, nrows=0).columns.tolist()
+    if metabolome_feature_id_col not in header:
+        raise ValueError("The specified column with feature identifiers '{0}' is not present in your '{1}' file.".format(metabolome_feature_id_col, os.path.basename(metabolome_csv)))
+    sample_cols = [col for col in header if col != metabolome_feature_id_col]
+
+    if blank_sample_contains is None:
+        blank_cols = []
+    else:
+        blank_cols = [col for col in sample_cols if blank_sample_contains in col]
+    if discard_features_detected_in_blanks:
+        if blank_sample_contains is None:
+            raise ValueError("Please specify blank_sample_contains to discard features detected in blank samples.")
+        row_filters = [not_detected_in_columns(blank_cols)]
+    else:
+        row_filters = []
+    if row_filter is not None:
+        row_filters.append(row_filter)
+
+    # Columns that are only read to evaluate row filters are dropped from each chunk
+    # Blank columns are not even parsed if no row filter needs them
+    cols_to_keep = [col for col in sample_cols if col not in blank_cols]
+    if len(row_filters) > 0:
+        cols_to_read = sample_cols
+    else:
+        cols_to_read = cols_to_keep
+
+    # an empty chunk is yielded first so that the column names are known even if the file has no rows
+    empty_chunk = pd.DataFrame(columns=cols_to_keep, dtype=dtype)
+    empty_chunk.index = pd.Index([], dtype=object, name=metabolome_feature_id_col)
+    yield empty_chunk
+    chunks = _iter_csv_chunks(
+        metabolome_csv, metabolome_feature_id_col, cols_to_read, dtype, chunksize, use_threads, stream=len(row_filters) > 0)
+    for chunk in chunks:
+        if len(row_filters) > 0:
+            rows_to_keep = np.ones(chunk.shape[0], dtype=bool)
+            for my_filter in row_filters:
+                rows_to_keep &= np.asarray(my_filter(chunk), dtype=bool)
+            chunk = chunk.loc[rows_to_keep, cols_to_keep]
+        yield chunk
+
+
+
+
+def load_metabolome(
+    metabolome_csv,
+    metabolome_feature_id_col='feature_id',
+    dtype='float32',
+    chunksize=100000,
+    blank_sample_contains=None,
+    discard_features_detected_in_blanks=False,
+    cache_dir=None,
+    cache_max_size_gb=10):
+    '''
+    Reads a metabolome .csv file with read_metabolome_csv(), optionally through an on-disk cache of parsed matrices.
+
+    With a cache directory, the first load parses the .csv file and stores the parsed matrix in binary (.npy) format.
+    Later loads of the same unchanged file with the same reader options are memory-mapped reads of the binary file.
+    See MetabolomeCache for details.
+
+    Parameters
+    ----------
+    metabolome_csv: str
+        A path to a .csv file with the metabolome data.
+    metabolome_feature_id_col, dtype, chunksize, blank_sample_contains, discard_features_detected_in_blanks:
+        See read_metabolome_csv().
+    cache_dir: str, optional
+        Directory where parsed matrices are cached. Default is None (no caching).
+    cache_max_size_gb: float, optional
+        Maximum size of the cache directory in gigabytes. 
+        Least recently used matrices are removed when the cache grows larger (default is 10).
+
+    Returns
+    -------
+    metabolome: `pandas.core.frame.DataFrame`, (n_features, n_samples)
+        The metabolome dataframe with the feature identifiers as index.
+    '''
+    reader_options = {
+        "metabolome_feature_id_col": metabolome_feature_id_col,
+        "dtype": np.dtype(dtype).name,
+        "blank_sample_contains": blank_sample_contains,
+        "discard_features_detected_in_blanks": discard_features_detected_in_blanks}
+    if cache_dir is None:
+        return read_metabolome_csv(metabolome_csv, chunksize=chunksize, **reader_options)
+
+    cache = MetabolomeCache(cache_dir, max_size_bytes=int(cache_max_size_gb * 1024**3))
+    metabolome = cache.load(metabolome_csv, reader_options)
+    if metabolome is None:
+        metabolome = read_metabolome_csv(metabolome_csv, chunksize=chunksize, **reader_options)
+        cache.store(metabolome_csv, reader_options, metabolome)
+    return metabolome
+
+
+class MetabolomeCache:
+    '''
+    A content-addressed on-disk cache of parsed metabolome matrices.
+
+    Each entry is a sub-directory of the cache directory named after a fingerprint of:
+      - the size, modification time and content hash of the source .csv file.
+      - the reader options (feature id column, dtype, blank filtering etc.). 
+    An entry contains the values as a .npy file (read back memory-mapped), the feature and sample labels 
+    and the path and version of the source file as .json files.
+
+    A changed .csv file gets a new fingerprint: its previous entries are removed when the new entry is stored.
+    When the total size of the cache exceeds max_size_bytes, the least recently used entries are removed. 
+
+    Parameters
+    ----------
+    cache_dir: str
+        Directory where parsed matrices are cached. Created if it does not exist.
+    max_size_bytes: int, optional
+        Maximum size of the cache in bytes (default is 10 GB).
+
+    Example
+    -------
+    >>> cache = MetabolomeCache("~/.cache/phenofeaturefinder")
+    >>> df = cache.load("my_metabolome_data.csv", reader_options={"dtype": "float32"})
+    >>> if df is None:
+            df = read_metabolome_csv("my_metabolome_data.csv", dtype="float32")
+            cache.store("my_metabolome_data.csv", {"dtype": "float32"}, df)
+    '''
+    values_file = "values.npy"
+    labels_file = "labels.json"
+    source_file = "source.json"
+    content_hashes_file = "content_hashes.json"
+
+    def __init__(self, cache_dir, max_size_bytes=10 * 1024**3):
+        self.cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+        self.max_size_bytes = max_size_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def fingerprint(self, metabolome_csv, reader_options):
+        '''
+        Returns the cache key of a .csv file read with the given reader options (a hexadecimal string).
+        '''
+        stats = os.stat(metabolome_csv)
+        key_content = {
+            "size": stats.st_size,
+            "mtime_ns": stats.st_mtime_ns,
+            "content_hash": self._content_hash(metabolome_csv, stats),
+            "reader_options": reader_options}
+        return hashlib.blake2b(json.dumps(key_content, sort_keys=True).encode(), digest_size=16).hexdigest()
+
+    def load(self, metabolome_csv, reader_options):
+        '''
+        Returns the cached dataframe (values memory-mapped from disk) or None if the file is not cached.
+        '''
+        entry_dir = os.path.join(self.cache_dir, self.fingerprint(metabolome_csv, reader_options))
+        try:
+            with open(os.path.join(entry_dir, self.labels_file)) as labels_fh:
+                labels = json.load(labels_fh)
+            # copy-on-write mapping: the file on disk is never modified by in-place operations
+            values = np.load(os.path.join(entry_dir, self.values_file), mmap_mode='c')
+        except (OSError, ValueError):
+            return None
+        # the modification time of an entry records its last use (for LRU eviction)
+        os.utime(entry_dir)
+        index = pd.Index(labels["index"], name=labels["index_name"])
+        return pd.DataFrame(values, index=index, columns=labels["columns"], copy=False)
+
+    def store(self, metabolome_csv, reader_options, metabolome):
+        '''
+        Stores a parsed dataframe, removes outdated entries of the same .csv file and evicts least recently used entries.
+        '''
+        key = self.fingerprint(metabolome_csv, reader_options)
+        source = os.path.abspath(metabolome_csv)
+        stats = os.stat(metabolome_csv)
+        source_version = [stats.st_size, stats.st_mtime_ns]
+
+        # write in a temporary directory then rename so that a partial entry is never read
+        tmp_dir = tempfile.mkdtemp(dir=self.cache_dir, prefix=".tmp_")
+        np.save(os.path.join(tmp_dir, self.values_file), np.ascontiguousarray(metabolome.to_numpy()))
+        with open(os.path.join(tmp_dir, self.source_file), "w") as source_fh:
+            json.dump({"source": source, "source_version": source_version}, source_fh)
+        with open(os.path.join(tmp_dir, self.labels_file), "w") as labels_fh:
+            json.dump({
+                "index_name": metabolome.index.name,
+                "index": metabolome.index.tolist(),
+                "columns": metabolome.columns.tolist()}, labels_fh)
+        entry_dir = os.path.join(self.cache_dir, key)
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        os.replace(tmp_dir, entry_dir)
+
+        # entries created from a previous version of the same file are outdated
+        for other_key, other_source in self._entry_sources().items():
+            if other_source["source"] == source and other_source["source_version"] != source_version:
+                shutil.rmtree(os.path.join(self.cache_dir, other_key), ignore_errors=True)
+        self.evict(keep=key)
+
+    def evict(self, keep=None):
+        '''
+        Removes least recently used entries until the cache size is below max_size_bytes. 
+        The entry named 'keep' is never removed.
+        '''
+        entries = []
+        for key in self._entry_sources():
+            entry_dir = os.path.join(self.cache_dir, key)
+            size = sum(os.path.getsize(os.path.join(entry_dir, name)) for name in os.listdir(entry_dir))
+            entries.append((os.path.getmtime(entry_dir), key, size))
+        total_size = sum(size for _, _, size in entries)
+        for _, key, size in sorted(entries):
+            if total_size <= self.max_size_bytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(os.path.join(self.cache_dir, key), ignore_errors=True)
+            total_size -= size
+
+    def clear(self):
+        '''
+        Removes all entries of the cache.
+        '''
+        for key in self._entry_sources():
+            shutil.rmtree(os.path.join(self.cache_dir, key), ignore_errors=True)
+        content_hashes_path = os.path.join(self.cache_dir, self.content_hashes_file)
+        if os.path.exists(content_hashes_path):
+            os.remove(content_hashes_path)
+
+    def _content_hash(self, metabolome_csv, stats):
+        '''
+        Hash of the file content. 
+        Hashes are remembered per (path, size, modification time) so that an unchanged file is hashed only once.
+        '''
+        content_hashes_path = os.path.join(self.cache_dir, self.content_hashes_file)
+        try:
+            with open(content_hashes_path) as hashes_fh:
+                content_hashes = json.load(hashes_fh)
+        except (OSError, ValueError):
+            content_hashes = {}
+        source_key = "{0}|{1}|{2}".format(os.path.abspath(metabolome_csv), stats.st_size, stats.st_mtime_ns)
+        if source_key not in content_hashes:
+            file_hash = hashlib.blake2b(digest_size=16)
+            with open(metabolome_csv, "rb") as csv_fh:
+                for block in iter(lambda: csv_fh.read(1 << 23), b""):
+                    file_hash.update(block)
+            # only the current version of each file is remembered
+            source = os.path.abspath(metabolome_csv) + "|"
+            content_hashes = {key: value for key, value in content_hashes.items() if not key.startswith(source)}
+            content_hashes[source_key] = file_hash.hexdigest()
+            with open(content_hashes_path, "w") as hashes_fh:
+                json.dump(content_hashes, hashes_fh)
+        return content_hashes[source_key]
+
+    def _entry_sources(self):
+        '''
+        Returns a dictionary with the key of each entry and its source .csv file (path and version).
+        '''
+        sources = {}
+        for key in os.listdir(self.cache_dir):
+            source_path = os.path.join(self.cache_dir, key, self.source_file)
+            if key.startswith(".") or not os.path.exists(source_path):
+                continue
+            with open(source_path) as source_fh:
+                sources[key] = json.load(source_fh)
+        return sources
+
+
+def not_detected_in_columns(columns):
+    '''
+    Creates a row filter for read_metabolome_csv() that keeps the features not detected in the selected columns.
+    A feature is detected if its summed abundance in these columns is higher than 0.
+
+    Parameters
+    ----------
+    columns: list
+        The column names e.g. the blank samples.
+
+    Returns
+    -------
+    callable
+        A function that takes a chunk and returns a boolean array with True for features not detected in the columns.
+    '''
+    columns = list(columns)
+    def row_filter(chunk):
+        return chunk[columns].sum(axis=1).to_numpy() == 0
+    return row_filter
+
+
+def _iter_csv_chunks(metabolome_csv, metabolome_feature_id_col, cols_to_read, dtype, chunksize, use_threads, stream=False):
+    '''
+    Yields dataframes of at most chunksize rows with the feature identifiers as index and cols_to_read as columns.
+    With stream=True (e.g. when the chunks are filtered), the pyarrow reader never holds the whole file.
+    '''
+    if pa_csv is not None and use_threads:
+        column_types = {col: pa.from_numpy_dtype(np.dtype(dtype)) for col in cols_to_read}
+        column_types[metabolome_feature_id_col] = pa.string()
+        convert_options = pa_csv.ConvertOptions(
+            column_types=column_types,
+            include_columns=[metabolome_feature_id_col] + cols_to_read)
+        # block_size is in bytes: estimated from the number of columns (~10 bytes per value) and capped
+        # (pyarrow block sizes are int32 and very large blocks defeat streaming)
+        block_size = int(min(max(chunksize * (len(cols_to_read) + 1) * 10, _MIN_BLOCK_BYTES), _MAX_BLOCK_BYTES))
+        read_options = pa_csv.ReadOptions(use_threads=True, block_size=block_size)
+        if not stream and os.path.getsize(metabolome_csv) <= _MAX_THREADED_READ_BYTES:
+            # the multi-threaded reader parses blocks in parallel but reads the whole file at once
+            table = pa_csv.read_csv(metabolome_csv, read_options=read_options, convert_options=convert_options)
+            batches = (table.slice(start, chunksize) for start in range(0, table.num_rows, chunksize))
+        else:
+            # the streaming reader keeps one block in memory at a time (single-threaded parsing)
+            batches = pa_csv.open_csv(metabolome_csv, read_options=read_options, convert_options=convert_options)
+        for batch in batches:
+            chunk = batch.to_pandas()
+            chunk.set_index(metabolome_feature_id_col, inplace=True)
+            yield chunk
+    else:
+        column_types = {col: dtype for col in cols_to_read}
+        column_types[metabolome_feature_id_col] = str
+        reader = pd.read_csv(
+            metabolome_csv,
+            usecols=[metabolome_feature_id_col] + cols_to_read,
+            dtype=column_types,
+            index_col=metabolome_feature_id_col,
+            chunksize=chunksize)
+        with reader:
+            for chunk in reader:
+                # usecols does not preserve the requested column order
+                yield chunk[cols_to_read]
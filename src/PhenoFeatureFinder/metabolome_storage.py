@@ -0,0 +1,472 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+
+class InMemoryMetabolomeStore:
+    '''
+    Default storage of the metabolome: a pandas dataframe kept in RAM.
+
+    Stores share a common interface used by OmicsAnalysis methods:
+      - shape, index (feature identifiers), columns (sample names) and nbytes.
+      - to_frame(), to_numpy() and iter_feature_blocks() to access the values.
+      - get_values() to access the values in the native format of the store (numpy array or scipy sparse matrix).
+      - select_features() and drop_samples() that return a new filtered store.
+        select_features() can also drop samples at the same time (used by the lazy filter plan).
+      - fill_values() that replaces some values (in place when possible) and returns the updated store.
+      - append_samples() that returns a store with new sample columns (aligned on the features of the store).
+      - copy() that returns a store with a private copy of the values (used before in-place changes of shared values).
+      - scale_samples() that divides the values of each sample by a factor (in place when possible) and returns the updated store.
+      - frame_is_shared: True once a dataframe that holds the values of the store was handed out (by to_frame() or the dataframe
+        the store was created from). The values are then copied before fill_values() or scale_samples() change them in place.
+
+    Parameters
+    ----------
+    metabolome: `pandas.core.frame.DataFrame`, (n_features, n_samples)
+        The metabolome dataframe with the feature identifiers as index.
+    frame_is_shared: `bool`, optional
+        Is the dataframe also held outside of the store, e.g. by the user (default is False)?
+    '''
+    def __init__(self, metabolome, frame_is_shared=False):
+        self.metabolome = metabolome
+        self.frame_is_shared = frame_is_shared
+
+    @property
+    def shape(self):
+        return self.metabolome.shape
+
+    @property
+    def index(self):
+        return self.metabolome.index
+
+    @property
+    def columns(self):
+        return self.metabolome.columns
+
+    @property
+    def nbytes(self):
+        return int(self.metabolome.memory_usage(index=False).sum())
+
+    def to_frame(self):
+        # the dataframe is handed out: its values must not change in place any more
+        self.frame_is_shared = True
+        return self.metabolome
+
+    def to_numpy(self, columns=None):
+        '''
+        Returns the values of all features (optionally only for the selected column labels) as a numpy array.
+        '''
+        if columns is None:
+            return self.metabolome.to_numpy()
+        return self.metabolome[list(columns)].to_numpy()
+
+    def get_values(self, columns=None):
+        return self.to_numpy(columns)
+
+    def iter_feature_blocks(self, block_size=50000, columns=None):
+        '''
+        Yields (start, stop, values) with the values of features start to stop as a numpy array.
+        '''
+        values = self.to_numpy(columns)
+        for start in range(0, values.shape[0], block_size):
+            stop = min(start + block_size, values.shape[0])
+            yield start, stop, values[start:stop]
+
+    def select_features(self, features_to_keep, columns_to_drop=None):
+        '''
+        Returns a new store with only the features selected by the boolean array features_to_keep.
+        Optionally also drops the columns_to_drop column labels (the values are then copied only once).
+        '''
+        features_to_keep = np.asarray(features_to_keep, dtype=bool)
+        if columns_to_drop is None:
+            return InMemoryMetabolomeStore(self.metabolome.loc[features_to_keep, :])
+        return InMemoryMetabolomeStore(self.metabolome.loc[features_to_keep, ~self.columns.isin(list(columns_to_drop))])
+
+    def drop_samples(self, columns):
+        '''
+        Returns a new store without the selected column labels.
+        '''
+        return InMemoryMetabolomeStore(self.metabolome.drop(list(columns), axis=1))
+
+    def copy(self, storage_dir=None):
+        return InMemoryMetabolomeStore(self.metabolome.copy())
+
+    def append_samples(self, samples, storage_dir=None):
+        '''
+        Returns a new store with the columns of the samples dataframe (same features, same order) added after the current ones.
+        '''
+        return InMemoryMetabolomeStore(pd.concat([self.metabolome, samples.astype(self.metabolome.dtypes.iloc[0], copy=False)], axis=1))
+
+    def fill_values(self, row_positions, col_positions, fill_values):
+        '''
+        Returns a store where the values at (row_positions, col_positions) are replaced by fill_values.
+        The values are modified in place when the dataframe holds them in a single numpy array (otherwise copied once):
+        copy the store first if frame_is_shared.
+        '''
+        release_shared_values(self)
+        values = self.metabolome.to_numpy()
+        if not values.flags.writeable:
+            values = values.copy()
+        values[row_positions, col_positions] = fill_values
+        return InMemoryMetabolomeStore(pd.DataFrame(values, index=self.index, columns=self.columns, copy=False))
+
+    def scale_samples(self, scaling_factors):
+        '''
+        Returns a store where the values of each sample are divided by its scaling factor.
+        The values are modified in place when the dataframe holds them in a single float numpy array (otherwise copied once):
+        copy the store first if frame_is_shared.
+        '''
+        release_shared_values(self)
+        values = self.metabolome.to_numpy()
+        if not values.flags.writeable or not np.issubdtype(values.dtype, np.floating):
+            values = values.astype(np.float64)
+        np.divide(values, scaling_factors, out=values, casting='unsafe')
+        return InMemoryMetabolomeStore(pd.DataFrame(values, index=self.index, columns=self.columns, copy=False))
+
+
+class MemmapMetabolomeStore:
+    '''
+    Storage of the metabolome values in a memory-mapped float32 array on local disk.
+
+    Feature identifiers and sample names are kept as pandas Index objects.
+    Filtering features or samples does not copy the values: a filtered store shares the memory-mapped array
+    with the original one and only keeps the positions of the selected rows and columns (index views).
+    A pandas dataframe is only built when to_frame() is called (and then kept until the next filter).
+
+    Parameters
+    ----------
+    values: `numpy.memmap`, (n_features, n_samples)
+        The memory-mapped values of all features and samples.
+    feature_ids: `pandas.core.indexes.base.Index`
+        The feature identifiers of all rows of values.
+    sample_ids: `pandas.core.indexes.base.Index`
+        The sample names of all columns of values.
+    rows: `numpy.ndarray`, optional
+        Positions of the selected rows (default is None: all rows).
+    cols: `numpy.ndarray`, optional
+        Positions of the selected columns (default is None: all columns).
+    '''
+    def __init__(self, values, feature_ids, sample_ids, rows=None, cols=None):
+        self.values = values
+        self.feature_ids = feature_ids
+        self.sample_ids = sample_ids
+        self.rows = np.arange(values.shape[0]) if rows is None else np.asarray(rows)
+        self.cols = np.arange(values.shape[1]) if cols is None else np.asarray(cols)
+        self._frame = None
+        self.frame_is_shared = False
+
+    @classmethod
+    def from_chunks(cls, chunks, storage_dir, dtype='float32'):
+        '''
+        Creates a store by appending dataframe chunks (same columns, features in index) to a new file in storage_dir.
+        Only one chunk is in memory at a time.
+        '''
+        os.makedirs(storage_dir, exist_ok=True)
+        values_fd, values_path = tempfile.mkstemp(dir=storage_dir, prefix="metabolome_values_", suffix=".dat")
+        os.close(values_fd)
+        feature_ids = []
+        sample_ids = None
+        n_rows = 0
+        with open(values_path, "wb") as values_fh:
+            for chunk in chunks:
+                if sample_ids is None:
+                    sample_ids = chunk.columns
+                    index_name = chunk.index.name
+                np.ascontiguousarray(chunk.to_numpy(dtype=dtype)).tofile(values_fh)
+                feature_ids.append(chunk.index)
+                n_rows += chunk.shape[0]
+        feature_ids = pd.Index(np.concatenate([np.asarray(ids, dtype=object) for ids in feature_ids]), name=index_name)
+        if n_rows == 0 or len(sample_ids) == 0:
+            # an empty file cannot be memory-mapped
+            values = np.zeros((n_rows, len(sample_ids)), dtype=dtype)
+        else:
+            values = np.memmap(values_path, dtype=dtype, mode='r+', shape=(n_rows, len(sample_ids)))
+        return cls(values, feature_ids, sample_ids)
+
+    @classmethod
+    def from_frame(cls, metabolome, storage_dir, dtype='float32', frame_is_shared=True):
+        '''
+        Creates a store from a dataframe.
+        Values that are already memory-mapped with the right dtype (e.g. from the MetabolomeCache) are used without copy:
+        they are then only changed in place if the dataframe is not held elsewhere (frame_is_shared=False).
+        '''
+        values = metabolome.to_numpy()
+        if _is_memory_mapped(values) and values.dtype == np.dtype(dtype) and values.flags.c_contiguous:
+            store = cls(values, metabolome.index, metabolome.columns)
+            store.frame_is_shared = frame_is_shared
+            return store
+        blocks = (metabolome.iloc[start:start + 50000] for start in range(0, max(metabolome.shape[0], 1), 50000))
+        return cls.from_chunks(blocks, storage_dir, dtype=dtype)
+
+    @property
+    def shape(self):
+        return (len(self.rows), len(self.cols))
+
+    @property
+    def index(self):
+        return self.feature_ids[self.rows]
+
+    @property
+    def columns(self):
+        return self.sample_ids[self.cols]
+
+    @property
+    def nbytes(self):
+        # values are on disk: only the labels and the row/column positions are in memory
+        return int(self.rows.nbytes + self.cols.nbytes)
+
+    def to_frame(self):
+        if self._frame is None:
+            if len(self.rows) == self.values.shape[0] and len(self.cols) == self.values.shape[1]:
+                # no filter applied yet: zero-copy dataframe on top of the memory-mapped array
+                frame_values = self.values
+                self.frame_is_shared = True
+            else:
+                frame_values = self.to_numpy()
+            self._frame = pd.DataFrame(frame_values, index=self.index, columns=self.columns, copy=False)
+        return self._frame
+
+    def to_numpy(self, columns=None):
+        '''
+        Returns the values of the selected features (optionally only for the selected column labels) as a numpy array.
+        '''
+        values = np.empty((len(self.rows), len(self._column_positions(columns))), dtype=self.values.dtype)
+        for start, stop, block in self.iter_feature_blocks(columns=columns):
+            values[start:stop] = block
+        return values
+
+    def get_values(self, columns=None):
+        return self.to_numpy(columns)
+
+    def iter_feature_blocks(self, block_size=50000, columns=None):
+        '''
+        Yields (start, stop, values) with the values of the selected features start to stop as a numpy array.
+        Only one block is read from disk at a time.
+        '''
+        cols = self._column_positions(columns)
+        for start in range(0, len(self.rows), block_size):
+            stop = min(start + block_size, len(self.rows))
+            yield start, stop, self.values[np.ix_(self.rows[start:stop], cols)]
+
+    def select_features(self, features_to_keep, columns_to_drop=None):
+        '''
+        Returns a new store (index view, values are not copied) with only the features selected by the boolean array features_to_keep.
+        Optionally also drops the columns_to_drop column labels.
+        '''
+        cols = self.cols
+        if columns_to_drop is not None:
+            cols = cols[~self.columns.isin(list(columns_to_drop))]
+        return MemmapMetabolomeStore(self.values, self.feature_ids, self.sample_ids, rows=self.rows[np.asarray(features_to_keep, dtype=bool)], cols=cols)
+
+    def drop_samples(self, columns):
+        '''
+        Returns a new store (index view, values are not copied) without the selected column labels.
+        '''
+        cols_to_keep = ~self.columns.isin(list(columns))
+        return MemmapMetabolomeStore(self.values, self.feature_ids, self.sample_ids, rows=self.rows, cols=self.cols[cols_to_keep])
+
+    def copy(self, storage_dir):
+        '''
+        Returns a store with the selected features and samples copied to a new file in storage_dir, block by block.
+        '''
+        if self.shape[0] == 0:
+            blocks = [pd.DataFrame(np.zeros(self.shape, dtype=self.values.dtype), index=self.index, columns=self.columns)]
+        else:
+            blocks = (pd.DataFrame(values, index=self.index[start:stop], columns=self.columns) for start, stop, values in self.iter_feature_blocks())
+        return MemmapMetabolomeStore.from_chunks(blocks, storage_dir, dtype=self.values.dtype)
+
+    def append_samples(self, samples, storage_dir):
+        '''
+        Returns a store with the columns of the samples dataframe (same features, same order) added after the current ones.
+        A new file is written in storage_dir block by block (the full matrix is never in RAM).
+        '''
+        columns = self.columns.append(samples.columns)
+        if self.shape[0] == 0:
+            blocks = [pd.DataFrame(np.zeros((0, len(columns)), dtype=self.values.dtype), index=self.index, columns=columns)]
+        else:
+            blocks = (
+                pd.DataFrame(np.hstack([values, samples.iloc[start:stop].to_numpy(dtype=self.values.dtype)]), index=self.index[start:stop], columns=columns)
+                for start, stop, values in self.iter_feature_blocks())
+        return MemmapMetabolomeStore.from_chunks(blocks, storage_dir, dtype=self.values.dtype)
+
+    def fill_values(self, row_positions, col_positions, fill_values):
+        '''
+        Returns a store where the values at (row_positions, col_positions) of the selected features and samples are replaced by fill_values.
+        The values are written in place in the memory-mapped file: copy the store first if frame_is_shared.
+        '''
+        release_shared_values(self)
+        self.values[self.rows[row_positions], self.cols[col_positions]] = fill_values
+        return MemmapMetabolomeStore(self.values, self.feature_ids, self.sample_ids, rows=self.rows, cols=self.cols)
+
+    def scale_samples(self, scaling_factors, block_size=50000):
+        '''
+        Returns a store where the values of each selected sample are divided by its scaling factor.
+        The values are written in place in the memory-mapped file, one block of features at a time: copy the store first if frame_is_shared.
+        '''
+        release_shared_values(self)
+        scaling_factors = np.asarray(scaling_factors)
+        for start in range(0, len(self.rows), block_size):
+            block_positions = np.ix_(self.rows[start:start + block_size], self.cols)
+            self.values[block_positions] = self.values[block_positions] / scaling_factors
+        return MemmapMetabolomeStore(self.values, self.feature_ids, self.sample_ids, rows=self.rows, cols=self.cols)
+
+    def _column_positions(self, columns):
+        if columns is None:
+            return self.cols
+        return self.cols[self.columns.get_indexer(list(columns))]
+
+
+class SparseMetabolomeStore:
+    '''
+    Storage of the metabolome values as a scipy sparse matrix in compressed sparse row (CSR) format.
+
+    Only non-zero values are stored: for a matrix with 70-90% zeros this uses a fraction of the dense memory.
+    Values are exposed as sparse matrices by get_values() and iter_feature_blocks() so that filters, 
+    normalisation and PCA can work without densifying the matrix.
+    to_frame() and to_numpy() return dense values (the dataframe is kept until the next filter).
+
+    Parameters
+    ----------
+    values: `scipy.sparse.csr_matrix`, (n_features, n_samples)
+        The metabolite values. 
+    index: `pandas.core.indexes.base.Index`
+        The feature identifiers.
+    columns: `pandas.core.indexes.base.Index`
+        The sample names.
+    '''
+    def __init__(self, values, index, columns):
+        self.values = sparse.csr_matrix(values)
+        # explicit zeros are not needed (NaN values are kept as stored values)
+        self.values.eliminate_zeros()
+        self.index = index
+        self.columns = columns
+        self._frame = None
+        # to_frame() returns a dense copy of the values
+        self.frame_is_shared = False
+
+    @classmethod
+    def from_store(cls, store, block_size=50000):
+        '''
+        Creates a sparse store from another store, block by block of features (the full dense matrix is never copied). 
+        '''
+        blocks = [sparse.csr_matrix(values) for _, _, values in store.iter_feature_blocks(block_size=block_size)]
+        if len(blocks) == 0:
+            values = sparse.csr_matrix(store.shape, dtype=np.float32)
+        else:
+            values = sparse.vstack(blocks, format='csr')
+        return cls(values, store.index, store.columns)
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    @property
+    def nbytes(self):
+        return int(self.values.data.nbytes + self.values.indices.nbytes + self.values.indptr.nbytes)
+
+    def to_frame(self):
+        if self._frame is None:
+            self._frame = pd.DataFrame(self.values.toarray(), index=self.index, columns=self.columns, copy=False)
+        return self._frame
+
+    def to_numpy(self, columns=None):
+        return self.get_values(columns).toarray()
+
+    def get_values(self, columns=None):
+        '''
+        Returns the values (optionally only for the selected column labels) as a scipy sparse CSR matrix. 
+        '''
+        if columns is None:
+            return self.values
+        return self.values[:, self.columns.get_indexer(list(columns))]
+
+    def iter_feature_blocks(self, block_size=50000, columns=None):
+        '''
+        Yields (start, stop, values) with the values of features start to stop as a scipy sparse CSR matrix.
+        '''
+        values = self.get_values(columns)
+        for start in range(0, values.shape[0], block_size):
+            stop = min(start + block_size, values.shape[0])
+            yield start, stop, values[start:stop]
+
+    def select_features(self, features_to_keep, columns_to_drop=None):
+        features_to_keep = np.asarray(features_to_keep, dtype=bool)
+        if columns_to_drop is None:
+            return SparseMetabolomeStore(self.values[features_to_keep], self.index[features_to_keep], self.columns)
+        cols_to_keep = ~self.columns.isin(list(columns_to_drop))
+        return SparseMetabolomeStore(self.values[features_to_keep][:, np.flatnonzero(cols_to_keep)], self.index[features_to_keep], self.columns[cols_to_keep])
+
+    def drop_samples(self, columns):
+        cols_to_keep = ~self.columns.isin(list(columns))
+        return SparseMetabolomeStore(self.values[:, np.flatnonzero(cols_to_keep)], self.index, self.columns[cols_to_keep])
+
+    def copy(self, storage_dir=None):
+        return SparseMetabolomeStore(self.values.copy(), self.index, self.columns)
+
+    def append_samples(self, samples, storage_dir=None):
+        '''
+        Returns a new store with the columns of the samples dataframe (same features, same order) added after the current ones.
+        Only the new columns are converted to sparse format.
+        '''
+        new_values = sparse.csr_matrix(samples.to_numpy(dtype=self.values.dtype))
+        return SparseMetabolomeStore(sparse.hstack([self.values, new_values], format='csr'), self.index, self.columns.append(samples.columns))
+
+    def fill_values(self, row_positions, col_positions, fill_values):
+        '''
+        Returns a store where the values at (row_positions, col_positions) are replaced by fill_values.
+        Stored values (e.g. NaN) are replaced in place in the data array. Other cells (zeros that are not stored) are inserted.
+        '''
+        release_shared_values(self)
+        values = self.values
+        values.sort_indices()
+        row_positions = np.asarray(row_positions)
+        col_positions = np.asarray(col_positions)
+        # position of each cell in the data array (stored values are sorted by row then column)
+        stored_rows = np.repeat(np.arange(values.shape[0], dtype=np.int64), np.diff(values.indptr))
+        stored_keys = stored_rows * values.shape[1] + values.indices
+        cell_keys = row_positions.astype(np.int64) * values.shape[1] + col_positions
+        data_positions = np.minimum(np.searchsorted(stored_keys, cell_keys), max(stored_keys.size - 1, 0))
+        is_stored = stored_keys[data_positions] == cell_keys if stored_keys.size > 0 else np.zeros(cell_keys.size, dtype=bool)
+        values.data[data_positions[is_stored]] = np.asarray(fill_values)[is_stored]
+        if not np.all(is_stored):
+            values = values + sparse.csr_matrix(
+                (np.asarray(fill_values)[~is_stored], (row_positions[~is_stored], col_positions[~is_stored])), shape=values.shape)
+        return SparseMetabolomeStore(values, self.index, self.columns)
+
+    def scale_samples(self, scaling_factors):
+        '''
+        Returns a store where the values of each sample are divided by its scaling factor.
+        Only the stored values are divided, in place in the data array (zeros stay zeros).
+        '''
+        release_shared_values(self)
+        values = self.values
+        values.data /= np.asarray(scaling_factors, dtype=np.float64)[values.indices]
+        return SparseMetabolomeStore(values, self.index, self.columns)
+
+
+def _is_memory_mapped(values):
+    '''
+    Is the numpy array a memory-mapped array or a view on the whole of one (pandas does not keep the numpy.memmap subclass)?
+    '''
+    base = values
+    while isinstance(base, np.ndarray):
+        if isinstance(base, np.memmap):
+            return base.nbytes == values.nbytes and np.shares_memory(base, values)
+        # the chain ends at the buffer owner (e.g. a mmap.mmap object or a PyCapsule), which has no base
+        base = getattr(base, "base", None)
+    return False
+
+
+def release_shared_values(store):
+    '''
+    Releases the copy of the values of a store shared with worker processes (see parallel.get_shared_values()).
+    Called before the values of a store are modified in place, so that workers never read outdated values.
+    '''
+    shared_values = getattr(store, "_shared_values", None)
+    if shared_values is not None:
+        shared_values.close()
+        store._shared_values = None
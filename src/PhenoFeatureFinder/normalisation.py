@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+
+import tempfile
+import warnings
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from phenofeaturefinder.parallel import map_feature_blocks
+
+
+class MedianOfRatiosNormaliser:
+    '''
+    Median of ratios normalisation (DESeq2) with separate fit and transform steps.
+
+    fit() computes the scaling factor (size factor) of each sample in one streaming pass over chunks of features:
+    only the features without zero values are kept (as log ratios to their average log value), the other chunks are discarded.
+    The average log value of each of these features is stored as the reference (log geometric means of the cohort).
+
+    transform() divides the values of each sample by its scaling factor, in place when possible.
+    Samples that were not part of the fit (a new batch) are normalised against the stored reference:
+    their scaling factor is the median, over the reference features detected in the sample, of the log ratios to the reference.
+    The original cohort does not need to be processed again.
+
+    Parameters
+    ----------
+    chunksize: int, optional
+        Number of features processed at once (default is 50000).
+    n_jobs: int, optional
+        Number of worker processes used to fit metabolome stores (default is 1). See parallel.map_feature_blocks().
+
+    Attributes
+    ----------
+    scaling_factors_: `pandas.core.series.Series`, (n_samples,)
+        The scaling factor of each sample of the fit. Normalised values are the values divided by the scaling factors.
+    reference_: `pandas.core.series.Series`, (n_reference_features,)
+        The average log value of each feature without zero values in the fit (indexed by feature identifiers).
+
+    Example
+    -------
+    >>> normaliser = MedianOfRatiosNormaliser()
+    >>> normaliser.fit(metabolome_df)
+    >>> normalised_df = normaliser.transform(metabolome_df)
+    >>> new_batch_normalised_df = normaliser.transform(new_batch_df)
+
+    See also
+    --------
+    utils.median_of_ratios_normalisation()
+    '''
+    def __init__(self, chunksize=50000, n_jobs=1):
+        self.chunksize = chunksize
+        self.n_jobs = n_jobs
+        self.scaling_factors_ = None
+        self.reference_ = None
+
+    def fit(self, X):
+        '''
+        Computes the scaling factor of each sample and the reference in one pass over chunks of features.
+
+        Parameters
+        ----------
+        X: pandas DataFrame, numpy array, scipy sparse matrix, metabolome store or iterable of DataFrame chunks, (n_features, n_samples)
+            The feature abundances (features in rows). Chunks can come from metabolome_io.iter_metabolome_csv().
+        '''
+        feature_ids = []
+        row_averages = []
+        log_ratios = []
+        sample_ids = _get_sample_ids(X)
+        if hasattr(X, "iter_feature_blocks") and self.n_jobs != 1:
+            start = 0
+            for features_without_zeros, row_avg, block_log_ratios in map_feature_blocks(
+                    X, compute_log_ratios_of_features_without_zeros, n_jobs=self.n_jobs, block_size=self.chunksize):
+                feature_ids.append(X.index[start:start + features_without_zeros.size][features_without_zeros])
+                row_averages.append(row_avg)
+                log_ratios.append(block_log_ratios)
+                start += features_without_zeros.size
+        else:
+            for chunk_feature_ids, values, chunk_sample_ids in _iter_feature_chunks(X, self.chunksize):
+                if sample_ids is None:
+                    sample_ids = chunk_sample_ids
+                features_without_zeros, row_avg, block_log_ratios = compute_log_ratios_of_features_without_zeros(values)
+                feature_ids.append(pd.Index(chunk_feature_ids)[features_without_zeros])
+                row_averages.append(row_avg)
+                log_ratios.append(block_log_ratios)
+        n_samples = len(sample_ids) if sample_ids is not None else 0
+
+        log_ratios = np.concatenate(log_ratios) if len(log_ratios) > 0 else np.zeros((0, n_samples))
+        with warnings.catch_warnings():
+            # samples with only missing values give NaN
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            medians = np.nanmedian(log_ratios, axis=0)
+        self.scaling_factors_ = pd.Series(np.e ** medians, index=sample_ids)
+        reference_index = feature_ids[0].append(feature_ids[1:]) if len(feature_ids) > 0 else pd.Index([])
+        self.reference_ = pd.Series(np.concatenate(row_averages) if len(row_averages) > 0 else np.zeros(0), index=reference_index)
+        return self
+
+    def compute_scaling_factors(self, X):
+        '''
+        Computes the scaling factors of (new) samples against the stored reference, in one pass over chunks of features.
+        Only the reference features detected (> 0) in a sample are used for its scaling factor.
+        Feature identifiers of X (index) are matched to the ones of the reference.
+
+        Returns
+        -------
+        `pandas.core.series.Series`, (n_samples,)
+        '''
+        self._check_fitted()
+        log_ratios = []
+        sample_ids = None
+        for chunk_feature_ids, values, chunk_sample_ids in _iter_feature_chunks(X, self.chunksize):
+            if sample_ids is None:
+                sample_ids = chunk_sample_ids
+            reference = self.reference_.reindex(pd.Index(chunk_feature_ids)).to_numpy()
+            in_reference = ~np.isnan(reference)
+            values = values[np.flatnonzero(in_reference)]
+            values = values.toarray() if sparse.issparse(values) else np.asarray(values)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                log_values = np.log(values.astype(np.float64))
+            log_values[~(values > 0)] = np.nan
+            log_ratios.append(log_values - reference[in_reference][:, np.newaxis])
+        if sample_ids is None:
+            sample_ids = _get_sample_ids(X)
+        log_ratios = np.concatenate(log_ratios) if len(log_ratios) > 0 else np.zeros((0, len(sample_ids)))
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            medians = np.nanmedian(log_ratios, axis=0)
+        return pd.Series(np.e ** medians, index=sample_ids)
+
+    def get_scaling_factors(self, X):
+        '''
+        Scaling factors of the samples of X: the fitted ones for samples of the fit, computed against the reference for new samples.
+        '''
+        self._check_fitted()
+        if not hasattr(X, "columns"):
+            # numpy arrays and sparse matrices have no sample names: same samples as the fit
+            if X.shape[1] != len(self.scaling_factors_):
+                raise ValueError("Arrays without sample names should have the {0} samples of the fit. "
+                                 "Use a dataframe with sample names and feature identifiers to normalise new samples.".format(len(self.scaling_factors_)))
+            return self.scaling_factors_
+        sample_ids = _get_sample_ids(X)
+        scaling_factors = self.scaling_factors_.reindex(sample_ids)
+        new_samples = scaling_factors.isna() & ~pd.Index(sample_ids).isin(self.scaling_factors_.index)
+        if new_samples.any():
+            scaling_factors[new_samples.to_numpy()] = self.compute_scaling_factors(_select_samples(X, sample_ids[new_samples.to_numpy()])).to_numpy()
+        return scaling_factors
+
+    def transform(self, X, inplace=True, storage_dir=None):
+        '''
+        Divides the values of each sample by its scaling factor (see get_scaling_factors()).
+
+        Parameters
+        ----------
+        X: pandas DataFrame, numpy array, scipy sparse matrix or metabolome store, (n_features, n_samples)
+            The values to normalise.
+        inplace: `bool`, optional
+            Modify the values of X in place when possible (default is True): float numpy arrays, pandas DataFrames
+            holding a single float numpy array, the data array of scipy sparse matrices and metabolome stores.
+            A metabolome store whose values were handed out as a dataframe (frame_is_shared) is copied first.
+        storage_dir: str, optional
+            Directory of the copy of a memory-mapped store (default is None: the system temporary directory).
+
+        Returns
+        -------
+        The normalised values, same type as X (X itself when modified in place).
+        '''
+        scaling_factors = self.get_scaling_factors(X).to_numpy()
+        if hasattr(X, "scale_samples"):
+            if not inplace or X.frame_is_shared:
+                X = X.copy(storage_dir=tempfile.gettempdir() if storage_dir is None else storage_dir)
+            return X.scale_samples(scaling_factors)
+        if isinstance(X, pd.DataFrame):
+            values = X.to_numpy()
+            if inplace and values.flags.writeable and np.issubdtype(values.dtype, np.floating) and np.shares_memory(values, X.to_numpy()):
+                np.divide(values, scaling_factors, out=values, casting='unsafe')
+                return X
+            return X / scaling_factors
+        if sparse.issparse(X):
+            X = sparse.csr_matrix(X, copy=not inplace)
+            X.data /= scaling_factors[X.indices]
+            return X
+        X = np.asarray(X)
+        if inplace and X.flags.writeable and np.issubdtype(X.dtype, np.floating):
+            np.divide(X, scaling_factors, out=X, casting='unsafe')
+            return X
+        return X / scaling_factors
+
+    def fit_transform(self, X, inplace=True):
+        return self.fit(X).transform(X, inplace=inplace)
+
+    def _check_fitted(self):
+        if self.reference_ is None:
+            raise ValueError("The normaliser is not fitted yet: call fit() first.")
+
+
+def compute_log_ratios_of_features_without_zeros(values):
+    '''
+    Steps 1 to 4 of the median of ratios method for a chunk of features: log ratios of the features without zeros
+    to their average log value (missing values ignored).
+
+    Returns
+    -------
+    features_without_zeros: `numpy.ndarray`, (n_features,)
+        Boolean mask of the features without zero values.
+    row_avg: `numpy.ndarray`, (n_features_without_zeros,)
+        Average log value of each feature without zeros.
+    log_ratios: `numpy.ndarray`, (n_features_without_zeros, n_samples)
+        Log values minus the average log value of the feature.
+    '''
+    if sparse.issparse(values):
+        values = sparse.csr_matrix(values, copy=True)
+        values.eliminate_zeros()
+        features_without_zeros = values.getnnz(axis=1) == values.shape[1]
+        values_no_zeros = values[np.flatnonzero(features_without_zeros)].toarray()
+    else:
+        values = np.asarray(values)
+        features_without_zeros = ~np.any(values == 0, axis=1)
+        values_no_zeros = values[features_without_zeros]
+    with warnings.catch_warnings():
+        # features with only missing values give NaN
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        log_values = np.log(values_no_zeros.astype(np.float64))
+        row_avg = np.nanmean(log_values, axis=1)
+    return features_without_zeros, row_avg, log_values - row_avg[:, np.newaxis]
+
+def _get_sample_ids(X):
+    if hasattr(X, "columns"):
+        return pd.Index(X.columns)
+    if hasattr(X, "shape"):
+        return pd.RangeIndex(X.shape[1])
+    return None
+
+def _iter_feature_chunks(X, chunksize):
+    '''
+    Yields (feature_ids, values, sample_ids) for chunks of features of X.
+    '''
+    if hasattr(X, "iter_feature_blocks"):
+        for start, stop, values in X.iter_feature_blocks(block_size=chunksize):
+            yield X.index[start:stop], values, X.columns
+    elif isinstance(X, pd.DataFrame):
+        for start in range(0, X.shape[0], chunksize):
+            chunk = X.iloc[start:start + chunksize]
+            yield chunk.index, chunk.to_numpy(), X.columns
+    elif sparse.issparse(X) or isinstance(X, np.ndarray):
+        X = sparse.csr_matrix(X) if sparse.issparse(X) else X
+        for start in range(0, X.shape[0], chunksize):
+            yield np.arange(start, min(start + chunksize, X.shape[0])), X[start:start + chunksize], pd.RangeIndex(X.shape[1])
+    else:
+        # iterable of DataFrame chunks
+        for chunk in X:
+            yield chunk.index, chunk.to_numpy(), chunk.columns
+
+def _select_samples(X, sample_ids):
+    if hasattr(X, "drop_samples"):
+        return X.drop_samples(X.columns[~X.columns.isin(sample_ids)])
+    if isinstance(X, pd.DataFrame):
+        return X[sample_ids]
+    return X[:, np.asarray(sample_ids)]
@@ -1,23 +1,46 @@
 #!/usr/bin/env python3 
 
 import os
+import shutil
+import weakref
+import tempfile
 import numpy as np
 import pandas as pd
+from scipy import sparse
 
 from numpy import count_nonzero
 
 
 from sklearn.decomposition import PCA
 from sklearn.preprocessing import StandardScaler
-from sklearn.impute import SimpleImputer
 
 import seaborn as sns
 import matplotlib.pyplot as plt
 
-from phenofeaturefinder.utils import calculate_percentile, extract_samples_to_condition
-
-import upsetplot
-from upsetplot import plot, from_indicators
+from phenofeaturefinder.metabolome_io import load_metabolome, iter_metabolome_csv
+from phenofeaturefinder.metabolome_storage import InMemoryMetabolomeStore, MemmapMetabolomeStore, SparseMetabolomeStore
+from phenofeaturefinder.filter_plan import FilterPlan, sweep_filter_parameters
+from phenofeaturefinder.parallel import map_feature_blocks, map_sample_blocks
+from phenofeaturefinder.imputation import IMPUTATION_STRATEGIES, is_nan_value, impute_block_with_sample_values, impute_block_with_group_medians
+from phenofeaturefinder.imputation import impute_block_with_min_fraction, impute_block_with_knn, compute_block_sample_distances, compute_nan_euclidean_distances
+from phenofeaturefinder.sample_sheet import SampleSheet
+from phenofeaturefinder.normalisation import MedianOfRatiosNormaliser
+from phenofeaturefinder.quantile_sketch import merge_sketches
+from phenofeaturefinder.version_history import VersionHistory
+from phenofeaturefinder.statistics_cube import StatisticsCube, STATISTICS
+from phenofeaturefinder.feature_index import FeatureIndex, FEATURE_ID_PATTERN
+from phenofeaturefinder.batch_merge import merge_metabolome_tables
+from phenofeaturefinder.feature_grouping import find_candidate_pairs, standardize_features, correlate_feature_pairs, group_features
+from phenofeaturefinder.feature_grouping import project_feature_block, prune_correlated_features
+from phenofeaturefinder.annotation import CompoundLibraryIndex, load_compound_library
+from phenofeaturefinder.differential_abundance import STATISTICAL_TESTS, compute_block_statistical_tests, benjamini_hochberg
+from phenofeaturefinder.utils import calculate_percentile, count_detections_per_group
+from phenofeaturefinder.utils import sum_per_feature, max_and_sketch_per_group, has_negative_values, median_per_sample
+from phenofeaturefinder.utils import compute_group_log_histograms, smooth_log_histogram
+from phenofeaturefinder.utils import count_presence_intersections
+from phenofeaturefinder.utils import compute_pca_with_gram_matrix, compute_pca_from_feature_blocks, compute_pca_with_randomized_svd
+
+from upsetplot import plot
 
 
 
@@ -32,19 +55,93 @@ class OmicsAnalysis:
 
     Parameters
     ----------
-    metabolome_csv: str
+    metabolome_csv: str or list
         A path to a .csv file with the metabolome data (scaled or unscaled).
         Shape of the dataframe is usually (n_samples, n_features) with n_features >> n_samples
+        A list of paths (one .csv file per acquisition batch) are aligned into one metabolome: features are matched
+        on the m/z and retention time of their identifiers within merge_ppm and merge_rt_tolerance
+        (see batch_merge.merge_metabolome_tables()). The batch_provenance attribute then maps the features of the batches
+        to the merged features.
         
     metabolome_feature_id_col: str, optional
         The name of the column that contains the feature identifiers (default is 'feature_id').
         Feature identifiers should be unique (=not duplicated).
 
+    dtype: str, optional
+        The dtype used to parse the metabolite values (default is 'float32').
+        float32 halves the memory used compared to float64.
+
+    chunksize: int, optional
+        Number of features parsed at once when reading the .csv file (default is 100000).
+
+    blank_sample_contains: str, optional
+        If specified, column names with this name are considered blank samples and the blank filtering is done while reading:
+        features detected in blank samples and the blank sample columns never reach memory.
+        The blank_features_filtered attribute is then set to True. 
+        Default is None (blank samples are kept, see discard_features_detected_in_blanks()).
+
+    cache_dir: str, optional
+        Opt-in directory where the parsed matrix is cached in binary format (default is None: no caching).
+        Later loads of the same unchanged .csv file are near-instant memory-mapped reads. 
+        The cached matrix is invalidated when the .csv file changes.
+
+    cache_max_size_gb: float, optional
+        Maximum size of the cache directory in gigabytes (default is 10).
+        The least recently used matrices are removed when the cache grows larger.
+
+    storage: str, optional
+        How the metabolite values are stored (default is 'memory').
+          - 'memory': a pandas dataframe in RAM. 
+          - 'memmap': a memory-mapped float32 array on local disk. Filters only keep the positions of the 
+            selected features and samples (index views) instead of copies of the data. 
+            This allows to filter matrices larger than the available RAM.
+
+    storage_dir: str, optional
+        Local directory of the memory-mapped values with storage='memmap'.
+        Default is None (a temporary directory removed when the object is deleted).
+
+    sparse_threshold: float, optional
+        If specified, the sparsity of the metabolome is computed after import and the values are stored 
+        as a sparse matrix if the sparsity (percentage of zero values) is higher or equal to this threshold. 
+        See compute_metabolome_sparsity(). Default is None.
+
+    lazy: `bool`, optional
+        If True, discard_features_detected_in_blanks(), filter_features_per_group_by_percentile() and 
+        filter_out_unreliable_features() only record the filter in a plan (default is False).
+        The plan is executed by execute() or on the first access to the metabolome values: all filters are then
+        computed in a single pass over the matrix (plus one pass for exact percentiles) and the values are copied only once. 
+
+    sample_metadata_csv: str, optional
+        A path to a .csv file with one row per sample: the sample names (column 'sample') and their group (column 'genotype').
+        If specified, groups are taken from this file instead of being derived from the sample names.
+        See load_sample_metadata() for other column names. Default is None.
+
+    n_jobs: int, optional
+        Number of worker processes used by the feature-wise operations (validation, blank, percentile and reliability filters,
+        lazy filter plan, sparsity, imputation and normalisation statistics). Default is 1 (serial). -1 uses all cores.
+        The matrix is split in blocks of features (or samples for per-sample medians) and placed once in shared memory:
+        workers do not receive copies of the data. With in-memory or sparse storage, this is one copy per filtered metabolome
+        (each filter step copies the remaining values again). Results are identical to the serial execution.
+        The worker processes are kept for the following operations: call parallel.shutdown_workers() to stop them.
+
+    merge_ppm: float, optional
+        The m/z tolerance in parts per million used to match the features of several batches (default is 10).
+
+    merge_rt_tolerance: float, optional
+        The retention time tolerance used to match the features of several batches (default is 0.05).
+
+    history_max_size_gb: float, optional
+        If specified, each operation on the metabolome records a version in a copy-on-write history (history attribute)
+        using at most history_max_size_gb gigabytes: filters only store a mask of the features kept against the shared values.
+        Earlier versions can be checked out (checkout(), undo()), branched (branch()) and compared (diff_versions()).
+        Default is None (no history).
+
     
     Attributes
     ----------
     metabolome: `pandas.core.frame.DataFrame`, (n_samples, n_features)
       The metabolome Pandas dataframe imported from the .csv file. 
+      With storage='memmap', the dataframe is only built when the attribute is accessed.
     metabolome_validated: `bool`
       Is the metabolome dataset validated?
       Default is False.
@@ -67,6 +164,21 @@ class OmicsAnalysis:
       The dimension of the numpy array is the minimum of the number of samples and features. 
     sparsity: float
       Metabolome matrix sparsity.
+    storage: str
+      How the metabolite values are stored: 'memory', 'memmap' or 'sparse'.
+    sparse_memory_saved: int
+      Number of bytes saved by switching to sparse storage (see convert_to_sparse()).
+    sample_sheet: `phenofeaturefinder.sample_sheet.SampleSheet`
+      The group and replicate of each sample of the metabolome (see get_sample_sheet()).
+    imputed_mask: `scipy.sparse.csr_matrix`, (n_features, n_samples)
+      Boolean mask of the values imputed by impute_missing_values() (None if no value was imputed). 
+      Kept aligned with the metabolome when features or samples are filtered.
+    batch_provenance: `pandas.core.frame.DataFrame`
+      With several metabolome files, the merged feature of each feature of each batch (see batch_merge.merge_metabolome_tables()).
+    feature_groups: `pandas.core.frame.DataFrame`
+      The group of isotopes and adducts and the representative of each feature (see group_isotopes_and_adducts()).
+    filter_report: `pandas.core.frame.DataFrame`
+      Number of features removed and remaining after each filter of the last executed lazy plan (see execute()).
 
 
     Methods
@@ -75,8 +187,11 @@ class OmicsAnalysis:
       Check if the provided metabolome file is suitable. Turns attribute metabolome_validated to True. 
     discard_features_detected_in_blanks
       Removes features only detected in blank samples. 
+    impute_missing_values
+      Impute missing values with the median of the sample, the median of the group, a fraction of the minimum 
+      detected value or the mean of the nearest samples (KNN).
     impute_missing_values_with_median
-      Impute missing values with the median value of the feature.
+      Impute missing values with the median value of the sample.
     filter_out_unreliable_features()
       Filter out features not reliably detectable in replicates of the same grouping factor. 
       For instance, if a feature is detected less than 4 times within 4 biological replicates, it is discarded with argument nb_times_detected=4.  
@@ -85,6 +200,35 @@ class OmicsAnalysis:
       For instance, features lower than the 90th percentile within a single group are discarded with argument percentile=90. 
     compute_metabolome_sparsity
       Computes the sparsity percentage of the metabolome matrix (percentage of 0 values e.g. 100% for an matrix full of 0 values)
+      Optionally switches to sparse storage above a sparsity threshold. 
+    convert_to_sparse
+      Stores the metabolite values as a sparse matrix: filters, normalisation and PCA then work without densifying the values. 
+    convert_to_dense
+      Stores the metabolite values as a dense pandas dataframe in memory.
+    normalise_with_median_of_ratios
+      Normalises the metabolite values of each sample with the median of ratios method (DESeq2).
+    append_samples
+      Adds a batch of new samples: the statistics, blank filter and sparsity are updated from the new values only.
+    get_feature_index
+      Returns the m/z and retention time index of the features, parsed once from the feature identifiers.
+    find_features
+      Returns the features within a m/z (ppm) and retention time tolerance window.
+    select_features_in_region
+      Selects the features of an m/z and retention time region.
+    annotate_features
+      Annotates the features with the compounds and adducts of a local compound library (ppm window on the m/z).
+    get_sample_sheet
+      Returns the group and replicate of each sample, shared by all methods and rebuilt only when samples change.
+    load_sample_metadata
+      Takes the group of each sample from a sample metadata .csv file.
+    execute
+      With lazy=True, executes the recorded filters in a single pass over the metabolome matrix. 
+    test_differential_abundance
+      Welch t-test, Mann-Whitney U test or one-way ANOVA of all features between groups with Benjamini-Hochberg correction.
+    group_isotopes_and_adducts
+      Keeps one representative feature per group of correlated isotopes and adducts of the same compound.
+    prune_redundant_features
+      Removes the features strongly correlated with a more intense feature (blockwise correlations within a memory budget).
     write_clean_metabolome_to_csv()
       Write the filtered and analysis-ready metabolome data to a .csv file.  
        
@@ -131,6 +275,24 @@ class OmicsAnalysis:
     unreliable_features_filtered = False
     pca_performed = False
     sparsity=None
+    sparse_memory_saved=None
+    filter_report=None
+    _density_histograms_cache=None
+    _statistics_cube=None
+    _blank_sample_contains=None
+    _feature_index_cache=None
+    imputed_mask=None
+    normaliser=None
+    scaling_factors=None
+    filter_sweep=None
+    filter_sweep_overlaps=None
+    history=None
+    batch_provenance=None
+    feature_groups=None
+    feature_group_pairs=None
+    redundant_features=None
+    differential_abundance=None
+    annotations=None
 
 
     ##########################
@@ -139,17 +301,624 @@ class OmicsAnalysis:
     def __init__(
         self, 
         metabolome_csv, 
-        metabolome_feature_id_col='feature_id'):
+        metabolome_feature_id_col='feature_id',
+        dtype='float32',
+        chunksize=100000,
+        blank_sample_contains=None,
+        cache_dir=None,
+        cache_max_size_gb=10,
+        storage='memory',
+        storage_dir=None,
+        sparse_threshold=None,
+        lazy=False,
+        sample_metadata_csv=None,
+        n_jobs=1,
+        merge_ppm=10,
+        merge_rt_tolerance=0.05,
+        history_max_size_gb=None):
         """
         Constructor method. 
         Returns a Python instance of class MetabolomeAnalysis 
         """     
-        # Import metabolome dataframe and verify presence of feature id column
-        self.metabolome = pd.read_csv(metabolome_csv, low_memory=False)
-        if metabolome_feature_id_col not in self.metabolome.columns:
-            raise ValueError("The specified column with feature identifiers {0} is not present in your '{1}' file.".format(metabolome_feature_id_col,os.path.basename(metabolome_csv)))
+        if storage not in ("memory", "memmap"):
+            raise ValueError("The storage argument should be either 'memory' or 'memmap' (see also sparse_threshold).")
+        self.storage = storage
+        if storage == "memmap" and storage_dir is None:
+            storage_dir = tempfile.mkdtemp(prefix="phenofeaturefinder_")
+            weakref.finalize(self, shutil.rmtree, storage_dir, True)
+        self.storage_dir = storage_dir
+        self.lazy = lazy
+        self.n_jobs = n_jobs
+        self._filter_plan = None
+        self._sample_metadata = None
+        self._sample_sheet = None
+        if sample_metadata_csv is not None:
+            self.load_sample_metadata(sample_metadata_csv)
+
+        # Import metabolome dataframe with an explicit schema (verifies presence of feature id column)
+        # Optionally discard blank samples and features detected in them while reading
+        reader_options = dict(
+            metabolome_feature_id_col=metabolome_feature_id_col, 
+            dtype=dtype, 
+            chunksize=chunksize,
+            blank_sample_contains=blank_sample_contains,
+            discard_features_detected_in_blanks=blank_sample_contains is not None)
+        if isinstance(metabolome_csv, (list, tuple)):
+            # one file per batch: the batches are aligned first, then the blank filter is applied to the merged metabolome
+            metabolome_df, self.batch_provenance = merge_metabolome_tables(
+                metabolome_csv, ppm=merge_ppm, rt_tolerance=merge_rt_tolerance, metabolome_feature_id_col=metabolome_feature_id_col, dtype=dtype)
+            if blank_sample_contains is not None:
+                blank_cols = [col for col in metabolome_df.columns.tolist() if blank_sample_contains in col]
+                metabolome_df = metabolome_df.loc[sum_per_feature(metabolome_df[blank_cols].to_numpy()) == 0].drop(columns=blank_cols)
+            self._set_metabolome_frame(metabolome_df, frame_is_shared=False)
+        elif storage == "memmap" and cache_dir is None:
+            # chunks are appended to the memory-mapped file: the full matrix is never in RAM
+            self._store = MemmapMetabolomeStore.from_chunks(iter_metabolome_csv(metabolome_csv, **reader_options), storage_dir)
+        else:
+            self._set_metabolome_frame(
+                load_metabolome(metabolome_csv, cache_dir=cache_dir, cache_max_size_gb=cache_max_size_gb, **reader_options), frame_is_shared=False)
+        if blank_sample_contains is not None:
+            self.blank_features_filtered = True
+            self._blank_sample_contains = blank_sample_contains
+        if sparse_threshold is not None:
+            self.compute_metabolome_sparsity(sparse_threshold=sparse_threshold)
+        if history_max_size_gb is not None:
+            self.history = VersionHistory(max_size_gb=history_max_size_gb)
+            self._record_values("load")
+
+    ###################################
+    ### Access to the stored metabolome
+    ###################################
+    @property
+    def _store(self):
+        # any access to the metabolome values first executes the pending lazy filters
+        if self._filter_plan is not None:
+            self.execute()
+        return self._metabolome_store
+
+    @_store.setter
+    def _store(self, store):
+        self._metabolome_store = store
+
+    @property
+    def metabolome(self):
+        return self._store.to_frame()
+
+    @metabolome.setter
+    def metabolome(self, metabolome_df):
+        # the caller keeps the dataframe: its values are not changed in place
+        self._set_metabolome_frame(metabolome_df, frame_is_shared=True)
+
+    def _set_metabolome_frame(self, metabolome_df, frame_is_shared):
+        # the new values replace the ones the pending lazy filters were recorded for
+        self._filter_plan = None
+        # the mask of imputed values stays valid if the features and samples are the same
+        if self.imputed_mask is not None and not (
+            metabolome_df.index.equals(self._metabolome_store.index) and metabolome_df.columns.equals(self._metabolome_store.columns)):
+            self.imputed_mask = None
+        if self.storage == "memmap":
+            self._store = MemmapMetabolomeStore.from_frame(metabolome_df, self.storage_dir, frame_is_shared=frame_is_shared)
+        elif self.storage == "sparse":
+            self._store = SparseMetabolomeStore(sparse.csr_matrix(metabolome_df.to_numpy()), metabolome_df.index, metabolome_df.columns)
+        else:
+            self._store = InMemoryMetabolomeStore(metabolome_df, frame_is_shared=frame_is_shared)
+        self._record_values("set_metabolome")
+
+    def _keep_features(self, features_to_keep, columns_to_drop=None, label="select_features"):
+        '''
+        Keeps only the features selected by the boolean array features_to_keep (in the order of the current metabolome).
+        Optionally also removes the samples with the columns_to_drop column names (the values are copied only once).
+        '''
+        self._subset_imputed_mask(features_to_keep=features_to_keep, columns_to_drop=columns_to_drop)
+        store = self._store
+        self._store = store.select_features(features_to_keep, columns_to_drop=columns_to_drop)
+        # the statistics of the remaining features do not change: the cube is updated without reading the values
+        if self._statistics_cube is not None and self._statistics_cube.store is store:
+            self._statistics_cube = self._statistics_cube.select_features(features_to_keep, columns_to_drop=columns_to_drop, store=self._metabolome_store)
+        # the parsed m/z and RT of the remaining features are kept
+        if self._feature_index_cache is not None and self._feature_index_cache["store"] is store:
+            self._feature_index_cache = dict(
+                self._feature_index_cache, store=self._metabolome_store, index=self._feature_index_cache["index"].select_features(features_to_keep))
+        if self.history is not None:
+            self.history.commit_selection(features_to_keep, columns_to_drop, label, state=self._get_version_state())
+
+    def _subset_imputed_mask(self, features_to_keep=None, columns_to_drop=None):
+        '''
+        Keeps the mask of imputed values aligned with the metabolome when features or samples are removed.
+        '''
+        if self.imputed_mask is None:
+            return
+        if features_to_keep is not None:
+            self.imputed_mask = self.imputed_mask[np.flatnonzero(features_to_keep)]
+        if columns_to_drop is not None:
+            self.imputed_mask = self.imputed_mask[:, np.flatnonzero(~self._metabolome_store.columns.isin(list(columns_to_drop)))]
+
+    ##################################
+    ### Append a batch of new samples
+    ##################################
+    def append_samples(self, new_samples, metabolome_feature_id_col='feature_id', separator_replicates='_', block_size=50000):
+        '''
+        Adds a batch of new samples (columns) to the metabolome without processing the cohort again.
+
+        Steps:
+          1. The batch is aligned on the current features: features filtered out earlier stay removed
+             and features absent from the batch get a value of 0.
+          2. If the metabolome was normalised with normalise_with_median_of_ratios(), the batch is normalised
+             against the stored reference (see normalisation.MedianOfRatiosNormaliser).
+          3. If blank samples were discarded, features detected in the new blank samples are removed and
+             the new blank samples are dropped (the only filter status that can flip for the remaining features:
+             numbers of detections and maxima per group can only increase with new samples).
+          4. The statistics cube (numbers of detections, blank sums, maxima, ranges and medians per group)
+             and the sparsity are updated from the new values only (see statistics_cube.StatisticsCube.append_samples()).
+
+        Apart from copying the values into the new matrix, the work scales with the size of the batch:
+        only medians of the groups that received new samples are computed again from their columns.
+        Missing values of the batch are not imputed.
+
+        Parameters
+        ----------
+        new_samples: str or `pandas.core.frame.DataFrame`
+            A path to a .csv file with the new samples (same format as the metabolome file) or a dataframe
+            with the feature identifiers as index and one column per new sample.
+        metabolome_feature_id_col: str, optional
+            The name of the column that contains the feature identifiers in the .csv file (default is 'feature_id').
+        separator_replicates: str, optional
+            The separator between the grouping variable and the biological replicates (default is underscore '_').
+        block_size: int, optional
+            Number of features processed at once (default is 50000).
+        '''
+        store = self._store
+        dtype = store.get_values(columns=store.columns[:1]).dtype
+        if isinstance(new_samples, pd.DataFrame):
+            batch = new_samples
+        else:
+            batch = load_metabolome(new_samples, metabolome_feature_id_col=metabolome_feature_id_col, dtype=dtype)
+        duplicated_samples = batch.columns[batch.columns.isin(store.columns) | batch.columns.duplicated()]
+        if len(duplicated_samples) > 0:
+            raise ValueError("These samples are already in the metabolome: {0}".format(duplicated_samples.tolist()))
+        n_unknown_features = np.count_nonzero(~batch.index.isin(store.index))
+        if n_unknown_features > 0:
+            print("{0} features of the new samples are not in the metabolome (new or filtered out earlier) and are ignored.".format(n_unknown_features))
+        batch = batch.reindex(store.index, fill_value=0).astype(dtype, copy=False)
+
+        if self.normaliser is not None:
+            scaling_factors = self.normaliser.compute_scaling_factors(batch)
+            batch = batch / scaling_factors.to_numpy()
+            self.scaling_factors = pd.concat([self.scaling_factors, scaling_factors])
+
+        if self.sparsity is not None:
+            number_of_non_zero_values = (1 - self.sparsity / 100) * store.shape[0] * store.shape[1]
+        # re-evaluate the blank filter on the new blank samples
+        if self.blank_features_filtered and self._blank_sample_contains is not None:
+            blank_cols = [col for col in batch.columns.tolist() if self._blank_sample_contains in col]
+            if len(blank_cols) > 0:
+                features_to_keep = sum_per_feature(batch[blank_cols].to_numpy()) == 0
+                print("{0} features detected in the new blank samples were removed.".format(np.count_nonzero(~features_to_keep)))
+                batch = batch.loc[features_to_keep].drop(columns=blank_cols)
+                if not features_to_keep.all():
+                    if self.sparsity is not None:
+                        # only the rows of the removed features are read
+                        removed_values = store.select_features(~features_to_keep).get_values()
+                        number_of_non_zero_values -= removed_values.count_nonzero() if sparse.issparse(removed_values) else np.count_nonzero(removed_values)
+                    self._keep_features(features_to_keep, label="append_samples: discard_features_detected_in_blanks")
+                    store = self._metabolome_store
+
+        sample_sheet = self.get_sample_sheet(separator_replicates=separator_replicates)
+        cube = self._statistics_cube
+        cube_is_valid = cube is not None and cube.is_valid_for(store, sample_sheet)
+        self._store = store.append_samples(batch, storage_dir=self.storage_dir)
+        if self.imputed_mask is not None:
+            self.imputed_mask = sparse.hstack([self.imputed_mask, sparse.csr_matrix(batch.shape, dtype=bool)], format='csr')
+        if cube_is_valid:
+            new_sample_sheet = self.get_sample_sheet(separator_replicates=separator_replicates)
+            self._statistics_cube = cube.append_samples(
+                batch, new_sample_sheet.groups[store.shape[1]:], self._metabolome_store, block_size=block_size)
+        if self.sparsity is not None:
+            number_of_non_zero_values += np.count_nonzero(batch.to_numpy())
+            self.sparsity = (1 - number_of_non_zero_values / (self._metabolome_store.shape[0] * self._metabolome_store.shape[1])) * 100
+        self._record_values("append_samples")
+        print("{0} samples appended ({1} features, {2} samples).".format(batch.shape[1], *self._metabolome_store.shape))
+
+    ######################################
+    ### Version history of the metabolome
+    ######################################
+    def _get_version_state(self):
+        # attributes that have to stay aligned with the values of a version
+        return dict(
+            imputed_mask=self.imputed_mask, 
+            storage=self.storage,
+            blank_features_filtered=self.blank_features_filtered,
+            blank_sample_contains=self._blank_sample_contains,
+            filtered_by_percentile_value=self.filtered_by_percentile_value,
+            unreliable_features_filtered=self.unreliable_features_filtered,
+            sparsity=self.sparsity,
+            normaliser=self.normaliser,
+            scaling_factors=self.scaling_factors)
+
+    def _update_version_state(self):
+        '''
+        Stores attributes computed from the current values without changing them (e.g. the sparsity) in the state of the current version.
+        '''
+        if self.history is not None and self.history.head in self.history.versions:
+            self.history.versions[self.history.head].state.update(self._get_version_state())
+
+    def _record_values(self, label):
+        '''
+        Records the current values as a new base of the version history (after operations that change values).
+        '''
+        if self.history is not None:
+            self.history.commit_values(self._metabolome_store, label, state=self._get_version_state())
+
+    def _get_writable_store(self, store):
+        '''
+        Copy-on-write: returns a copy of store if its values are shared with a version of the history or with a dataframe
+        handed out earlier (e.g. by the metabolome attribute), otherwise store itself. Modifying the values in place then
+        changes neither earlier versions nor dataframes held by the user.
+        '''
+        if store.frame_is_shared or (self.history is not None and self.history.is_shared(store)):
+            return store.copy(storage_dir=self.storage_dir)
+        return store
+
+    def _check_history(self):
+        if self.history is None:
+            raise ValueError("The version history is not enabled: create the OmicsAnalysis object with history_max_size_gb.")
+
+    def checkout(self, version):
+        '''
+        Restores an earlier state of the metabolome from the version history (see get_history()).
+        The values are not reloaded: the state is rebuilt from the shared values and the mask of the version.
+        Operations applied after checking out a version by number start a new branch of the history.
+        Pending lazy filters are discarded.
+
+        Parameters
+        ----------
+        version: int or str
+            The version_id of the version or the name of a branch.
+        '''
+        self._check_history()
+        self._set_version(self.history.checkout(version))
+
+    def undo(self):
+        '''
+        Restores the state of the metabolome before the last operation (the parent of the current version).
+        The current branch then points to that version.
+        '''
+        self._check_history()
+        self._set_version(self.history.undo())
+
+    def branch(self, name, version=None):
+        '''
+        Creates a named branch of the version history pointing to version (default is None: the current version) and checks it out.
+        The following operations are recorded on this branch.
+        '''
+        self._check_history()
+        self._set_version(self.history.branch(name, version=version))
+
+    def diff_versions(self, version_a, version_b):
+        '''
+        Compares two versions of the history (version_id or branch name) without building their metabolome.
+
+        Returns
+        -------
+        dict
+            Features and samples only present in one of the versions and whether their values differ 
+            (e.g. normalised or imputed in only one of them). See version_history.VersionHistory.diff().
+        '''
+        self._check_history()
+        return self.history.diff(version_a, version_b)
+
+    def get_history(self):
+        '''
+        Returns a dataframe with the retained versions of the metabolome (label, parent, branches, shape and current version).
+        '''
+        self._check_history()
+        return self.history.to_frame()
+
+    def _set_version(self, version):
+        self._filter_plan = None
+        self._metabolome_store = version.to_store()
+        self.imputed_mask = version.state.get("imputed_mask")
+        self.storage = version.state.get("storage", self.storage)
+        self.blank_features_filtered = version.state.get("blank_features_filtered", False)
+        self._blank_sample_contains = version.state.get("blank_sample_contains")
+        self.filtered_by_percentile_value = version.state.get("filtered_by_percentile_value", False)
+        self.unreliable_features_filtered = version.state.get("unreliable_features_filtered", False)
+        self.sparsity = version.state.get("sparsity")
+        # a version recorded before the normalisation has raw values: new samples are not scaled
+        self.normaliser = version.state.get("normaliser")
+        self.scaling_factors = version.state.get("scaling_factors")
+
+    ######################################
+    ### Statistics cube (feature x group)
+    ######################################
+    def get_statistics_cube(self, separator_replicates='_', path=None, block_size=50000):
+        '''
+        Returns the per-feature and per-group statistics of the metabolome (see statistics_cube.StatisticsCube):
+        numbers of detections, non-zero and missing values, sum, maximum, range of positive values and median.
+
+        Each statistic is computed the first time it is asked for, in one pass over blocks of features (in parallel with n_jobs > 1)
+        that only computes this statistic, and shared by the blank, percentile and reliability filters, the density and UpSet plots
+        and the sparsity report: e.g. the reliability filter only counts detections and the medians are only computed when asked for.
+        It is kept up to date when features are filtered out or whole groups of samples are removed
+        and computed again after other changes of the values (e.g. imputation or normalisation).
+
+        Parameters
+        ----------
+        separator_replicates: str, optional
+            The separator between the grouping variable and the biological replicates (default is underscore '_').
+        path: str, optional
+            A .npz file (e.g. next to the metabolome file). If it holds the cube of the current metabolome, the cube is loaded
+            from it, otherwise all the statistics are computed and the cube is saved to it. Default is None: the cube is only kept in memory.
+        block_size: int, optional
+            Number of features read at once (default is 50000).
+
+        Returns
+        -------
+        `phenofeaturefinder.statistics_cube.StatisticsCube`
+        '''
+        store = self._store
+        sample_sheet = self.get_sample_sheet(separator_replicates=separator_replicates)
+        cube = self._statistics_cube
+        if cube is not None and cube.is_valid_for(store, sample_sheet):
+            return cube
+        cube = None
+        if path is not None and os.path.exists(path):
+            saved_cube = StatisticsCube.load(path)
+            if saved_cube.matches(store, sample_sheet):
+                saved_cube.index = store.index
+                saved_cube.sample_names = sample_sheet.sample_names
+                saved_cube.sample_groups = sample_sheet.groups
+                saved_cube.group_names = sample_sheet.group_names[sample_sheet.group_names.astype(str).get_indexer(saved_cube.group_names)]
+                saved_cube.store = store
+                saved_cube.block_size = block_size
+                saved_cube.n_jobs = self.n_jobs
+                cube = saved_cube
+        if cube is None:
+            statistics = STATISTICS if path is not None else ()
+            cube = StatisticsCube.from_store(store, sample_sheet, statistics=statistics, block_size=block_size, n_jobs=self.n_jobs)
+            if path is not None:
+                cube.save(path)
+        self._statistics_cube = cube
+        return cube
+
+    def _retarget_statistics_cube(self, previous_store):
+        # the values are the same in another storage: the cube stays valid
+        if self._statistics_cube is not None and self._statistics_cube.store is previous_store:
+            self._statistics_cube.store = self._metabolome_store
+
+    #########################################
+    ### m/z and retention time of the features
+    #########################################
+    def get_feature_index(self, pattern=FEATURE_ID_PATTERN):
+        '''
+        Returns the m/z and retention time index of the features (see feature_index.FeatureIndex).
+
+        The feature identifiers (e.g. 'rt-0.06_mz-124.96631') are parsed once: the index is kept when features are 
+        filtered out and only built again when the features change otherwise.
+
+        Parameters
+        ----------
+        pattern: str, optional
+            A regular expression with the named groups 'rt' and 'mz' used to parse the feature identifiers
+            (default is feature_index.FEATURE_ID_PATTERN, for identifiers such as 'rt-0.06_mz-124.96631').
+
+        Returns
+        -------
+        `phenofeaturefinder.feature_index.FeatureIndex`
+        '''
+        store = self._store
+        cache = self._feature_index_cache
+        if cache is not None and cache["pattern"] == pattern:
+            if cache["store"] is store:
+                return cache["index"]
+            if cache["index"].feature_ids.equals(store.index):
+                self._feature_index_cache = dict(cache, store=store)
+                return cache["index"]
+        index = FeatureIndex.from_feature_ids(store.index, pattern=pattern)
+        if index.n_unparsed > 0:
+            print("{0} feature identifiers do not hold an m/z and a retention time: they are not part of the index.".format(index.n_unparsed))
+        self._feature_index_cache = dict(store=store, pattern=pattern, index=index)
+        return index
+
+    def find_features(self, mz, ppm=10, rt=None, rt_tolerance=None):
+        '''
+        Returns the identifiers of the features within ppm of an m/z value (and within rt_tolerance of a retention time).
+
+        Parameters
+        ----------
+        mz: float
+            The m/z value searched.
+        ppm: float, optional
+            The m/z tolerance in parts per million (default is 10).
+        rt: float, optional
+            The retention time searched (default is None: any retention time).
+        rt_tolerance: float, optional
+            The retention time tolerance, same unit as the feature identifiers (default is None: any retention time).
+
+        Returns
+        -------
+        `pandas.core.indexes.base.Index`
+        '''
+        index = self.get_feature_index()
+        return index.feature_ids[index.query_tolerance(mz, ppm=ppm, rt=rt, rt_tolerance=rt_tolerance)]
+
+    def select_features_in_region(self, mz_range=None, rt_range=None, inplace=False):
+        '''
+        Selects the features of an m/z and retention time region with binary searches on the feature index 
+        (the feature identifiers are not scanned).
+
+        Parameters
+        ----------
+        mz_range: tuple, optional
+            The (min, max) m/z values, bounds included. None for no restriction (default).
+        rt_range: tuple, optional
+            The (min, max) retention times, bounds included. None for no restriction (default).
+        inplace: bool, optional
+            Keep only the selected features in the metabolome (default is False).
+
+        Returns
+        -------
+        `pandas.core.frame.DataFrame`
+            The values of the selected features (None with inplace=True).
+        '''
+        features_to_keep = self.get_feature_index().get_mask(mz_range=mz_range, rt_range=rt_range)
+        if inplace:
+            self._keep_features(features_to_keep, label="select_features_in_region")
+            return
+        return self._store.select_features(features_to_keep).to_frame()
+
+    def annotate_features(self, compound_library, ppm=5, adducts=None, cache_dir=None, name_col='name', mass_col='monoisotopic_mass'):
+        '''
+        Annotates the features with the compounds of a local library whose ions (compound and adduct) have an m/z 
+        within ppm of the m/z of the feature. 
+
+        The m/z of the ions are sorted once (see annotation.CompoundLibraryIndex) and each feature is annotated by binary search:
+        O(n log m) for n features and m ions. With cache_dir, the built library index is cached on disk for later runs.
+
+        Parameters
+        ----------
+        compound_library: str or `phenofeaturefinder.annotation.CompoundLibraryIndex`
+            A path to a .csv file with one row per compound (name and monoisotopic mass columns) or a library index.
+        ppm: float, optional
+            The m/z tolerance in parts per million (default is 5).
+        adducts: dict or str, optional
+            Adduct rules: a dictionary or a path to a .csv file with the columns 'adduct', 'mass_shift', 'charge' 
+            and optionally 'n_molecules'. Default is None: annotation.POSITIVE_ADDUCTS.
+        cache_dir: str, optional
+            Directory where the library index is cached (default is None: no caching).
+        name_col: str, optional
+            The column of the library with the compound names (default is 'name').
+        mass_col: str, optional
+            The column of the library with the monoisotopic masses in Da (default is 'monoisotopic_mass').
+
+        Returns
+        -------
+        `pandas.core.frame.DataFrame`
+            One row per candidate annotation: 'feature_id', 'compound', 'adduct', 'theoretical_mz', 'mz' and 'ppm_error'
+            (best candidates of a feature first). Also stored in the annotations attribute.
+        '''
+        if isinstance(compound_library, CompoundLibraryIndex):
+            library = compound_library
+        else:
+            library = load_compound_library(compound_library, adducts=adducts, cache_dir=cache_dir, name_col=name_col, mass_col=mass_col)
+        index = self.get_feature_index()
+        annotations = library.annotate(index.mz, ppm=ppm)
+        annotations.insert(0, "feature_id", index.feature_ids[annotations.pop("position").to_numpy()])
+        print("{0} of {1} features annotated ({2} candidate annotations).".format(annotations["feature_id"].nunique(), len(index), len(annotations)))
+        self.annotations = annotations
+        return annotations
+
+    ##################################
+    ### Sample sheet (groups of samples)
+    ##################################
+    def load_sample_metadata(self, sample_metadata_csv, sample_col='sample', group_col='genotype', replicate_col=None):
+        '''
+        Takes the group of each sample from a sample metadata .csv file (one row per sample) 
+        instead of deriving it from the sample names.
+
+        Parameters
+        ----------
+        sample_metadata_csv: str
+            A path to a .csv file with the sample metadata.
+        sample_col: str, optional
+            The column with the sample names as in the metabolome file (default is 'sample').
+        group_col: str, optional
+            The column with the group of each sample (default is 'genotype').
+        replicate_col: str, optional
+            The column with the biological replicate of each sample (default is None).
+        '''
+        self._sample_metadata = SampleSheet.from_csv(sample_metadata_csv, sample_col=sample_col, group_col=group_col, replicate_col=replicate_col)
+        self._sample_sheet = None
+
+    def get_sample_sheet(self, separator_replicates='_'):
+        '''
+        Returns the sample sheet (group and replicate of each sample) of the current metabolome samples.
+
+        The sample sheet is built once (in O(n_samples), from the column names or from the sample metadata file)
+        and shared by all methods. It is rebuilt when the samples change (e.g. blank samples removed) 
+        or when another separator is used.
+        With lazy=True, the samples are the ones that remain after the pending filters (the filters are not executed).
+
+        Parameters
+        ----------
+        separator_replicates: str, optional
+            The separator between the grouping variable and the biological replicates in sample names (default is underscore '_').
+            Not used when the groups come from a sample metadata file. 
+
+        Returns
+        -------
+        `phenofeaturefinder.sample_sheet.SampleSheet`
+        '''
+        if self._filter_plan is not None:
+            sample_names = self._filter_plan.columns
         else:
-            self.metabolome.set_index(metabolome_feature_id_col, inplace=True)
+            sample_names = self._metabolome_store.columns
+        if self._sample_metadata is not None:
+            separator_replicates = None
+        if self._sample_sheet is None or not self._sample_sheet.is_valid_for(sample_names, separator_replicates=separator_replicates):
+            if self._sample_metadata is not None:
+                self._sample_sheet = self._sample_metadata.select_samples(sample_names)
+            else:
+                self._sample_sheet = SampleSheet.from_sample_names(sample_names, separator_replicates=separator_replicates)
+        return self._sample_sheet
+
+    @property
+    def sample_sheet(self):
+        return self.get_sample_sheet()
+
+    def _get_filter_plan(self):
+        '''
+        Returns the pending lazy filter plan (a new one is created if needed). 
+        '''
+        if self._filter_plan is None:
+            self._filter_plan = FilterPlan(self._metabolome_store.columns)
+        return self._filter_plan
+
+    ###############################
+    ### Execute the lazy filter plan
+    ###############################
+    def execute(self, block_size=50000):
+        '''
+        Executes the filters recorded with lazy=True (blank, percentile and reliability filters).
+
+        The per-feature statistics of all filters are computed in a single pass over blocks of features
+        (exact percentiles need one more pass, see filter_plan.compute_exact_percentiles()). 
+        One combined mask of features to keep is then applied (the values are copied only once).
+        The number of features removed by each filter is printed and stored in the filter_report attribute. 
+        Nothing is done if no filter is pending. 
+
+        Parameters
+        ----------
+        block_size: int, optional
+            Number of features read at once (default is 50000).
+
+        Returns
+        -------
+        self: object
+            Object with the filtered .metabolome, the filter flags set to True and filter_report filled. 
+        '''
+        filter_plan = self._filter_plan
+        if filter_plan is None:
+            return
+        features_to_keep, columns_to_drop, report = filter_plan.execute(self._metabolome_store, block_size=block_size, n_jobs=self.n_jobs)
+        self._filter_plan = None
+        # the filter flags are part of the version recorded by _keep_features()
+        filters = set(report["filter"])
+        if "discard_features_detected_in_blanks" in filters:
+            self.blank_features_filtered = True
+        if "filter_features_per_group_by_percentile" in filters:
+            self.filtered_by_percentile_value = True
+        if "filter_out_unreliable_features" in filters:
+            self.unreliable_features_filtered = True
+        self._keep_features(features_to_keep, columns_to_drop=columns_to_drop, label="execute: " + ", ".join(report["filter"]))
+
+        for step in filter_plan.steps:
+            if step.get("validate", False) and not self.metabolome_validated:
+                print("Metabolome input data validated.")
+                self.metabolome_validated = True
+        for _, row in report.iterrows():
+            print("{0}: {1} features removed ({2} remaining)".format(row["filter"], row["features_removed"], row["features_remaining"]))
+        self.filter_report = report
     
     def validate_input_metabolome_df(self, metabolome_feature_id_col='feature_id'):
         '''
@@ -182,39 +951,166 @@ class OmicsAnalysis:
         
         '''
 
-        if np.any(self.metabolome.values < 0):
+        if any(map_feature_blocks(self._store, has_negative_values, n_jobs=self.n_jobs)):
             raise ValueError("Sorry, metabolite values have to be zero or positive integers (>=0)")
         else:
             print("Metabolome input data validated.")
             self.metabolome_validated = True
 
     ####################################################
-    ### (Optional) Impute missing values with the median
+    ### (Optional) Impute missing values
     ### This is necessary for PCA to work
     ###################################################
-    def impute_missing_values_with_median(self, missing_value_str='np.nan'):
+    def impute_missing_values(
+        self, 
+        strategy="median", 
+        missing_values=np.nan, 
+        separator_replicates="_",
+        min_value_fraction=0.2,
+        n_neighbors=5,
+        block_size=50000):
+        '''
+        Imputes missing values (NaN by default) block by block of features.
+
+        Strategies:
+          - 'median': median of the sample (column), as scikit-learn SimpleImputer(strategy='median').
+          - 'group_median': median of the feature in the samples of the same group (e.g. genotype).
+          - 'min_fraction': fraction (min_value_fraction) of the minimum detected (> 0) value of the feature.
+          - 'knn': mean value of the feature in the n_neighbors nearest samples in which it is present 
+            (nan-euclidean distances between samples, as scikit-learn KNNImputer applied to samples).
+        
+        Blocks of features are imputed in parallel with n_jobs > 1. Only the imputed cells are sent back by the workers:
+        the values are then replaced in place when the storage allows it (single numpy array in memory, memory-mapped file, 
+        missing values stored in a sparse matrix). The imputed cells are recorded in the imputed_mask attribute.
+        Missing values without any value to impute from (e.g. a group with only missing values) are left missing. 
+
+        Parameters
+        ----------
+        strategy: str, optional
+            'median' (default), 'group_median', 'min_fraction' or 'knn'.
+        missing_values: float, optional
+            The value that represents missing values (default is np.nan).
+        separator_replicates: str, optional
+            The separator between the grouping variable and the biological replicates (default is underscore "_").
+            Used by the 'group_median' strategy. 
+        min_value_fraction: float, optional
+            The fraction of the minimum detected value used by the 'min_fraction' strategy (default is 0.2).
+        n_neighbors: int, optional
+            The number of nearest samples used by the 'knn' strategy (default is 5).
+        block_size: int, optional
+            Number of features imputed at once (default is 50000).
+
+        Returns
+        -------
+        self: object
+            Object with attribute 'metabolome' updated with imputed values and 'imputed_mask' updated.
+        '''
+        if strategy not in IMPUTATION_STRATEGIES:
+            raise ValueError("The strategy argument should be one of {0}.".format(", ".join("'{0}'".format(s) for s in IMPUTATION_STRATEGIES)))
+        if is_nan_value(missing_values):
+            missing_values = np.nan
+        store = self._store
+
+        if strategy == "median":
+            sample_medians = np.concatenate(map_sample_blocks(store, median_per_sample, n_jobs=self.n_jobs, missing_values=missing_values)) if store.shape[1] > 0 else np.zeros(0)
+            imputed_blocks = map_feature_blocks(store, impute_block_with_sample_values, n_jobs=self.n_jobs, block_size=block_size, 
+                sample_values=sample_medians, missing_values=missing_values)
+        elif strategy == "group_median":
+            sample_sheet = self.get_sample_sheet(separator_replicates=separator_replicates)
+            imputed_blocks = map_feature_blocks(store, impute_block_with_group_medians, n_jobs=self.n_jobs, block_size=block_size, 
+                group_codes=sample_sheet.group_codes, n_groups=sample_sheet.n_groups, missing_values=missing_values)
+        elif strategy == "min_fraction":
+            imputed_blocks = map_feature_blocks(store, impute_block_with_min_fraction, n_jobs=self.n_jobs, block_size=block_size, 
+                min_value_fraction=min_value_fraction, missing_values=missing_values)
+        else:
+            # nan-euclidean distances between samples accumulated over blocks of features
+            squared_differences = np.zeros((store.shape[1], store.shape[1]))
+            n_present = np.zeros((store.shape[1], store.shape[1]))
+            for block_squared_differences, block_n_present in map_feature_blocks(
+                    store, compute_block_sample_distances, n_jobs=self.n_jobs, block_size=block_size, missing_values=missing_values):
+                squared_differences += block_squared_differences
+                n_present += block_n_present
+            distances = compute_nan_euclidean_distances(squared_differences, n_present, n_features=store.shape[0])
+            np.fill_diagonal(distances, np.inf)
+            neighbor_order = np.argsort(distances, axis=1, kind='stable')[:, :max(store.shape[1] - 1, 0)]
+            imputed_blocks = map_feature_blocks(store, impute_block_with_knn, n_jobs=self.n_jobs, block_size=block_size, 
+                neighbor_order=neighbor_order, n_neighbors=n_neighbors, missing_values=missing_values)
+
+        # cells imputed in each block (rows relative to the block)
+        block_starts = np.cumsum([0] + [n_rows for _, _, _, n_rows in imputed_blocks[:-1]])
+        row_positions = np.concatenate([rows + start for (rows, _, _, _), start in zip(imputed_blocks, block_starts)] + [np.zeros(0, dtype=np.int64)])
+        col_positions = np.concatenate([cols for _, cols, _, _ in imputed_blocks] + [np.zeros(0, dtype=np.int64)])
+        fill_values = np.concatenate([values for _, _, values, _ in imputed_blocks] + [np.zeros(0)])
+
+        self._store = self._get_writable_store(store).fill_values(row_positions, col_positions, fill_values)
+        imputed_mask = sparse.csr_matrix((np.ones(row_positions.size, dtype=bool), (row_positions, col_positions)), shape=store.shape)
+        self.imputed_mask = imputed_mask if self.imputed_mask is None else (self.imputed_mask + imputed_mask).astype(bool)
+        self._record_values("impute_missing_values: " + strategy)
+        print("{0} missing values imputed with the {1} strategy.".format(row_positions.size, strategy))
+
+    def impute_missing_values_with_median(self, missing_value_str=np.nan):
         '''
-        Imputes missing values with the median of the column.
+        Imputes missing values with the median of the column (sample).
+        See impute_missing_values() for other strategies.
         
         Params
         ------
-        missing_value_str: str, optional
-            The string that represents missing values in the input dataframe.
+        missing_value_str: float, optional
+            The value that represents missing values in the input dataframe (default is np.nan).
             All occurrences of missing_values will be imputed. 
-            For pandas’ dataframes with nullable integer dtypes with missing values, missing_values can be set to either np.nan or pd.NA.
+            The string 'np.nan' is also understood as NaN.
 
         Returns
         -------
         self: object with attribute 'metabolome' updated with imputed values.
         '''
-        feature_ids = self.metabolome.index
-        sample_ids = self.metabolome.columns
+        self.impute_missing_values(strategy="median", missing_values=missing_value_str)
 
-        imputer = SimpleImputer(missing_values=missing_value_str, strategy='median')
-        metabolome_not_imputed = self.metabolome
-        metabolome_imputed = imputer.fit_transform(metabolome_not_imputed)
-        metabolome_imputed_df = pd.DataFrame(metabolome_imputed, index=feature_ids, columns=sample_ids)
-        self.metabolome = metabolome_imputed_df
+
+    ###############################################
+    ### Normalise samples with the median of ratios
+    ###############################################
+    def normalise_with_median_of_ratios(self, normaliser=None, block_size=50000):
+        '''
+        Normalises the metabolite values of each sample with the median of ratios method from DESeq2.
+        Only features without zero values are used to compute the scaling factor of each sample. 
+        The scaling factors are computed in one pass over blocks of features and the values are divided in place
+        (with sparse storage, only the stored values are divided: the values are never densified).
+        A dataframe returned earlier by the 'metabolome' attribute keeps its values: they are copied before the division.
+        With n_jobs > 1, blocks of features are processed in parallel. 
+
+        Parameters
+        ----------
+        normaliser: `normalisation.MedianOfRatiosNormaliser`, optional
+            A normaliser fitted on a reference cohort, e.g. the 'normaliser' attribute of another OmicsAnalysis object.
+            The samples of this batch are then normalised against the stored reference (log geometric means of the cohort)
+            without processing the original cohort again. Default is None: a normaliser is fitted on this metabolome.
+        block_size: int, optional
+            Number of features processed at once (default is 50000).
+
+        Returns
+        -------
+        self: object
+            Object with attribute 'metabolome' normalised, 'scaling_factors' (one per sample) and 'normaliser'.
+
+        Example
+        -------
+        >>> cohort.normalise_with_median_of_ratios()
+        >>> new_batch.normalise_with_median_of_ratios(normaliser=cohort.normaliser)
+
+        See also
+        --------
+        normalisation.MedianOfRatiosNormaliser
+        utils.median_of_ratios_normalisation()
+        '''
+        store = self._store
+        if normaliser is None:
+            normaliser = MedianOfRatiosNormaliser(chunksize=block_size, n_jobs=self.n_jobs).fit(store)
+        scaling_factors = normaliser.get_scaling_factors(store)
+        self._store = self._get_writable_store(store).scale_samples(scaling_factors.to_numpy())
+        self.scaling_factors = scaling_factors
+        self.normaliser = normaliser
+        self._record_values("normalise_with_median_of_ratios")
 
 
     #############################################
@@ -240,30 +1136,119 @@ class OmicsAnalysis:
         -------
         metabolome: pandas.core.frame.DataFrame
             A filtered Pandas dataframe without features detected in blank samples and with the blank samples removed. 
+            With lazy=True, the filter is only recorded (see execute()).
         '''
+        if self.lazy:
+            self._get_filter_plan().add_blank_filter(blank_sample_contains=blank_sample_contains, validate=not self.metabolome_validated)
+            self._blank_sample_contains = blank_sample_contains
+            return
         if self.metabolome_validated == True:
             pass
         else:
             self.validate_input_metabolome_df()
-        blank_cols = [col for col in self.metabolome.columns.values.tolist() if blank_sample_contains in col]
+        blank_cols = [col for col in self._store.columns.tolist() if blank_sample_contains in col]
         # If the sum of a feature in blank samples is higher than 0 then 
         # this feature should be removed
         # only keep features that are not detectable in blank samples
-        self.metabolome["sum_features"] = self.metabolome[blank_cols].sum(axis=1)
-        self.metabolome = self.metabolome.query("sum_features == 0")
-        # Remove columns with blank samples and the sum column used for filtering
-        self.metabolome = self.metabolome.drop(blank_cols, axis=1)
-        self.metabolome = self.metabolome.drop("sum_features", axis=1)    
+        cube = self._statistics_cube
+        cube_has_sums = cube is not None and cube.store is self._store and cube.is_computed("sum")
+        blank_groups = cube.get_groups_of_samples(blank_cols) if cube_has_sums else None
+        if blank_groups is not None:
+            # the blank samples are whole groups of the statistics cube
+            sum_features = cube.get("sum")[:, cube.group_names.isin(blank_groups)].sum(axis=1)
+        else:
+            sum_features = _concatenate_blocks(map_feature_blocks(self._store, sum_per_feature, n_jobs=self.n_jobs, columns=blank_cols), (0,))
+        # Remove columns with blank samples at the same time
+        self.blank_features_filtered = True
+        self._blank_sample_contains = blank_sample_contains
+        self._keep_features(sum_features == 0, columns_to_drop=blank_cols, label="discard_features_detected_in_blanks")
 
 
     #######################################################################
     # Create density plots of feature peak areas for each grouping variable
     #######################################################################
-    def create_density_plot(self, name_grouping_var="genotype", n_cols=3, nbins=1000):
+    def compute_density_histograms(self, nbins=1000, separator_replicates="_", name_grouping_var="genotype"):
+        '''
+        Computes, for each grouping variable (e.g. genotype), the histogram of all feature peak areas on log-spaced bins 
+        and an approximate density (gaussian kernel applied to the binned counts). 
+
+        The histograms of all groups are computed in one vectorized pass over blocks of features of the wide matrix 
+        (after a pass to find the range of the values): the matrix is never melted.
+        The result is a compact summary (n_groups x nbins rows) cached until the metabolome values or samples change.
+        Zero values cannot be placed on the log scale: they are not binned but are part of the total used for percentages.
+
+        Parameters
+        ----------
+        nbins: int, optional
+            The number of log-spaced bins (default is 1000).
+        separator_replicates: str, optional
+            The separator between the grouping variable and the biological replicates (default is underscore "_").
+        name_grouping_var: str, optional
+            The name of the column with the groups (default is "genotype").
+
+        Returns
+        -------
+        `pandas.core.frame.DataFrame`
+            One row per group and bin with columns name_grouping_var, 'bin_left', 'bin_right', 'count', 
+            'percent' (percentage of the values of the group) and 'kde_percent' (density in the same unit).
+        '''
+        sample_sheet = self.get_sample_sheet(separator_replicates=separator_replicates)
+        store = self._store
+        cache = self._density_histograms_cache
+        if cache is not None and cache["store"] is store and cache["sample_sheet"] is sample_sheet and cache["nbins"] == nbins:
+            return cache["histograms"].rename(columns={"group": name_grouping_var})
+
+        # range of the positive values (log10 scale) from the statistics cube
+        cube = self.get_statistics_cube(separator_replicates=separator_replicates)
+        min_positive = cube.get("min_positive")
+        if np.all(np.isnan(min_positive)):
+            log_min, log_max = 0.0, 1.0
+        else:
+            log_min, log_max = np.log10(np.nanmin(min_positive)), np.log10(np.nanmax(cube.get("max_positive")))
+        if log_max <= log_min:
+            log_max = log_min + 1.0
+        bin_edges = np.linspace(log_min, log_max, nbins + 1)
+
+        # one pass: histograms of all groups for each block of features, summed over blocks
+        counts = np.zeros((sample_sheet.n_groups, nbins))
+        n_values = np.zeros(sample_sheet.n_groups)
+        sum_log = np.zeros(sample_sheet.n_groups)
+        sum_squared_log = np.zeros(sample_sheet.n_groups)
+        for block_counts, block_n_values, block_sum_log, block_sum_squared_log in map_feature_blocks(
+                store, compute_group_log_histograms, n_jobs=self.n_jobs,
+                group_codes=sample_sheet.group_codes, n_groups=sample_sheet.n_groups, log_min=log_min, log_max=log_max, nbins=nbins):
+            counts += block_counts
+            n_values += block_n_values
+            sum_log += block_sum_log
+            sum_squared_log += block_sum_squared_log
+
+        histograms = []
+        for group_code, group_name in enumerate(sample_sheet.group_names):
+            n_positive = counts[group_code].sum()
+            log_mean = sum_log[group_code] / n_positive if n_positive > 0 else np.nan
+            log_std = np.sqrt(max(sum_squared_log[group_code] / n_positive - log_mean**2, 0)) if n_positive > 0 else np.nan
+            kde_counts = smooth_log_histogram(counts[group_code], bin_width=bin_edges[1] - bin_edges[0], log_std=log_std)
+            total = n_values[group_code] if n_values[group_code] > 0 else 1
+            histograms.append(pd.DataFrame({
+                "group": group_name,
+                "bin_left": 10 ** bin_edges[:-1],
+                "bin_right": 10 ** bin_edges[1:],
+                "count": counts[group_code],
+                "percent": counts[group_code] / total * 100,
+                "kde_percent": kde_counts / total * 100}))
+        histograms = pd.concat(histograms, ignore_index=True) if len(histograms) > 0 else pd.DataFrame(
+            columns=["group", "bin_left", "bin_right", "count", "percent", "kde_percent"])
+        self._density_histograms_cache = dict(store=store, sample_sheet=sample_sheet, nbins=nbins, histograms=histograms)
+        return histograms.rename(columns={"group": name_grouping_var})
+
+    def create_density_plot(self, name_grouping_var="genotype", n_cols=3, nbins=1000, separator_replicates="_"):
         '''
         For each grouping variable (e.g. genotype), creates a histogram and density plot of all feature peak areas.
         This plot helps to see whether some groups have a value distribution different from the rest. 
-        The percentage is indicated on the y-axis (bar heights sum to 100).
+        The percentage is indicated on the y-axis (bar heights sum to 100 minus the percentage of zero values).
+
+        The plot is drawn from the precomputed histograms of compute_density_histograms() (log-spaced bins, 
+        approximate density from the binned counts), not from the individual values.
         
         Parameters
         ----------
@@ -275,26 +1260,22 @@ class OmicsAnalysis:
             The number of columns for the final plot.
         nbins: int, optional
             The number of bins to create. 
+        separator_replicates: str, optional
+            The separator between the grouping variable and the biological replicates (default is underscore "_").
         
         Returns
         -------
-        matplotlib Axes
-            Returns the Axes object with the density plots drawn onto it.
-        '''
-        df = self.metabolome
-        melted_df = pd.melt(
-            df.reset_index(), 
-            id_vars=df.index.name, 
-            var_name='sample')
-        samples2conditions = extract_samples_to_condition(df)
-        melted_df_with_cond = melted_df.merge(samples2conditions, on='sample')
-        fig = plt.figure()
-        g = sns.FacetGrid(melted_df_with_cond, col='genotype', col_wrap=3)
-        g = g.map_dataframe(sns.histplot, x='value', kde=True, stat='percent', bins=nbins)
+        seaborn FacetGrid
+            Returns the FacetGrid object with the density plots drawn onto it.
+        '''
+        histograms = self.compute_density_histograms(nbins=nbins, separator_replicates=separator_replicates, name_grouping_var=name_grouping_var)
+        g = sns.FacetGrid(histograms, col=name_grouping_var, col_wrap=n_cols)
+        g = g.map_dataframe(_draw_binned_histogram)
         g.set_titles(col_template="{col_name}")
+        g.set(xscale='log')
         g.set_xlabels("Peak area value (AU, log scale)")
         g.set_ylabels("Percentage of total (%)")
-        plt.xscale('log')
+        return g
 
     
     ###########################################################
@@ -304,11 +1285,13 @@ class OmicsAnalysis:
         self, 
         name_grouping_var="genotype",
         separator_replicates="_",
-        percentile=50):
+        percentile=50,
+        sketch_k=None):
         '''
         Filter metabolome dataframe based on a selected percentile threshold.
         Features with a peak area values lower than the selected percentile will be discarded. 
-        The percentile value is calculated per grouping variable. 
+        The percentile value is calculated per grouping variable on the block of samples of that group.
+        A feature is kept if at least one of its values is strictly higher than the percentile value of its group. 
 
         For instance, selecting the 50th percentile (median) will discard 50% of the features with a peak area
         lower than the median/50th percentile in each group. 
@@ -319,14 +1302,21 @@ class OmicsAnalysis:
             The name of the grouping variable (default is "genotype")
         separator_replicates: str, optional
             The character used to separate the main grouping variable from biological replicates. 
+            The grouping variable is the part of the sample name before the first separator. 
             Default is "_: (underscore)
         percentile: float, optional
             The percentile threshold. Has to be comprised 0 and 100.
+        sketch_k: int, optional
+            If given, the percentile of each group is approximated with KLL quantile sketches of size parameter sketch_k:
+            sketches are built on blocks of features (in parallel with n_jobs > 1) and merged, so the values of a group 
+            are never gathered in memory. The rank error of the percentile is bounded (about 1.65% of the values for sketch_k=200,
+            see quantile_sketch.KLLSketch). Default is None: exact percentile.
 
         Returns
         -------
         self: object
             The object with the .metabolome attribute filtered and the filtered_by_percentile_value set to True. 
+            With lazy=True, the filter is only recorded (see execute()).
 
         Example
         -------
@@ -347,38 +1337,36 @@ class OmicsAnalysis:
         --------
         create_density_plot() method to decide on a suitable percentile value. 
         '''
-        # melt to tidy/long format (one value per row, one column per variable)
-        # add grouping variable name
-        df = self.metabolome
-        melted_df = pd.melt(
-            df.reset_index(), 
-            id_vars='feature_id', 
-            var_name='sample', 
-            value_name='value')
-        sample2condition = extract_samples_to_condition(df, name_grouping_var=name_grouping_var, separator_replicates=separator_replicates)
-        melted_df_with_group = melted_df.merge(sample2condition, on="sample")
-        
+        if self.lazy:
+            filter_plan = self._get_filter_plan()
+            filter_plan.add_percentile_filter(self.get_sample_sheet(separator_replicates=separator_replicates), percentile=percentile, sketch_k=sketch_k)
+            return
+
+        # Work on the wide matrix: one block of columns per group (no melting to long format)
+        sample_sheet = self.get_sample_sheet(separator_replicates=separator_replicates)
+
         # calculate selected percentile value per group 
-        percentiles_per_group = melted_df_with_group.groupby('genotype').apply(lambda df: calculate_percentile(df["value"], my_percentile=percentile))
-
-        # extract features per group which abundance is strictly higher than the selected percentile value
-        # do that for each group e.g. each genotype
-        # deduplicate the final list of features to keep 
-        features_to_keep = []
-        all_groups = percentiles_per_group.index.values
-        feature_id_colname = df.index.name
-        for my_group in all_groups:
-            sub_df = melted_df_with_group[melted_df_with_group[name_grouping_var] == my_group]
-            my_group_percentile = percentiles_per_group.loc[my_group]
-            sub_df_filtered = sub_df.loc[sub_df["value"] > my_group_percentile]
-            good_features = sub_df_filtered[feature_id_colname]
-            for good_feature in good_features:
-                features_to_keep.append(good_feature)
-        features_to_keep = list(set(features_to_keep)) # deduplicate
-        df_filtered = df.loc[features_to_keep,:]
-
-        self.metabolome = df_filtered
+        # keep features which abundance is strictly higher than the percentile value of at least one group
+        if sketch_k is not None:
+            # one pass: maximum per group and quantile sketches of each group, merged across blocks
+            blocks = map_feature_blocks(
+                self._store, max_and_sketch_per_group, n_jobs=self.n_jobs, 
+                group_codes=sample_sheet.group_codes, n_groups=sample_sheet.n_groups, sketch_k=sketch_k)
+            maximum_per_group = _concatenate_blocks([maximum for maximum, _ in blocks], (0, sample_sheet.n_groups))
+            group_sketches = merge_sketches([sketches for _, sketches in blocks])
+        else:
+            maximum_per_group = self.get_statistics_cube(separator_replicates=separator_replicates).get("max", sample_sheet)
+        features_to_keep = np.zeros(self._store.shape[0], dtype=bool)
+        for group_code in range(sample_sheet.n_groups):
+            if sketch_k is not None:
+                group_values = group_sketches[group_code]
+            else:
+                group_values = self._store.get_values(columns=sample_sheet.get_group_samples(group_code))
+            group_percentile = calculate_percentile(group_values, my_percentile=percentile)
+            features_to_keep |= maximum_per_group[:, group_code] > group_percentile
+
         self.filtered_by_percentile_value = True
+        self._keep_features(features_to_keep, label="filter_features_per_group_by_percentile")
 
 
     #######################################################################################
@@ -388,16 +1376,17 @@ class OmicsAnalysis:
         self,
         name_grouping_var="genotype", 
         nb_times_detected=4,
-        separator_replicates='_'):
+        separator_replicates='_',
+        count_imputed_values=True):
         '''
         Removes features not reliably detectable in multiple biological replicates from the same grouping factor. 
 
         Takes a dataframe with feature identifiers in index and samples as columns.
-        Step 1: First melt and split the sample names to generate the grouping variable
-        Step 2: count number of times a metabolite is detected in the groups. 
+        Step 1: Split the sample names once to generate an integer code of the grouping variable per sample.
+        Step 2: count number of times a metabolite is detected in the groups, for all features at once
+        (grouped sum of the value > 0 mask over the samples of each group). 
         If number of times detected in a group = number of biological replicates then it is considered as reliable
-        Each feature receives a tag  'reliable' or 'not_reliable'
-        Step 3: discard the 'not_reliable' features and keep the filtered dataframe. 
+        Step 3: discard the features that are not reliable in any group and keep the filtered dataframe. 
 
         Params
         ------
@@ -410,12 +1399,15 @@ class OmicsAnalysis:
             Should be equal to the number of biological replicates for a given group of interest (e.g. genotype)
         separator_replicates: string, default="_"
             The separator to split sample names into a grouping variable (e.g. genotype) and the biological replicate number (e.g. 1)
+        count_imputed_values: `bool`, optional
+            Count imputed values (see impute_missing_values() and the imputed_mask attribute) as detections (default is True). 
         
 
         Returns
         -------
         metabolome: ndarray
             A Pandas dataframe with only features considered as reliable, sample names and their values. 
+            With lazy=True, the filter is only recorded (see execute()).
         
         Notes 
         -----
@@ -440,50 +1432,299 @@ class OmicsAnalysis:
 
 
         '''
-        df = self.metabolome
+        if self.lazy and (count_imputed_values or self.imputed_mask is None):
+            filter_plan = self._get_filter_plan()
+            filter_plan.add_reliability_filter(self.get_sample_sheet(separator_replicates=separator_replicates), nb_times_detected=nb_times_detected)
+            return
+
+        ### Count detections per group for all features at once (block by block of features)
+        sample_sheet = self.get_sample_sheet(separator_replicates=separator_replicates)
+        detections_per_group = self.get_statistics_cube(separator_replicates=separator_replicates).get("n_detected", sample_sheet).astype(np.int64)
+        if not count_imputed_values and self.imputed_mask is not None:
+            # imputed values > 0 are not detections
+            for start, stop, values in self._store.iter_feature_blocks():
+                imputed_rows, imputed_cols = self.imputed_mask[start:stop].nonzero()
+                imputed_values = np.asarray(values[imputed_rows, imputed_cols]).ravel()
+                detected_imputed_values = sparse.csr_matrix(
+                    (imputed_values > 0, (imputed_rows, imputed_cols)), shape=values.shape)
+                detections_per_group[start:stop] -= count_detections_per_group(detected_imputed_values, sample_sheet.group_codes, n_groups=sample_sheet.n_groups)
 
-        ### Melt (required to tag reliable/not reliable features)
-        melted_df = pd.melt(
-            df.reset_index(), 
-            id_vars='feature_id', 
-            var_name="sample")
-        melted_df[[name_grouping_var, 'rep']] = melted_df["sample"].str.split(pat=separator_replicates, expand=True)
-        sorted_melted_df = melted_df.sort_values(by=['feature_id', name_grouping_var])
-        sorted_melted_df.set_index('feature_id', inplace=True)
-        sorted_melted_df_parsed = sorted_melted_df.drop('sample', axis=1)
-        
         ### Identify features that are reliable
-        # Creates a dictionary to have the feature identifier and a 'reliable'/'not_reliable' tag
-        reliability_feature_dict = {}
-        features = sorted_melted_df_parsed.index.unique().tolist()
-
-        for feature in features:
-          # Dataframe containing only one metabolite
-          temp_df = sorted_melted_df_parsed.loc[feature,:]
-          temp_df = temp_df.drop('rep', axis=1)
-
-          # number of values above 0 across all groups
-          min_number_of_values_above_0_across_all_groups = temp_df[temp_df['value'] > 0].groupby(by=name_grouping_var)[name_grouping_var].count().max()
-
-          # If the feature is detected a minimum of times equal to the number of biological replicates
-          # This means the feature is reliably detectable in at least one group (e.g. one genotype)
-          if min_number_of_values_above_0_across_all_groups >= nb_times_detected:
-            reliability_feature_dict[feature] = "reliable"    
-          else:
-            reliability_feature_dict[feature] = 'not_reliable'
-
-        # Convert to a Pandas to prepare the filtering of the feature/abundance dataframe
-        reliability_df = pd.DataFrame.from_dict(
-            reliability_feature_dict, orient="index", columns=["reliability"]).reset_index()
-        
-        reliability_df = reliability_df.rename({"index":"feature_id"}, axis='columns')
-        reliability_df = reliability_df[reliability_df["reliability"] == "reliable"]
-        features_to_keep = reliability_df.feature_id.tolist()
+        # If the feature is detected a minimum of times equal to the number of biological replicates
+        # This means the feature is reliably detectable in at least one group (e.g. one genotype)
+        max_detections_across_all_groups = detections_per_group.max(axis=1, initial=0)
+        # Features never detected are never reliable (also when nb_times_detected=0)
+        is_reliable = (max_detections_across_all_groups >= nb_times_detected) & (max_detections_across_all_groups > 0)
 
-        df_reliable_features = df.loc[features_to_keep,:]
-                
-        self.metabolome = df_reliable_features
         self.unreliable_features_filtered = True
+        self._keep_features(is_reliable, label="filter_out_unreliable_features")
+
+    ###################################################
+    ### Sweep the parameters of the cleaning filters
+    ###################################################
+    def sweep_filter_parameters(
+        self,
+        percentiles=(10, 25, 50, 75, 90),
+        nb_times_detected=(1, 2, 3, 4),
+        blank_sample_contains=("blank", None),
+        separator_replicates="_",
+        sketch_k=None,
+        block_size=50000):
+        '''
+        Number of features retained by the cleaning chain for a grid of filter parameters, without filtering the metabolome.
+
+        The chain is: discard_features_detected_in_blanks() (or not), filter_features_per_group_by_percentile()
+        and filter_out_unreliable_features(). Instead of running the filters again for each combination of parameters,
+        the statistics they need (features detected in blanks, maximum and detections per group, percentile of each group)
+        are computed once in a single pass over the metabolome and every grid point is resolved from boolean masks.
+        The metabolome is not modified. With n_jobs > 1, blocks of features are processed in parallel.
+
+        Parameters
+        ----------
+        percentiles: list-like, optional
+            The percentile thresholds to test (default is 10, 25, 50, 75 and 90).
+        nb_times_detected: list-like, optional
+            The minimum numbers of detections in one group to test (default is 1 to 4).
+        blank_sample_contains: list-like, optional
+            The blank policies to test: samples whose name contains the string are blank samples.
+            None tests the chain without the blank filter (default is "blank" and None).
+        separator_replicates: str, optional
+            The separator between the grouping variable and the biological replicates (default is "_").
+        sketch_k: int, optional
+            Approximate the percentiles with quantile sketches (see filter_features_per_group_by_percentile()).
+            Default is None: exact percentiles.
+        block_size: int, optional
+            Number of features read at once (default is 50000).
+
+        Returns
+        -------
+        sweep: `pandas.core.frame.DataFrame`
+            One row per grid point with columns 'blank_sample_contains', 'percentile', 'nb_times_detected' and 'features_retained'.
+            Also stored in the 'filter_sweep' attribute. The 'filter_sweep_overlaps' attribute is a dataframe 
+            with the number of features retained by both grid points (same order as the rows of sweep).
+
+        Example
+        -------
+        >>> sweep = met.sweep_filter_parameters(percentiles=[25, 50, 75], nb_times_detected=[2, 3, 4])
+        >>> sweep.pivot_table(index="percentile", columns="nb_times_detected", values="features_retained")
+        '''
+        store = self._store
+        sample_sheet = self.get_sample_sheet(separator_replicates=separator_replicates)
+        blank_policies = []
+        sample_sheets = []
+        for blank_string in blank_sample_contains:
+            if blank_string is None:
+                blank_cols = None
+                sample_sheets.append(sample_sheet)
+            else:
+                blank_cols = [col for col in store.columns.tolist() if blank_string in col]
+                sample_sheets.append(sample_sheet.select_samples(store.columns[~store.columns.isin(blank_cols)]))
+            blank_policies.append(blank_cols)
+        sweep, overlaps = sweep_filter_parameters(
+            store, sample_sheets, list(percentiles), list(nb_times_detected), blank_policies,
+            block_size=block_size, n_jobs=self.n_jobs, sketch_k=sketch_k)
+        sweep.insert(0, "blank_sample_contains", np.asarray(list(blank_sample_contains), dtype=object)[sweep.pop("blank_policy").to_numpy()])
+        grid_index = pd.MultiIndex.from_frame(sweep[["blank_sample_contains", "percentile", "nb_times_detected"]])
+        self.filter_sweep = sweep
+        self.filter_sweep_overlaps = pd.DataFrame(overlaps, index=grid_index, columns=grid_index)
+        return sweep
+
+    ##########################################################
+    ### Differential abundance of the features between groups
+    ##########################################################
+    def test_differential_abundance(self, groups=None, test="welch", separator_replicates="_", block_size=50000):
+        '''
+        Tests the difference of abundance of all features between groups of samples (e.g. genotypes) 
+        and corrects the p-values for multiple testing (Benjamini-Hochberg false discovery rate).
+
+        The tests are vectorized over blocks of features (in parallel with n_jobs > 1): the matrix is read once.
+        Groups are taken from the sample sheet, as in filter_out_unreliable_features() (see get_sample_sheet()).
+
+        Parameters
+        ----------
+        groups: list, optional
+            The groups to compare. For the 'welch' and 'mann-whitney' tests, two groups: the reference group first.
+            Default is None: all groups (there should be exactly two groups for the 'welch' and 'mann-whitney' tests).
+        test: str, optional
+            The statistical test (default is 'welch'):
+              - 'welch': Welch t-test (unequal variances) between two groups.
+              - 'mann-whitney': Mann-Whitney U test between two groups (normal approximation with tie correction).
+              - 'anova': one-way ANOVA between two or more groups.
+        separator_replicates: str, optional
+            The separator between the grouping variable and the biological replicates (default is underscore '_').
+        block_size: int, optional
+            Number of features tested at once (default is 50000).
+
+        Returns
+        -------
+        `pandas.core.frame.DataFrame`, (n_features, n_columns)
+            One row per feature with the mean of each group ('mean_<group>'), the log2 fold change of the second group
+            over the reference group ('log2_fold_change', two-group tests only), 'statistic', 'p_value' and 'adjusted_p_value'.
+            Features with missing values in the tested groups get NaN p-values (see impute_missing_values()).
+            Also stored in the differential_abundance attribute.
+        '''
+        if test not in STATISTICAL_TESTS:
+            raise ValueError("The test argument should be one of {0}.".format(", ".join("'{0}'".format(name) for name in STATISTICAL_TESTS)))
+        sample_sheet = self.get_sample_sheet(separator_replicates=separator_replicates)
+        groups = sample_sheet.group_names if groups is None else pd.Index(groups)
+        unknown_groups = groups[~groups.isin(sample_sheet.group_names)]
+        if len(unknown_groups) > 0:
+            raise ValueError("These groups are not in the sample sheet: {0}. Groups: {1}".format(unknown_groups.tolist(), sample_sheet.group_names.tolist()))
+        if test != "anova" and len(groups) != 2:
+            raise ValueError("The '{0}' test compares two groups: please select two groups (the reference group first).".format(test))
+        if len(groups) < 2:
+            raise ValueError("Please select at least two groups.")
+
+        group_codes = groups.get_indexer(sample_sheet.groups)
+        is_tested = group_codes >= 0
+        store = self._store
+        results = _concatenate_blocks(map_feature_blocks(
+            store, compute_block_statistical_tests, n_jobs=self.n_jobs, block_size=block_size, 
+            columns=sample_sheet.sample_names[is_tested], group_codes=group_codes[is_tested], n_groups=len(groups), test=test), (0, len(groups) + 2))
+
+        differential_abundance = pd.DataFrame(results[:, :len(groups)], index=store.index, columns=["mean_{0}".format(group) for group in groups])
+        if len(groups) == 2:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                differential_abundance["log2_fold_change"] = np.log2(results[:, 1] / results[:, 0])
+        differential_abundance["statistic"] = results[:, len(groups)]
+        differential_abundance["p_value"] = results[:, len(groups) + 1]
+        differential_abundance["adjusted_p_value"] = benjamini_hochberg(results[:, len(groups) + 1])
+        self.differential_abundance = differential_abundance
+        return differential_abundance
+
+    ###############################################################
+    ### Group isotopes and adducts of the same compound (one feature)
+    ###############################################################
+    def group_isotopes_and_adducts(
+        self, 
+        rt_tolerance=0.02, 
+        mz_tolerance=0.005, 
+        min_correlation=0.8, 
+        mass_differences=None, 
+        inplace=True, 
+        block_size=50000):
+        '''
+        Groups the features that are isotopes or adducts of the same compound and keeps one representative feature per group,
+        to shrink the feature space before PCA and machine learning.
+
+        Steps:
+          1. Candidate pairs: features that co-elute (RT within rt_tolerance) with a m/z difference of a 13C isotope 
+             or a common adduct (within mz_tolerance), found with a KD-tree over the (RT, m/z) of the features
+             parsed from their identifiers (see get_feature_index()).
+          2. Confirmation: the intensities of the two features should be correlated across samples (Pearson correlation
+             >= min_correlation). Correlations are computed by blocks of pairs from standardized values.
+          3. Features linked by confirmed pairs form a group; its representative is the feature with the highest 
+             total intensity (see get_statistics_cube()). The other features of the group are removed.
+
+        Parameters
+        ----------
+        rt_tolerance: float, optional
+            The retention time tolerance, same unit as the feature identifiers (default is 0.02).
+        mz_tolerance: float, optional
+            The tolerance on the m/z differences in Da (default is 0.005).
+        min_correlation: float, optional
+            The minimum correlation of the intensities of two features of the same compound (default is 0.8).
+        mass_differences: dict, optional
+            Names and m/z differences (Da) searched (default is None: feature_grouping.MASS_DIFFERENCES, 
+            13C isotopes and NH4, Na and K adducts of [M+H]+).
+        inplace: bool, optional
+            Keep only the representative features in the metabolome (default is True).
+        block_size: int, optional
+            Number of features standardized at once (default is 50000).
+
+        Returns
+        -------
+        self: object
+            Object with feature_groups filled: one row per feature with its 'group', the 'representative' feature of its group 
+            and 'is_representative'. The confirmed pairs, their relation and correlation are in feature_group_pairs.
+        '''
+        index = self.get_feature_index()
+        store = self._store
+        candidates = find_candidate_pairs(
+            index.rt, index.mz, mass_differences=mass_differences, rt_tolerance=rt_tolerance, mz_tolerance=mz_tolerance)
+        standardized = standardize_features(store, block_size=block_size, n_jobs=self.n_jobs)
+        candidates["correlation"] = correlate_feature_pairs(standardized, candidates["feature_a"], candidates["feature_b"])
+        del standardized
+        confirmed = candidates.loc[candidates["correlation"] >= min_correlation].reset_index(drop=True)
+
+        total_intensities = self.get_statistics_cube().get("sum").sum(axis=1)
+        groups, representatives = group_features(store.shape[0], confirmed["feature_a"], confirmed["feature_b"], total_intensities)
+        is_representative = np.zeros(store.shape[0], dtype=bool)
+        is_representative[representatives] = True
+        self.feature_groups = pd.DataFrame(
+            {"group": groups, "representative": store.index[representatives[groups]], "is_representative": is_representative}, index=store.index)
+        self.feature_group_pairs = pd.DataFrame({
+            "feature_a": store.index[confirmed["feature_a"]],
+            "feature_b": store.index[confirmed["feature_b"]],
+            "relation": confirmed["relation"],
+            "correlation": confirmed["correlation"]})
+        print("{0} candidate pairs of isotopes or adducts, {1} confirmed by correlation: {2} features grouped into {3} features.".format(
+            len(candidates), len(confirmed), store.shape[0], len(representatives)))
+        if inplace:
+            self._keep_features(is_representative, label="group_isotopes_and_adducts")
+
+    #############################################
+    ### Remove redundant (correlated) features
+    #############################################
+    def prune_redundant_features(
+        self, 
+        threshold=0.95, 
+        max_memory_mb=512, 
+        sketch_size=None, 
+        random_state=None, 
+        inplace=True, 
+        block_size=50000):
+        '''
+        Removes redundant features: metabolomic features are strongly correlated and a feature whose absolute correlation
+        with a more intense feature is >= threshold brings little information to PCA or machine learning.
+
+        Features are visited by decreasing total intensity (see get_statistics_cube()) and kept if they are not correlated 
+        with a feature kept before (greedy selection). The correlations are computed by blocks sized to max_memory_mb:
+        the (n_features, n_features) correlation matrix is never built.
+        With sketch_size, the standardized values are projected on sketch_size random directions of the samples 
+        (computed by blocks of features): correlations are then approximated (error of the order of 1/sqrt(sketch_size))
+        but the memory and time needed no longer depend on the number of samples.
+
+        Parameters
+        ----------
+        threshold: float, optional
+            Absolute correlation above which a feature is redundant (default is 0.95).
+        max_memory_mb: float, optional
+            Memory budget of the standardized values and of the correlation blocks in megabytes (default is 512).
+        sketch_size: int, optional
+            Number of random directions of the projection (default is None: exact correlations).
+        random_state: int, optional
+            Seed of the random projection (default is None).
+        inplace: bool, optional
+            Remove the redundant features from the metabolome (default is True).
+        block_size: int, optional
+            Number of features standardized at once (default is 50000).
+
+        Returns
+        -------
+        self: object
+            Object with redundant_features filled: one row per removed feature (index) with the 'representative' 
+            feature kept in its place and their 'correlation'.
+        '''
+        store = self._store
+        if sketch_size is None:
+            standardized = standardize_features(store, block_size=block_size, n_jobs=self.n_jobs)
+        else:
+            rng = np.random.default_rng(random_state)
+            projection = rng.standard_normal((store.shape[1], sketch_size)) / np.sqrt(sketch_size)
+            blocks = map_feature_blocks(store, project_feature_block, n_jobs=self.n_jobs, block_size=block_size, projection=projection)
+            standardized = _concatenate_blocks(blocks, (0, sketch_size)).astype(np.float32)
+        total_intensities = self.get_statistics_cube().get("sum").sum(axis=1)
+        representatives, correlations = prune_correlated_features(
+            standardized, total_intensities, threshold=threshold, max_memory_mb=max_memory_mb)
+        del standardized
+        is_redundant = representatives >= 0
+        self.redundant_features = pd.DataFrame(
+            {"representative": store.index[representatives[is_redundant]], "correlation": correlations[is_redundant]}, 
+            index=store.index[is_redundant])
+        print("{0} redundant features (absolute correlation >= {1}) out of {2} features.".format(np.count_nonzero(is_redundant), threshold, store.shape[0]))
+        if inplace:
+            self._keep_features(~is_redundant, label="prune_redundant_features")
 
     #################################################
     ### Write filtered metabolomoe data to a csv file
@@ -518,7 +1759,7 @@ class OmicsAnalysis:
     ## Principal Component Analysis
     #################################
 
-    def compute_pca_on_metabolites(self, scale=True, n_principal_components=10, auto_transpose=True):
+    def compute_pca_on_metabolites(self, scale=True, n_principal_components=10, auto_transpose=True, solver="full", block_size=10000, random_state=None):
         """
         Performs a Principal Component Analysis (PCA) on the metabolome data. 
         
@@ -539,6 +1780,20 @@ class OmicsAnalysis:
         auto_transpose: `bool`, optional. 
             If n_samples > n_features, performs a transpose of the feature matrix.
             Default is True (meaning that transposing will occur if n_samples > n_features).
+        solver: str, optional
+            The PCA solver (default is 'full'). 
+              - 'full': scikit-learn PCA on a standardized copy of the data (StandardScaler).
+              - 'randomized': randomized truncated SVD. Fast when a few components are computed.
+              - 'gram': eigendecomposition of the (n_samples, n_samples) Gram matrix. Fast when n_samples << n_features.
+              - 'incremental': out-of-core version of 'gram' that streams blocks of features from the storage 
+                (only one block of features is in memory at a time, e.g. with storage='memmap').
+            With the 'randomized', 'gram' and 'incremental' solvers, centering and scaling are fused in the computation:
+            the standardized copy of the data is never made. 
+            With sparse storage, the 'full' solver is replaced by 'gram' so that the values are not densified.
+        block_size: int, optional
+            Number of features processed at once by the 'gram' and 'incremental' solvers (default is 10000).
+        random_state: int, optional
+            Seed of the 'randomized' solver (default is None).
     
         Returns
         -------
@@ -547,39 +1802,58 @@ class OmicsAnalysis:
           .metabolome_pca_reduced: dataframe with samples in reduced dimensions
           .pca_performed: `bool`ean set to True
         """
+        if solver not in ("full", "randomized", "gram", "incremental"):
+            raise ValueError("The solver argument should be one of 'full', 'randomized', 'gram' or 'incremental'.")
+        if solver == "full" and self.storage == "sparse":
+            solver = "gram"
+
         # Verify that samples are in rows and features in columns
         # Usually n_samples << n_features so we should have n_rows << n_cols
-        n_rows = self.metabolome.shape[0]
-        n_cols = self.metabolome.shape[1]
-        
-        metabolite_df = self.metabolome
-        if n_rows > n_cols:
-            # Likely features are in row so transpose to have samples in rows
-            metabolite_df = metabolite_df.transpose()
-        else:
-            pass
-    
-        if scale == True:
-            scaler = StandardScaler(with_mean=True, with_std=True)
-            metabolite_df_scaled = scaler.fit_transform(metabolite_df)
-            metabolite_df_scaled = pd.DataFrame(metabolite_df_scaled)
-            metabolite_df_scaled.columns = metabolite_df.columns
-            metabolite_df_scaled.set_index(metabolite_df.index.values)       
-        else:
-            pass
+        n_rows = self._store.shape[0]
+        n_cols = self._store.shape[1]
+        features_in_rows = n_rows > n_cols
 
-        if n_principal_components <= np.minimum(n_rows, n_cols):
-            pca = PCA(n_components=n_principal_components)
-            metabolite_df_scaled_transformed = pca.fit_transform(metabolite_df_scaled)
-            exp_variance = pd.DataFrame(pca.explained_variance_ratio_.round(2)*100, columns=["explained_variance"])
         # If n_principal_components > min(n_samples, n_features)
         # then n_principal_components = min(n_samples, n_features)
-        else:
-            n_principal_components > np.minimum(n_rows, n_cols)
-            n_principal_components = np.minimum(n_rows, n_cols)
+        n_principal_components = int(np.minimum(n_principal_components, np.minimum(n_rows, n_cols)))
+
+        if solver == "full":
+            metabolite_df = self.metabolome
+            if features_in_rows:
+                # Likely features are in row so transpose to have samples in rows
+                metabolite_df = metabolite_df.transpose()
+
+            # float64 to avoid the loss of precision of float32 values in the decomposition
+            metabolite_values = metabolite_df.to_numpy(dtype=np.float64)
+            if scale == True:
+                scaler = StandardScaler(with_mean=True, with_std=True)
+                metabolite_df_scaled = scaler.fit_transform(metabolite_values)
+            else:
+                # PCA centers the data itself
+                metabolite_df_scaled = metabolite_values
+
             pca = PCA(n_components=n_principal_components)
             metabolite_df_scaled_transformed = pca.fit_transform(metabolite_df_scaled)
-            exp_variance = pd.DataFrame(pca.explained_variance_ratio_.round(2)*100, columns=["explained_variance"])         
+            explained_variance_ratio = pca.explained_variance_ratio_
+        elif solver == "incremental" and features_in_rows:
+            # blocks of features are read from the storage (features x samples) and transposed
+            def iter_feature_blocks():
+                for _, _, values in self._store.iter_feature_blocks(block_size=block_size):
+                    yield values.T
+            metabolite_df_scaled_transformed, explained_variance_ratio = compute_pca_from_feature_blocks(
+                iter_feature_blocks, n_principal_components, scale=scale)
+        else:
+            values = self._store.get_values()
+            if features_in_rows:
+                values = values.T
+            if solver == "randomized":
+                metabolite_df_scaled_transformed, explained_variance_ratio = compute_pca_with_randomized_svd(
+                    values, n_principal_components, scale=scale, random_state=random_state)
+            else:
+                metabolite_df_scaled_transformed, explained_variance_ratio = compute_pca_with_gram_matrix(
+                    values, n_principal_components, scale=scale, block_size=block_size)
+
+        exp_variance = pd.DataFrame(explained_variance_ratio.round(2)*100, columns=["explained_variance"])
 
         # The numbering of the components starts by default at 0. 
         # Setting this to 1 to make it more user friendly
@@ -678,7 +1952,7 @@ class OmicsAnalysis:
         n_samples = self.metabolome.shape[1]
         min_of_samples_and_features = np.minimum(n_samples, n_features)
         
-        samples_to_conditions = extract_samples_to_condition(df=self.metabolome, name_grouping_var=name_grouping_var, separator_replicates=separator_replicates)
+        samples_to_conditions = self.get_sample_sheet(separator_replicates=separator_replicates).to_frame(name_grouping_var=name_grouping_var)
 
         if pc_x_axis == pc_y_axis:
             raise ValueError("Values for Principal Components on x axis and y axis have to be different.")
@@ -697,7 +1971,7 @@ class OmicsAnalysis:
             self.scatter_plot = sns.scatterplot(
             x=self.metabolome_pca_reduced[:,pc_x_axis-1],
             y=self.metabolome_pca_reduced[:,pc_y_axis-1],
-            hue=samples_to_conditions[name_grouping_var],
+            hue=samples_to_conditions[name_grouping_var].to_numpy(),
             s=200)
 
             plt.xlabel("PC" + str(pc_x_axis) + ": " + str(self.exp_variance.iloc[pc_x_axis-1,0].round(2)) + "% variance") 
@@ -722,11 +1996,17 @@ class OmicsAnalysis:
     #######################################################################################
     ### Determine sparsity (number of non-zero)
     ######################################################################################
-    def compute_metabolome_sparsity(self):
+    def compute_metabolome_sparsity(self, sparse_threshold=None):
         '''
         Determine the sparsity of the metabolome matrix. 
         Formula: number of non zero values/number of values * 100
         The higher the sparsity, the more zero values 
+
+        Parameters
+        ----------
+        sparse_threshold: float, optional
+            If the sparsity (in %) is higher or equal to this threshold, the metabolite values are stored 
+            as a sparse matrix with convert_to_sparse(). Default is None (the storage is not changed).
         
         Returns
         -------
@@ -737,23 +2017,100 @@ class OmicsAnalysis:
         ----------
         https://stackoverflow.com/questions/38708621/how-to-calculate-percentage-of-sparsity-for-a-numpy-array-matrix
         '''
-        number_of_non_zero_values = count_nonzero(self.metabolome)
-        total_number_of_values = self.metabolome.size
+        cube = self._statistics_cube
+        if cube is None or cube.store is not self._store:
+            cube = self.get_statistics_cube()
+        number_of_non_zero_values = cube.get("n_nonzero").sum()
+        total_number_of_values = self._store.shape[0] * self._store.shape[1]
         sparsity = (1 - (number_of_non_zero_values/total_number_of_values)) * 100
         print("Sparsity of the metabolome matrix is equal to {0:.3f} %".format(sparsity))
         self.sparsity=sparsity
+        self._update_version_state()
+
+        if sparse_threshold is not None and sparsity >= sparse_threshold and self.storage != "sparse":
+            self.convert_to_sparse()
+
+    def convert_to_sparse(self):
+        '''
+        Stores the metabolite values as a scipy sparse matrix (CSR format). 
+        Blank filtering, percentile filtering, reliability filtering, median of ratios normalisation and PCA 
+        then work on the sparse matrix without densifying it. 
+        Prints and stores (sparse_memory_saved attribute) the memory saved compared to the dense values.
+
+        Returns
+        -------
+        self: object
+            Object with storage set to 'sparse' and sparse_memory_saved filled (in bytes).
+        '''
+        if self.storage == "sparse":
+            return
+        n_values = self._store.shape[0] * self._store.shape[1]
+        dense_nbytes = n_values * self._store.get_values(columns=self._store.columns[:1]).dtype.itemsize
+        store = self._store
+        self._store = SparseMetabolomeStore.from_store(store)
+        self.storage = "sparse"
+        self._retarget_statistics_cube(store)
+        self._record_values("compute_metabolome_sparsity")
+        self.sparse_memory_saved = dense_nbytes - self._store.nbytes
+        print("Switched to sparse storage: {0:.1f} MB instead of {1:.1f} MB ({2:.1f} MB saved)".format(
+            self._store.nbytes / 1024**2, dense_nbytes / 1024**2, self.sparse_memory_saved / 1024**2))
+
+    def convert_to_dense(self):
+        '''
+        Stores the metabolite values as a dense pandas dataframe in memory.
+
+        Returns
+        -------
+        self: object
+            Object with storage set to 'memory'.
+        '''
+        store = self._store
+        # the dataframe may have been handed out before the conversion
+        self._store = InMemoryMetabolomeStore(store.to_frame(), frame_is_shared=True)
+        self.storage = "memory"
+        self._retarget_statistics_cube(store)
+        self._record_values("convert_to_dense")
 
     
     #######################################################################################
     ### Plot features present per group in an UpSet plot
     ######################################################################################
+    def compute_feature_presence_intersections(self, separator_replicates="_", top_k=None):
+        '''
+        Counts the features present in each combination of groups (the intersections of an UpSet plot). 
+        A feature is considered present in a group if the median>0.
+
+        The presence matrix (n_features x n_groups) is obtained from the grouped detection and missing value counts
+        of the statistics cube (see statistics_cube.StatisticsCube.get_presence()), without computing the medians.
+        The presence of each feature is packed in a bitset read as integer keys, and the intersections are counted on these keys.
+        The stored metabolome is not modified.
+
+        Params
+        ------
+        separator_replicates: string, default="_"
+            The separator to split sample names into a grouping variable (e.g. genotype) and the biological replicate number (e.g. 1)
+        top_k: int, optional
+            Only keep the top_k intersections with the most features (default is None: all intersections).
+
+        Returns
+        -------
+        `pandas.core.frame.DataFrame`
+            One row per intersection (sorted by decreasing number of features): one boolean column per group 
+            and the number of features in column 'n_features'.
+        '''
+        sample_sheet = self.get_sample_sheet(separator_replicates=separator_replicates)
+        presence = self.get_statistics_cube(separator_replicates=separator_replicates).get_presence(sample_sheet)
+        return count_presence_intersections(presence, group_names=sample_sheet.group_names, top_k=top_k)
+
     def plot_features_in_upset_plot(
         self,
         seperator_replicates="_",
-        plot_file_name=None):
+        plot_file_name=None,
+        top_k=None):
         '''
         Visuallises the presence of features per group in an UpSet plot. 
         A feature is considered present in a group if the median>0.
+        The intersections are counted with compute_feature_presence_intersections() and passed to upsetplot as counts. 
 
         Params
         ------
@@ -763,6 +2120,8 @@ class OmicsAnalysis:
           A file name and its path to save the sample score plot (default is None).
           For instance "mydir/feature_upset_plot.pdf"
           Path is relative to current working directory.
+        top_k: int, optional
+            Only plot the top_k intersections with the most features (default is None: all intersections).
         
 
         Returns
@@ -784,16 +2143,15 @@ class OmicsAnalysis:
 
 
         '''
-        df = self.metabolome
-
-        # Create dataframe with median of each feature per group
-        df.columns = self.metabolome.columns.str.split(seperator_replicates,expand=True).get_level_values(0)
-        df = df.T.groupby(by=df.columns).median().T
+        intersections = self.compute_feature_presence_intersections(separator_replicates=seperator_replicates, top_k=top_k)
+        group_names = [col for col in intersections.columns if col != "n_features"]
 
-        # Cenvert the values to boolean with median>0 as True
-        df = df.gt(0)
+        # Counts per intersection indexed by the presence in each group (upsetplot format)
+        intersection_counts = pd.Series(
+            intersections["n_features"].to_numpy(), 
+            index=pd.MultiIndex.from_frame(intersections[group_names]))
         
-        plot(from_indicators(lambda df: df.select_dtypes(bool), data=df), show_counts=True)
+        plot(intersection_counts, show_counts=True)
         
         # Optionally save the plot
         if plot_file_name != None:
@@ -806,4 +2164,14 @@ class OmicsAnalysis:
 
         plt.show()
 
-        
\ No newline at end of file
+
+def _concatenate_blocks(blocks, empty_shape):
+    if len(blocks) == 0:
+        return np.zeros(empty_shape)
+    return np.concatenate(blocks)
+
+def _draw_binned_histogram(data, color=None, **kwargs):
+    # bars of the precomputed histogram and approximate density of one group (see compute_density_histograms())
+    ax = plt.gca()
+    ax.bar(data["bin_left"], data["percent"], width=data["bin_right"] - data["bin_left"], align="edge", color=color, alpha=0.75, linewidth=0)
+    ax.plot(np.sqrt(data["bin_left"] * data["bin_right"]), data["kde_percent"], color=color)
@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+
+import os
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
+from scipy import sparse
+
+from phenofeaturefinder.metabolome_storage import MemmapMetabolomeStore, SparseMetabolomeStore
+
+
+##########################################
+### Map a function over blocks of the store
+##########################################
+def map_feature_blocks(store, func, n_jobs=1, block_size=50000, columns=None, pass_bounds=False, **kwargs):
+    '''
+    Applies func(values, **kwargs) to blocks of features (rows) of a metabolome store and returns the results in order.
+
+    With n_jobs > 1, the blocks are processed by a pool of worker processes, kept for the following calls until
+    shutdown_workers() is called. The values are placed once in shared memory for each store (read-only memory-mapped stores
+    are read from their file) so that workers do not receive pickled copies of the matrix: only the block positions and the
+    results are sent. For in-memory and sparse stores this is one copy of the values per store: every filter step returns
+    a new store, whose values are copied again by its first parallel call (the copy of the previous store is released
+    when that store is garbage collected). The results are identical to the serial execution (n_jobs=1).
+
+    Parameters
+    ----------
+    store: object
+        A metabolome store (see metabolome_storage).
+    func: callable
+        A module-level function (picklable) taking the values of a block (numpy array or scipy sparse matrix).
+    n_jobs: int, optional
+        Number of worker processes (default is 1: serial execution). -1 uses all available cores.
+    block_size: int, optional
+        Maximum number of features per block (default is 50000).
+    columns: list-like, optional
+        Only pass the values of these column labels to func (default is None: all columns).
+    pass_bounds: bool, optional
+        If True, func is called as func(values, start, stop, **kwargs) with the positions of the features of the block
+        (e.g. to select features of the block with a mask of all features). Default is False.
+    **kwargs:
+        Keyword arguments of func. They are sent once to each worker.
+
+    Returns
+    -------
+    list
+        The result of func for each block, in the order of the features.
+    '''
+    n_jobs = get_n_jobs(n_jobs)
+    if n_jobs == 1 or store.shape[0] == 0:
+        if pass_bounds:
+            return [func(values, start, stop, **kwargs) for start, stop, values in store.iter_feature_blocks(block_size=block_size, columns=columns)]
+        return [func(values, **kwargs) for _, _, values in store.iter_feature_blocks(block_size=block_size, columns=columns)]
+    col_positions = np.arange(store.shape[1]) if columns is None else store.columns.get_indexer(list(columns))
+    blocks = _split(store.shape[0], block_size, n_jobs)
+    return _map_blocks(get_shared_values(store), func, blocks, n_jobs, axis=0, positions=col_positions, kwargs=kwargs, pass_bounds=pass_bounds)
+
+def map_sample_blocks(store, func, n_jobs=1, block_size=1000, features=None, **kwargs):
+    '''
+    Applies func(values, **kwargs) to blocks of samples (columns) of a metabolome store and returns the results in order.
+    Used for per-sample statistics such as medians. See map_feature_blocks().
+
+    Parameters
+    ----------
+    store: object
+        A metabolome store (see metabolome_storage).
+    func: callable
+        A module-level function (picklable) taking the values of a block (numpy array or scipy sparse matrix).
+    n_jobs: int, optional
+        Number of worker processes (default is 1: serial execution). -1 uses all available cores.
+    block_size: int, optional
+        Maximum number of samples per block (default is 1000).
+    features: `numpy.ndarray`, optional
+        Boolean mask: only pass the values of these features to func (default is None: all features).
+    **kwargs:
+        Keyword arguments of func. They are sent once to each worker.
+
+    Returns
+    -------
+    list
+        The result of func for each block, in the order of the samples.
+    '''
+    n_jobs = get_n_jobs(n_jobs)
+    row_positions = np.arange(store.shape[0]) if features is None else np.flatnonzero(features)
+    blocks = _split(store.shape[1], block_size, n_jobs)
+    if n_jobs == 1 or store.shape[1] == 0:
+        values = store.get_values()
+        if features is not None:
+            values = values[row_positions]
+        return [func(values[:, start:stop], **kwargs) for start, stop in blocks]
+    return _map_blocks(get_shared_values(store), func, blocks, n_jobs, axis=1, positions=row_positions, kwargs=kwargs)
+
+def get_n_jobs(n_jobs):
+    '''
+    Number of worker processes: None is 1 and negative values count from the number of cores (-1 is all cores).
+    '''
+    if n_jobs is None:
+        return 1
+    if n_jobs < 0:
+        return max(os.cpu_count() + 1 + n_jobs, 1)
+    if n_jobs == 0:
+        raise ValueError("n_jobs should be a positive integer or -1 (all cores).")
+    return n_jobs
+
+def _split(n, block_size, n_jobs):
+    # at least one block per worker
+    block_size = max(min(block_size, -(-n // n_jobs)), 1)
+    return [(start, min(start + block_size, n)) for start in range(0, n, block_size)]
+
+def _map_blocks(shared_values, func, blocks, n_jobs, axis, positions, kwargs, pass_bounds=False):
+    n_workers = min(n_jobs, len(blocks))
+    # one chunk of blocks per worker: the arguments shared by the blocks of a chunk are pickled once
+    tasks = [(shared_values.spec, func, axis, positions, kwargs, pass_bounds, block) for block in blocks]
+    executor = _get_executor(n_jobs)
+    try:
+        return list(executor.map(_run_block, tasks, chunksize=-(-len(tasks) // n_workers)))
+    except BrokenProcessPool:
+        # a worker died (e.g. out of memory): the next call starts a new pool
+        shutdown_workers()
+        raise
+
+def _get_executor(n_jobs):
+    '''
+    The pool of worker processes, started on the first call and reused by the following ones.
+    Only one pool is kept: it is replaced by a larger one when more workers are requested. A smaller n_jobs reuses the pool
+    (a call never runs more than n_jobs chunks of blocks at once, see _map_blocks()).
+    '''
+    global _executor, _n_workers
+    if _executor is None or _n_workers < n_jobs:
+        shutdown_workers()
+        # workers share the resource tracker of this process: shared memory they attach to is not unlinked when they exit
+        resource_tracker.ensure_running()
+        _executor = ProcessPoolExecutor(max_workers=n_jobs)
+        _n_workers = n_jobs
+    return _executor
+
+def shutdown_workers():
+    '''
+    Stops the worker processes kept between parallel calls (n_jobs > 1), e.g. at the end of an analysis.
+    The next parallel call starts a new pool.
+    '''
+    global _executor, _n_workers
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+    _executor = None
+    _n_workers = 0
+
+_executor = None
+_n_workers = 0
+
+
+#####################################
+### Metabolome values in shared memory
+#####################################
+def get_shared_values(store):
+    '''
+    Returns the SharedMetabolomeValues of a store: created on the first call and reused by the following calls on the same store.
+    The shared memory is released when the store is garbage collected or modified in place (see metabolome_storage.release_shared_values()).
+    '''
+    shared_values = getattr(store, "_shared_values", None)
+    if shared_values is None or shared_values.spec is None:
+        shared_values = SharedMetabolomeValues(store)
+        store._shared_values = shared_values
+        weakref.finalize(store, shared_values.close)
+    return shared_values
+
+class SharedMetabolomeValues:
+    '''
+    The selected values of a metabolome store made available to worker processes without pickling.
+
+    - Memory-mapped stores: workers open the same file (the values are not copied). This is only done when the file
+      holds the current values: read-only arrays, or writable arrays ('r+' mode) that are flushed first.
+      Copy-on-write arrays (e.g. loaded from the MetabolomeCache) may hold changes that are not in the file: they are copied like dense stores.
+    - Sparse stores: the data, indices and indptr arrays of the CSR matrix are copied once in shared memory.
+    - Dense in-memory stores: the values are copied once in shared memory.
+    The copy belongs to the store: a filtered store (a new store) gets its own copy, and shared memory is used for
+    the values of each store that is alive and was used in a parallel call.
+
+    Use get_shared_values() to reuse the shared values of a store, or as a context manager: the shared memory is released on exit.
+
+    Attributes
+    ----------
+    spec: tuple
+        What a worker needs to attach to the values (see _attach_values()). None once released.
+    '''
+    def __init__(self, store):
+        self._shared_memories = []
+        memmap_file = _get_memmap_file(store.values) if isinstance(store, MemmapMetabolomeStore) else None
+        if memmap_file is not None:
+            filename, offset = memmap_file
+            self.spec = ("memmap", filename, offset, store.values.dtype.str, store.values.shape, store.rows, store.cols)
+        elif isinstance(store, SparseMetabolomeStore):
+            values = store.get_values()
+            self.spec = ("sparse", values.shape, [self._share(array) for array in (values.data, values.indices, values.indptr)])
+        elif isinstance(store, MemmapMetabolomeStore):
+            # only the selected rows and columns are copied
+            self.spec = ("dense", self._share(store.to_numpy()))
+        else:
+            self.spec = ("dense", self._share(store.get_values()))
+
+    def _share(self, array):
+        array = np.asarray(array)
+        shared_memory_block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        self._shared_memories.append(shared_memory_block)
+        shared_array = np.ndarray(array.shape, dtype=array.dtype, buffer=shared_memory_block.buf)
+        shared_array[...] = array
+        del shared_array
+        return (shared_memory_block.name, array.dtype.str, array.shape)
+
+    def close(self):
+        for shared_memory_block in self._shared_memories:
+            shared_memory_block.close()
+            shared_memory_block.unlink()
+        self._shared_memories = []
+        self.spec = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def _get_memmap_file(values):
+    '''
+    Returns (filename, offset) of the file of a memory-mapped array covering all of its memory when the file holds 
+    the current values ('r' mode, or 'r+' and 'w+' modes after a flush). Returns None otherwise (e.g. copy-on-write 'c' mode).
+    '''
+    base = values
+    while isinstance(base, np.ndarray):
+        if isinstance(base, np.memmap) and getattr(base, "filename", None) is not None:
+            if base.nbytes != values.nbytes or not values.flags.c_contiguous or not np.shares_memory(base, values):
+                return None
+            if base.mode == 'r':
+                return base.filename, base.offset
+            if base.mode in ('r+', 'w+'):
+                base.flush()
+                return base.filename, base.offset
+            return None
+        # the chain ends at the buffer owner (e.g. a mmap.mmap object), which has no base
+        base = getattr(base, "base", None)
+    return None
+
+
+##################
+### Worker process
+##################
+def _attach_values(spec):
+    if spec[0] == "memmap":
+        _, filename, offset, dtype, shape, rows, cols = spec
+        values = np.memmap(filename, dtype=np.dtype(dtype), mode='r', offset=offset, shape=shape)
+        return values, rows, cols, []
+    if spec[0] == "sparse":
+        _, shape, arrays = spec
+        attached = [_attach_array(*array) for array in arrays]
+        values = sparse.csr_matrix(tuple(array for array, _ in attached), shape=shape, copy=False)
+        return values, None, None, [shared_memory_block for _, shared_memory_block in attached]
+    values, shared_memory_block = _attach_array(*spec[1])
+    return values, None, None, [shared_memory_block]
+
+def _attach_array(name, dtype, shape):
+    shared_memory_block = shared_memory.SharedMemory(name=name)
+    return np.ndarray(shape, dtype=np.dtype(dtype), buffer=shared_memory_block.buf), shared_memory_block
+
+def _run_block(task):
+    spec, func, axis, positions, kwargs, pass_bounds, (start, stop) = task
+    values, rows, cols, shared_memory_blocks = _attach_values(spec)
+    if axis == 0:
+        row_positions = np.arange(start, stop)
+        col_positions = positions
+    else:
+        row_positions = positions
+        col_positions = np.arange(start, stop)
+    # positions are relative to the selected rows and columns of memory-mapped stores
+    if rows is not None:
+        row_positions = rows[row_positions]
+        col_positions = cols[col_positions]
+    # fancy indexing copies the values of the block: the shared memory can be detached before running func
+    if sparse.issparse(values):
+        block_values = values[row_positions][:, col_positions]
+    else:
+        block_values = values[np.ix_(row_positions, col_positions)]
+    del values
+    for shared_memory_block in shared_memory_blocks:
+        shared_memory_block.close()
+    if pass_bounds:
+        return func(block_values, start, stop, **kwargs)
+    return func(block_values, **kwargs)
@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+
+import numpy as np
+from scipy import sparse
+
+
+class KLLSketch:
+    '''
+    A KLL quantile sketch (Karnin, Lang and Liberty, 2016): a compact summary of a stream of values
+    that gives approximate quantiles with a bounded rank error.
+
+    The sketch can be updated chunk by chunk (only the sketch is kept in memory, not the values) and
+    sketches built on different chunks (e.g. by different worker processes) can be merged.
+    Its size grows with k and only logarithmically with the number of values.
+
+    Values are kept in levels (compactors): a value at level h stands for 2**h values of the stream.
+    When a level is full, it is sorted and every other value (random offset) is promoted to the next level.
+
+    Rank error guarantee: with probability 99%, the rank of a returned quantile differs from the requested rank
+    by at most normalized_rank_error * n values (about 1.65% of n for k=200, 0.35% for k=1000), whatever the number of values.
+    The minimum and maximum values are exact.
+
+    Parameters
+    ----------
+    k: int, optional
+        Size parameter of the sketch: larger values are more accurate (default is 200).
+    random_state: int, optional
+        Seed of the random offsets of the compactions (default is None: not reproducible).
+
+    Attributes
+    ----------
+    n: int
+        Number of values summarised by the sketch.
+    has_nan: bool
+        Were missing values (NaN) added? Quantiles are then NaN, like numpy.percentile().
+
+    Example
+    -------
+    >>> sketch = KLLSketch(k=200)
+    >>> for chunk in chunks:
+            sketch.update(chunk)
+    >>> sketch.merge(other_sketch)
+    >>> sketch.percentile(90)
+
+    References
+    ----------
+    Karnin, Lang and Liberty (2016) Optimal quantile approximation in streams. https://arxiv.org/abs/1603.05346
+    Apache DataSketches KLL sketch: https://datasketches.apache.org/docs/KLL/KLLSketch.html
+    '''
+    def __init__(self, k=200, random_state=None):
+        if k < 8:
+            raise ValueError("The size parameter k of the sketch should be at least 8.")
+        self.k = k
+        self.n = 0
+        self.has_nan = False
+        self.min_value = np.inf
+        self.max_value = -np.inf
+        self.levels = [np.zeros(0)]
+        self._rng = np.random.default_rng(random_state)
+
+    @property
+    def normalized_rank_error(self):
+        '''
+        Bound of the rank error of quantiles as a fraction of n (99% confidence, empirical formula of Apache DataSketches).
+        '''
+        return 2.446 / self.k ** 0.9433
+
+    @property
+    def n_retained(self):
+        return sum(level.size for level in self.levels)
+
+    def update(self, values):
+        '''
+        Adds values to the sketch: numpy array, pandas object or scipy sparse matrix (all values, flattened).
+        Zeros of a sparse matrix that are not stored are added as weighted items (never densified).
+        '''
+        if sparse.issparse(values):
+            values = sparse.csr_matrix(values)
+            self.update_with_repeated_value(0.0, values.shape[0] * values.shape[1] - values.nnz)
+            values = values.data
+        values = np.asarray(values, dtype=np.float64).ravel()
+        is_nan = np.isnan(values)
+        if is_nan.any():
+            self.has_nan = True
+            values = values[~is_nan]
+        if values.size == 0:
+            return self
+        self.n += values.size
+        self.min_value = min(self.min_value, values.min())
+        self.max_value = max(self.max_value, values.max())
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self._compress()
+        return self
+
+    def update_with_repeated_value(self, value, count):
+        '''
+        Adds count times the same value: one item is placed at each level h where bit h of count is set (weight 2**h).
+        '''
+        if count <= 0:
+            return self
+        if np.isnan(value):
+            self.has_nan = True
+            return self
+        self.n += count
+        self.min_value = min(self.min_value, value)
+        self.max_value = max(self.max_value, value)
+        for level in range(int(count).bit_length()):
+            if (count >> level) & 1:
+                self._ensure_level(level)
+                self.levels[level] = np.append(self.levels[level], value)
+        self._compress()
+        return self
+
+    def merge(self, other):
+        '''
+        Adds the values summarised by another sketch (e.g. built on another chunk or by another worker).
+        '''
+        self.n += other.n
+        self.has_nan = self.has_nan or other.has_nan
+        self.min_value = min(self.min_value, other.min_value)
+        self.max_value = max(self.max_value, other.max_value)
+        self._ensure_level(len(other.levels) - 1)
+        for level, items in enumerate(other.levels):
+            self.levels[level] = np.concatenate([self.levels[level], items])
+        self._compress()
+        return self
+
+    def quantile(self, q):
+        '''
+        Approximate q-th quantile (0 <= q <= 1), with the linear interpolation of numpy.percentile() between ranks.
+        '''
+        if not 0 <= q <= 1:
+            raise ValueError("Quantiles should be comprised between 0 and 1.")
+        if self.has_nan:
+            return np.nan
+        if self.n == 0:
+            raise IndexError("Cannot compute the quantile of an empty sketch.")
+        items, cumulative_weights = self._sorted_items()
+        position = (self.n - 1) * q
+        lower = int(np.floor(position))
+        upper = min(lower + 1, self.n - 1)
+        lower_value = self._value_at_rank(items, cumulative_weights, lower)
+        return lower_value + (self._value_at_rank(items, cumulative_weights, upper) - lower_value) * (position - lower)
+
+    def percentile(self, my_percentile=50):
+        '''
+        Approximate percentile (between 0 and 100). See quantile().
+        '''
+        return self.quantile(my_percentile / 100)
+
+    def rank(self, value):
+        '''
+        Approximate fraction of the values lower or equal to value.
+        '''
+        if self.n == 0:
+            raise IndexError("Cannot compute the rank in an empty sketch.")
+        items, cumulative_weights = self._sorted_items()
+        position = np.searchsorted(items, value, side='right')
+        return (cumulative_weights[position - 1] if position > 0 else 0) / self.n
+
+    def _value_at_rank(self, items, cumulative_weights, rank):
+        # the extremes are exact
+        if rank == 0:
+            return self.min_value
+        if rank == self.n - 1:
+            return self.max_value
+        return items[min(np.searchsorted(cumulative_weights, rank, side='right'), items.size - 1)]
+
+    def _sorted_items(self):
+        items = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(level.size, 2**h, dtype=np.int64) for h, level in enumerate(self.levels)])
+        order = np.argsort(items, kind='stable')
+        return items[order], np.cumsum(weights[order])
+
+    def _ensure_level(self, level):
+        while len(self.levels) <= level:
+            self.levels.append(np.zeros(0))
+
+    def _capacity(self, level):
+        # the top level has capacity k, lower levels decrease geometrically (factor 2/3) down to 8 items
+        depth = len(self.levels) - 1 - level
+        return max(int(np.ceil(self.k * (2 / 3) ** depth)), 8)
+
+    def _compress(self):
+        while self.n_retained > sum(self._capacity(level) for level in range(len(self.levels))):
+            for level in range(len(self.levels)):
+                if self.levels[level].size >= self._capacity(level):
+                    break
+            items = np.sort(self.levels[level])
+            # an odd item stays at its level
+            if items.size % 2 == 1:
+                kept, items = items[:1], items[1:]
+            else:
+                kept = items[:0]
+            self._ensure_level(level + 1)
+            self.levels[level] = kept
+            self.levels[level + 1] = np.concatenate([self.levels[level + 1], items[self._rng.integers(2)::2]])
+
+
+def sketch_per_group(values, group_codes, n_groups, k=200, random_state=None, features=None):
+    '''
+    One KLL sketch of the values of each group of samples (columns) of a block of features.
+    Used to compute the percentile of each group over blocks of features (see merge_sketches()).
+
+    Parameters
+    ----------
+    values: `numpy.ndarray` or `scipy.sparse.spmatrix`, (n_features, n_samples)
+        The values of a block of features.
+    group_codes: `numpy.ndarray`, (n_samples,)
+        Integer code of the group of each sample.
+    features: `numpy.ndarray`, optional
+        Boolean mask of the features of the block to add (default is None: all features).
+
+    Returns
+    -------
+    list of KLLSketch, (n_groups,)
+    '''
+    if features is not None:
+        values = values[np.flatnonzero(features)]
+    group_codes = np.asarray(group_codes)
+    sketches = []
+    for group_code in range(n_groups):
+        sketch = KLLSketch(k=k, random_state=random_state)
+        sketch.update(values[:, np.flatnonzero(group_codes == group_code)])
+        sketches.append(sketch)
+    return sketches
+
+def merge_sketches(sketches_per_block):
+    '''
+    Merges the sketches of each group computed on blocks of features (list of lists of sketches, one list per block).
+    Returns one sketch per group.
+    '''
+    merged = None
+    for sketches in sketches_per_block:
+        if merged is None:
+            merged = sketches
+        else:
+            for merged_sketch, sketch in zip(merged, sketches):
+                merged_sketch.merge(sketch)
+    return merged
+
+
+###########################################################
+### Exact percentiles from the brackets of quantile sketches
+###########################################################
+def bracket_percentile(sketch, my_percentile, margin=2):
+    '''
+    Values (lower, upper) around the percentile of the values summarised by a sketch: the approximate quantiles at ranks
+    margin times the rank error bound of the sketch below and above the percentile.
+    The exact percentile lies between them unless the sketch error is larger than its bound (see KLLSketch).
+    '''
+    q = my_percentile / 100
+    rank_error = margin * sketch.normalized_rank_error
+    return sketch.quantile(max(q - rank_error, 0)), sketch.quantile(min(q + rank_error, 1))
+
+def count_in_bracket(values, lower, upper):
+    '''
+    Counts the values lower than lower, equal to lower and equal to upper and returns the values strictly between them
+    (missing values are ignored). Zeros of a sparse matrix that are not stored are counted without densifying it.
+    Summed over blocks of values, the result gives exact percentiles (see percentile_from_bracket()).
+
+    Returns
+    -------
+    counts: `numpy.ndarray`, (3,)
+        Number of values lower than lower, equal to lower and equal to upper (0 when upper is lower).
+    inside: `numpy.ndarray`
+        The values strictly between lower and upper.
+    '''
+    n_implicit_zeros = 0
+    if sparse.issparse(values):
+        values = sparse.csr_matrix(values)
+        n_implicit_zeros = values.shape[0] * values.shape[1] - values.nnz
+        values = values.data
+    values = np.asarray(values).ravel()
+    counts = np.array([
+        np.count_nonzero(values < lower),
+        np.count_nonzero(values == lower),
+        np.count_nonzero(values == upper) if upper > lower else 0], dtype=np.int64)
+    inside = values[(values > lower) & (values < upper)]
+    if n_implicit_zeros > 0:
+        if 0 < lower:
+            counts[0] += n_implicit_zeros
+        elif 0 == lower:
+            counts[1] += n_implicit_zeros
+        elif 0 == upper:
+            counts[2] += n_implicit_zeros
+        elif 0 < upper:
+            inside = np.concatenate([inside, np.zeros(n_implicit_zeros, dtype=inside.dtype)])
+    return counts, inside
+
+def percentile_from_bracket(n_values, my_percentile, lower, upper, counts, inside):
+    '''
+    Exact percentile of n_values values (same linear interpolation as numpy.percentile()) from the counts and the values
+    inside the bracket returned by count_in_bracket() for all of them.
+    Returns None when an order statistic of the percentile is outside of the bracket.
+    '''
+    q = np.true_divide(my_percentile, 100)
+    position = (n_values - 1) * q
+    previous_rank = int(np.floor(position))
+    inside = np.sort(inside)
+    order_statistics = []
+    for rank in (previous_rank, min(previous_rank + 1, n_values - 1)):
+        offset = rank - counts[0]
+        if offset < 0:
+            return None
+        if offset < counts[1]:
+            order_statistics.append(lower)
+            continue
+        offset -= counts[1]
+        if offset < inside.size:
+            order_statistics.append(inside[offset])
+            continue
+        offset -= inside.size
+        if offset < counts[2]:
+            order_statistics.append(upper)
+            continue
+        return None
+    # the interpolation of numpy between two consecutive order statistics
+    return np.quantile(np.array(order_statistics, dtype=inside.dtype), position - previous_rank)
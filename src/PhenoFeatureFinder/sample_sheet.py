@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import pandas as pd
+
+from phenofeaturefinder.utils import get_group_codes_from_sample_names
+
+
+class SampleSheet:
+    '''
+    A registry of the samples of the metabolome: the group (e.g. genotype) and the biological replicate of each sample.
+
+    The sample sheet is built once from the sample names (column names of the metabolome) or from an external
+    sample metadata .csv file. Groups are stored as integer codes so that methods can select the samples
+    of a group without parsing sample names again. Building the sheet costs O(n_samples): the feature matrix is never used.
+
+    Parameters
+    ----------
+    sample_names: list-like
+        The sample names, in the order of the metabolome columns.
+    groups: list-like
+        The group of each sample.
+    replicates: list-like, optional
+        The biological replicate of each sample (default is None: no replicate information).
+    separator_replicates: str, optional
+        The separator used to derive the groups from the sample names (default is None: groups given explicitly).
+
+    Attributes
+    ----------
+    sample_names: `pandas.core.indexes.base.Index`, (n_samples,)
+        The sample names.
+    group_codes: `numpy.ndarray`, (n_samples,)
+        Integer code of the group of each sample (groups are numbered in order of first appearance).
+    group_names: `pandas.core.indexes.base.Index`, (n_groups,)
+        The name of each group. group_names[code] gives the group of a sample.
+    replicates: `pandas.core.indexes.base.Index`, (n_samples,)
+        The biological replicate of each sample (None if unknown).
+
+    Example
+    -------
+    >>> sheet = SampleSheet.from_sample_names(["MM_1", "MM_2", "LA1330_1"])
+    >>> sheet.group_codes
+    array([0, 0, 1])
+    >>> sheet.group_names
+    Index(['MM', 'LA1330'], dtype='object')
+    '''
+    def __init__(self, sample_names, groups, replicates=None, separator_replicates=None):
+        self.sample_names = pd.Index(sample_names)
+        self.group_codes, group_names = pd.factorize(pd.Index(groups))
+        self.group_names = pd.Index(group_names)
+        self.replicates = None if replicates is None else pd.Index(replicates)
+        self.separator_replicates = separator_replicates
+        if len(self.group_codes) != len(self.sample_names):
+            raise ValueError("The number of groups should be equal to the number of sample names.")
+
+    @classmethod
+    def from_sample_names(cls, sample_names, separator_replicates='_'):
+        '''
+        Creates a sample sheet from sample names such as 'MM_1':
+        the group is the part of the sample name before the first separator and the replicate the part after it.
+        '''
+        sample_names = pd.Index(sample_names)
+        group_codes, group_names = get_group_codes_from_sample_names(sample_names, separator_replicates=separator_replicates)
+        replicates = sample_names.astype(str).str.split(pat=separator_replicates, n=1).str[1]
+        return cls(sample_names, group_names[group_codes], replicates=replicates, separator_replicates=separator_replicates)
+
+    @classmethod
+    def from_csv(cls, sample_metadata_csv, sample_col='sample', group_col='genotype', replicate_col=None):
+        '''
+        Creates a sample sheet from a sample metadata .csv file with one row per sample.
+
+        Parameters
+        ----------
+        sample_metadata_csv: str
+            A path to a .csv file with the sample metadata.
+        sample_col: str, optional
+            The column with the sample names as in the metabolome file (default is 'sample').
+        group_col: str, optional
+            The column with the group of each sample (default is 'genotype').
+        replicate_col: str, optional
+            The column with the biological replicate of each sample (default is None).
+        '''
+        usecols = [sample_col, group_col] if replicate_col is None else [sample_col, group_col, replicate_col]
+        sample_metadata = pd.read_csv(sample_metadata_csv, usecols=usecols, dtype=str)
+        if sample_metadata[sample_col].duplicated().any():
+            raise ValueError("Sample names in the sample metadata file should be unique (column '{0}').".format(sample_col))
+        replicates = None if replicate_col is None else sample_metadata[replicate_col]
+        return cls(sample_metadata[sample_col], sample_metadata[group_col], replicates=replicates)
+
+    @property
+    def n_samples(self):
+        return len(self.sample_names)
+
+    @property
+    def n_groups(self):
+        return len(self.group_names)
+
+    @property
+    def groups(self):
+        '''
+        The group name of each sample.
+        '''
+        return self.group_names[self.group_codes]
+
+    def get_group_samples(self, group_code):
+        '''
+        Returns the names of the samples of the group with integer code group_code.
+        '''
+        return self.sample_names[self.group_codes == group_code]
+
+    def is_valid_for(self, sample_names, separator_replicates=None):
+        '''
+        Is the sample sheet describing exactly these sample names (same order)?
+        Sheets derived from sample names also need to be derived with the same separator.
+        '''
+        if self.separator_replicates is not None and self.separator_replicates != separator_replicates:
+            return False
+        return self.sample_names.equals(pd.Index(sample_names))
+
+    def select_samples(self, sample_names):
+        '''
+        Returns a new sample sheet with only the selected samples, in the order of sample_names.
+        Group names keep their first appearance order among the selected samples.
+        '''
+        positions = self.sample_names.get_indexer(pd.Index(sample_names))
+        if np.any(positions < 0):
+            missing_samples = pd.Index(sample_names)[positions < 0].tolist()
+            raise ValueError("These samples are not present in the sample sheet: {0}".format(missing_samples))
+        replicates = None if self.replicates is None else self.replicates[positions]
+        return SampleSheet(self.sample_names[positions], self.groups[positions], replicates=replicates, separator_replicates=self.separator_replicates)
+
+    def to_frame(self, name_grouping_var='genotype'):
+        '''
+        Returns a dataframe with the correspondence between samples, grouping variable and replicates
+        (columns 'sample', name_grouping_var and 'rep', one row per sample).
+        '''
+        samples_to_conditions = pd.DataFrame({"sample": self.sample_names, name_grouping_var: self.groups})
+        if self.replicates is not None:
+            samples_to_conditions["rep"] = self.replicates
+        return samples_to_conditions
@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+
+import warnings
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from phenofeaturefinder.parallel import map_feature_blocks
+from phenofeaturefinder.utils import max_per_group
+
+
+STATISTICS = ("n_detected", "n_nonzero", "n_missing", "sum", "max", "min_positive", "max_positive", "median")
+
+
+class StatisticsCube:
+    '''
+    Per-feature and per-group statistics of the metabolome (feature x group x statistic), shared by filters and plots.
+
+    Each statistic is computed the first time it is asked for (see get()), in one pass over blocks of features of the store
+    that only computes this statistic:
+      - n_detected: number of values > 0 (reliability filter).
+      - n_nonzero: number of values different from zero (sparsity).
+      - n_missing: number of missing values (NaN).
+      - sum: sum of the values ignoring missing values (blank filter).
+      - max: maximum value, NaN if the feature has a missing value in the group (percentile filter).
+      - min_positive and max_positive: range of the values > 0, NaN if none (density plot).
+      - median: median ignoring missing values (presence if median > 0, see get_presence()).
+    Counts, sums and maxima are grouped reductions over the sample axis: the per-group medians, which need a sort
+    of the values of each group, are only computed when they are asked for.
+
+    Removing features only removes rows of the cube and removing whole groups of samples only removes groups:
+    the cube is then updated without reading the values again. Appending samples only reads the new values
+    (see append_samples()). Other changes of the values require a new cube.
+
+    Parameters
+    ----------
+    values: `numpy.ndarray`, (n_features, n_groups, n_statistics)
+        The statistics, in the order of STATISTICS (NaN for the statistics that are not computed yet).
+    index: `pandas.core.indexes.base.Index`
+        The feature identifiers.
+    sample_names: `pandas.core.indexes.base.Index`
+        The sample names the statistics were computed on.
+    sample_groups: `pandas.core.indexes.base.Index`
+        The group of each sample.
+    group_names: `pandas.core.indexes.base.Index`
+        The name of each group, in the order of the second axis of values.
+    computed: `numpy.ndarray`, (n_statistics,), optional
+        Which statistics of values are computed (default is None: all of them).
+
+    Attributes
+    ----------
+    store: object
+        The metabolome store described by the cube (None for a cube loaded from disk and not attached yet).
+    block_size: int
+        Number of features read at once when a statistic is computed (default is 50000).
+    n_jobs: int
+        Number of processes used when a statistic is computed (default is 1).
+    '''
+    def __init__(self, values, index, sample_names, sample_groups, group_names, computed=None):
+        self.values = values
+        self.index = pd.Index(index)
+        self.sample_names = pd.Index(sample_names)
+        self.sample_groups = pd.Index(sample_groups)
+        self.group_names = pd.Index(group_names)
+        if computed is None:
+            computed = np.ones(len(STATISTICS), dtype=bool)
+        self.computed = np.asarray(computed, dtype=bool)
+        self.store = None
+        self.block_size = 50000
+        self.n_jobs = 1
+
+    @classmethod
+    def from_store(cls, store, sample_sheet, statistics=STATISTICS, block_size=50000, n_jobs=1):
+        '''
+        Computes the statistics of each feature and group of sample_sheet in one pass over blocks of features of store.
+        The other statistics are computed when they are asked for (see get()): with statistics=(), nothing is read yet.
+        '''
+        positions = store.columns.get_indexer(sample_sheet.sample_names)
+        values = np.full((store.shape[0], sample_sheet.n_groups, len(STATISTICS)), np.nan)
+        cube = cls(
+            values, store.index, store.columns[positions], sample_sheet.groups, sample_sheet.group_names,
+            computed=np.zeros(len(STATISTICS), dtype=bool))
+        cube.store = store
+        cube.block_size = block_size
+        cube.n_jobs = n_jobs
+        cube.compute(statistics)
+        return cube
+
+    def compute(self, statistics):
+        '''
+        Computes the statistics that are not computed yet in one pass over blocks of features of the store.
+        '''
+        statistics = [statistic for statistic in STATISTICS if statistic in statistics and not self.is_computed(statistic)]
+        if len(statistics) == 0:
+            return
+        if self.store is None:
+            raise ValueError("The statistics {0} are not computed and the cube is not attached to a metabolome.".format(statistics))
+        blocks = map_feature_blocks(
+            self.store, compute_block_group_statistics, n_jobs=self.n_jobs, block_size=self.block_size, columns=self.sample_names,
+            group_codes=self.group_names.get_indexer(self.sample_groups), n_groups=len(self.group_names), statistics=statistics)
+        positions = [STATISTICS.index(statistic) for statistic in statistics]
+        if len(blocks) > 0:
+            self.values[:, :, positions] = np.concatenate(blocks)
+        self.computed[positions] = True
+
+    def is_computed(self, statistic):
+        '''
+        Is the statistic already computed?
+        '''
+        return bool(self.computed[STATISTICS.index(statistic)])
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Loads a cube saved with save().
+        '''
+        with np.load(path, allow_pickle=False) as saved:
+            computed = saved["computed"] if "computed" in saved.files else None
+            return cls(saved["values"], saved["index"], saved["sample_names"], saved["sample_groups"], saved["group_names"], computed=computed)
+
+    def save(self, path):
+        '''
+        Saves the cube to a .npz file (e.g. next to the metabolome file). Labels are saved as strings.
+        '''
+        np.savez(
+            path,
+            values=self.values,
+            index=np.asarray(self.index.astype(str), dtype=str),
+            sample_names=np.asarray(self.sample_names.astype(str), dtype=str),
+            sample_groups=np.asarray(self.sample_groups.astype(str), dtype=str),
+            group_names=np.asarray(self.group_names.astype(str), dtype=str),
+            computed=self.computed)
+
+    def get(self, statistic, sample_sheet=None):
+        '''
+        Returns one statistic for all features and groups, (n_features, n_groups).
+        With a sample sheet, the groups are in the order of sample_sheet.group_names.
+        The statistic is computed from the store the first time it is asked for.
+        '''
+        self.compute([statistic])
+        values = self.values[:, :, STATISTICS.index(statistic)]
+        if sample_sheet is not None:
+            values = values[:, self.group_names.get_indexer(sample_sheet.group_names)]
+        return values
+
+    def get_presence(self, sample_sheet=None):
+        '''
+        Presence of each feature in each group, (n_features, n_groups): a feature is present in a group if its median value
+        in the group is > 0 (missing values ignored, absent if the group only has missing values).
+
+        For non-negative values, the median is > 0 if at least half of the non-missing values are > 0: the presence is obtained
+        from the numbers of detections and missing values, without computing the medians. The number of negative values
+        (non-zero values that are neither detected nor missing) is known from the same counts: with negative values,
+        the presence falls back to the medians.
+        '''
+        n_detected = self.get("n_detected", sample_sheet)
+        n_missing = self.get("n_missing", sample_sheet)
+        if np.any(self.get("n_nonzero", sample_sheet) - n_detected - n_missing > 0):
+            return self.get("median", sample_sheet) > 0
+        group_sizes = np.bincount(self.group_names.get_indexer(self.sample_groups), minlength=len(self.group_names))
+        if sample_sheet is not None:
+            group_sizes = group_sizes[self.group_names.get_indexer(sample_sheet.group_names)]
+        n_non_missing = group_sizes - n_missing
+        return (n_non_missing > 0) & (2 * n_detected >= n_non_missing)
+
+    def is_valid_for(self, store, sample_sheet):
+        '''
+        Does the cube describe this store with the groups of this sample sheet?
+        '''
+        return (
+            self.store is store
+            and self.sample_names.equals(sample_sheet.sample_names)
+            and self.sample_groups.equals(sample_sheet.groups))
+
+    def matches(self, store, sample_sheet):
+        '''
+        Do the labels of the cube (e.g. loaded from disk) match this store and sample sheet? Labels are compared as strings.
+        '''
+        return (
+            self.index.equals(store.index.astype(str))
+            and self.sample_names.equals(pd.Index(sample_sheet.sample_names).astype(str))
+            and self.sample_groups.equals(pd.Index(sample_sheet.groups).astype(str)))
+
+    def get_groups_of_samples(self, sample_names):
+        '''
+        Returns the groups whose samples are exactly sample_names (None if sample_names is not a union of whole groups).
+        '''
+        is_selected = self.sample_names.isin(list(sample_names))
+        if np.count_nonzero(is_selected) != len(set(sample_names)):
+            return None
+        selected_groups = self.sample_groups[is_selected].unique()
+        if self.sample_groups.isin(selected_groups).sum() != np.count_nonzero(is_selected):
+            return None
+        return selected_groups
+
+    def select_features(self, features_to_keep, columns_to_drop=None, store=None):
+        '''
+        Returns the cube of the selected features (and without the columns_to_drop samples) for the new store.
+        Returns None if columns_to_drop is not a union of whole groups (the statistics of the groups would change).
+        '''
+        features_to_keep = np.asarray(features_to_keep, dtype=bool)
+        groups_to_keep = np.ones(len(self.group_names), dtype=bool)
+        samples_to_keep = np.ones(len(self.sample_names), dtype=bool)
+        if columns_to_drop is not None and len(columns_to_drop) > 0:
+            dropped_groups = self.get_groups_of_samples(columns_to_drop)
+            if dropped_groups is None:
+                return None
+            groups_to_keep = ~self.group_names.isin(dropped_groups)
+            samples_to_keep = ~self.sample_names.isin(list(columns_to_drop))
+        cube = StatisticsCube(
+            self.values[features_to_keep][:, groups_to_keep], self.index[features_to_keep],
+            self.sample_names[samples_to_keep], self.sample_groups[samples_to_keep], self.group_names[groups_to_keep],
+            computed=self.computed.copy())
+        cube.store = store
+        cube.block_size = self.block_size
+        cube.n_jobs = self.n_jobs
+        return cube
+
+    def append_samples(self, samples, sample_groups, store, block_size=50000):
+        '''
+        Returns the cube of store after the samples were appended to the metabolome described by this cube.
+
+        Only the new values are read: counts and sums are added, maxima and ranges are combined with the ones of the cube
+        and new groups are added. Medians cannot be combined: they are computed again from the columns of the existing
+        groups that received new samples only (the other groups are not read). Statistics that are not computed yet
+        stay so.
+
+        Parameters
+        ----------
+        samples: `pandas.core.frame.DataFrame`, (n_features, n_new_samples)
+            The values of the new samples, with the features of the cube (same order).
+        sample_groups: list-like, (n_new_samples,)
+            The group of each new sample.
+        store: object
+            The metabolome store with all samples (the samples of the cube followed by the new samples).
+        '''
+        sample_groups = pd.Index(sample_groups)
+        new_group_names = sample_groups.unique()
+        group_names = self.group_names.append(new_group_names[~new_group_names.isin(self.group_names)])
+        group_codes = group_names.get_indexer(sample_groups)
+        n_groups = len(group_names)
+        n_existing_groups = len(self.group_names)
+        statistics = [statistic for statistic in STATISTICS if self.is_computed(statistic)]
+        combined_statistics = [statistic for statistic in statistics if statistic != "median"]
+
+        combined_positions = [STATISTICS.index(statistic) for statistic in combined_statistics]
+        new_statistics = np.full((samples.shape[0], n_groups, len(STATISTICS)), np.nan)
+        for start in range(0, samples.shape[0], block_size):
+            new_statistics[start:start + block_size, :, combined_positions] = compute_block_group_statistics(
+                samples.iloc[start:start + block_size].to_numpy(), group_codes, n_groups, statistics=combined_statistics)
+
+        values = np.concatenate([self.values, new_statistics[:, n_existing_groups:]], axis=1)
+        updated_groups = np.unique(group_codes[group_codes < n_existing_groups])
+        old = self.values[:, updated_groups]
+        new = new_statistics[:, updated_groups]
+        combined = values[:, updated_groups]
+        for statistic in ("n_detected", "n_nonzero", "n_missing", "sum"):
+            position = STATISTICS.index(statistic)
+            combined[:, :, position] = old[:, :, position] + new[:, :, position]
+        position = STATISTICS.index("max")
+        combined[:, :, position] = np.maximum(old[:, :, position], new[:, :, position])
+        position = STATISTICS.index("min_positive")
+        combined[:, :, position] = np.fmin(old[:, :, position], new[:, :, position])
+        position = STATISTICS.index("max_positive")
+        combined[:, :, position] = np.fmax(old[:, :, position], new[:, :, position])
+
+        sample_names = self.sample_names.append(pd.Index(samples.columns))
+        all_sample_groups = self.sample_groups.append(sample_groups)
+        if "median" in statistics:
+            position = STATISTICS.index("median")
+            # groups with new samples only: medians of the new values
+            is_in_new_group = group_codes >= n_existing_groups
+            for start in range(0, samples.shape[0], block_size):
+                values[start:start + block_size, n_existing_groups:, position] = median_per_group(
+                    samples.iloc[start:start + block_size, is_in_new_group].to_numpy(),
+                    group_codes[is_in_new_group] - n_existing_groups, n_groups - n_existing_groups)
+            if updated_groups.size > 0:
+                is_in_updated_group = all_sample_groups.isin(group_names[updated_groups])
+                median_group_codes = pd.Index(group_names[updated_groups]).get_indexer(all_sample_groups[is_in_updated_group])
+                medians = [
+                    median_per_group(block, median_group_codes, updated_groups.size)
+                    for _, _, block in store.iter_feature_blocks(block_size=block_size, columns=sample_names[is_in_updated_group])]
+                if len(medians) > 0:
+                    combined[:, :, position] = np.concatenate(medians)
+        values[:, updated_groups] = combined
+
+        cube = StatisticsCube(values, self.index, sample_names, all_sample_groups, group_names, computed=self.computed.copy())
+        cube.store = store
+        cube.block_size = self.block_size
+        cube.n_jobs = self.n_jobs
+        return cube
+
+
+def compute_block_group_statistics(values, group_codes, n_groups, statistics=STATISTICS):
+    '''
+    Statistics of each feature and group of samples for one block of features (see StatisticsCube).
+    Only the requested statistics are computed: counts and sums are grouped sums over the sample axis
+    (scipy sparse matrices are not densified for them), the other statistics are computed group by group.
+
+    Returns
+    -------
+    `numpy.ndarray`, (n_features, n_groups, n_statistics)
+        The statistics in the order of STATISTICS, restricted to the requested ones.
+    '''
+    group_codes = np.asarray(group_codes)
+    statistics = [statistic for statistic in STATISTICS if statistic in statistics]
+    results = np.full((values.shape[0], n_groups, len(statistics)), np.nan)
+    dense_values = None
+    with warnings.catch_warnings():
+        # groups with only missing values give NaN
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        for position, statistic in enumerate(statistics):
+            if statistic == "n_detected":
+                results[:, :, position] = sum_per_group(values, group_codes, n_groups, lambda x: x > 0)
+            elif statistic == "n_nonzero":
+                results[:, :, position] = sum_per_group(values, group_codes, n_groups, lambda x: x != 0)
+            elif statistic == "n_missing":
+                results[:, :, position] = sum_per_group(values, group_codes, n_groups, np.isnan)
+            elif statistic == "sum":
+                results[:, :, position] = sum_per_group(values, group_codes, n_groups, lambda x: np.nan_to_num(x, nan=0.0))
+            elif statistic == "max":
+                results[:, :, position] = max_per_group(values, group_codes, n_groups)
+            else:
+                if dense_values is None:
+                    dense_values = values.toarray() if sparse.issparse(values) else np.asarray(values)
+                    dense_values = dense_values.astype(np.float64)
+                if statistic == "median":
+                    results[:, :, position] = median_per_group(dense_values, group_codes, n_groups)
+                    continue
+                for group_code in range(n_groups):
+                    group_positions = np.flatnonzero(group_codes == group_code)
+                    if group_positions.size == 0:
+                        continue
+                    group_values = dense_values[:, group_positions]
+                    positive_values = np.where(group_values > 0, group_values, np.nan)
+                    if statistic == "min_positive":
+                        results[:, group_code, position] = np.nanmin(positive_values, axis=1)
+                    else:
+                        results[:, group_code, position] = np.nanmax(positive_values, axis=1)
+    return results
+
+def sum_per_group(values, group_codes, n_groups, transform):
+    '''
+    Sum of transform(values) (e.g. a detection mask) of each feature and group of samples for one block of features, 
+    (n_features, n_groups). transform must map 0 to 0: for scipy sparse matrices, it is only applied to the stored values.
+    '''
+    if sparse.issparse(values):
+        values = sparse.csr_matrix(values, copy=True)
+        values.data = np.asarray(transform(values.data), dtype=np.float64)
+        # product with a (n_samples, n_groups) group membership matrix
+        membership = sparse.csr_matrix(
+            (np.ones(group_codes.size), (np.arange(group_codes.size), group_codes)), shape=(group_codes.size, n_groups))
+        return (values @ membership).toarray()
+    transformed = np.asarray(transform(np.asarray(values)))
+    sums = np.zeros((transformed.shape[0], n_groups))
+    # sort samples by group so that each group is a contiguous block of columns
+    # then sum each block in one call (groups without any sample get 0)
+    order = np.argsort(group_codes, kind='stable')
+    group_sizes = np.bincount(group_codes, minlength=n_groups)
+    non_empty_groups = np.flatnonzero(group_sizes > 0)
+    if non_empty_groups.size > 0 and transformed.shape[0] > 0:
+        block_starts = np.searchsorted(group_codes[order], non_empty_groups)
+        # counts of a boolean mask are summed as integers
+        dtype = np.int32 if transformed.dtype == bool else np.float64
+        sums[:, non_empty_groups] = np.add.reduceat(transformed[:, order], block_starts, axis=1, dtype=dtype)
+    return sums
+
+def median_per_group(values, group_codes, n_groups):
+    '''
+    Median of each feature and group of samples (missing values ignored) for one block of features, (n_features, n_groups).
+    '''
+    values = values.toarray() if sparse.issparse(values) else np.asarray(values)
+    values = values.astype(np.float64)
+    group_codes = np.asarray(group_codes)
+    medians = np.full((values.shape[0], n_groups), np.nan)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        for group_code in range(n_groups):
+            group_positions = np.flatnonzero(group_codes == group_code)
+            if group_positions.size > 0:
+                medians[:, group_code] = np.nanmedian(values[:, group_positions], axis=1)
+    return medians
@@ -1,12 +1,16 @@
 #!/usr/bin/env python3 
 
 import os
+import warnings
 from warnings import WarningMessage
 import numpy as np
 import pandas as pd
+from scipy import sparse
 import matplotlib.pyplot as plt
 from sklearn.metrics import balanced_accuracy_score, precision_score, recall_score, f1_score, confusion_matrix, ConfusionMatrixDisplay
 
+from phenofeaturefinder.quantile_sketch import KLLSketch, sketch_per_group
+
 def median_of_ratios_normalisation(_data : pd.DataFrame) -> pd.DataFrame:
     """
     Normalize a dataframe with the median of ratios method 
@@ -31,48 +35,128 @@ def median_of_ratios_normalisation(_data : pd.DataFrame) -> pd.DataFrame:
     StatQuest: https://www.youtube.com/watch?v=UFB993xufUU
     HBC Harvard: https://hbctraining.github.io/DGE_workshop/lessons/02_DGE_count_normalization.html
 
-    """
-    # step 1: log normalize
-    log_data = np.log(_data)
+    See also
+    --------
+    normalisation.MedianOfRatiosNormaliser: fit on chunks of features, in place transform and normalisation of new samples against a reference.
 
-    # step 2: average rows
-    row_avg = np.mean(log_data, axis=1)
-    
-    # step 3: filter rows with zeros
-    rows_no_zeros = row_avg[row_avg != -np.inf].index
-    
-    # step 4: subtract avg log counts from log counts
-    ratios = log_data.loc[rows_no_zeros].subtract(row_avg.loc[rows_no_zeros], axis=0)
-    
-    # step 5: calculate median of ratios
-    medians = ratios.median(axis=0)
-    
-    # step 6: median -> base number
-    scaling_factors = np.e ** medians
+    """
+    # steps 1 to 6: scaling factor per sample
+    scaling_factors = compute_median_of_ratios_scaling_factors(_data.to_numpy())
     
     # step 7: normalize!
     normalized_data = _data / scaling_factors
     return normalized_data
 
-def calculate_percentile(df, my_percentile=50):
+def compute_median_of_ratios_scaling_factors(values):
+    """
+    Compute the scaling factor of each sample with the median of ratios method from DESeq2.
+    See median_of_ratios_normalisation().
+
+    Only features without zero values are used to compute the ratios: 
+    with a scipy sparse matrix, these features are selected from the number of stored values per row
+    so that the matrix is never densified. 
+    Missing values (NaN) are ignored.
+
+    Parameters
+    ----------
+    values: `numpy.ndarray` or `scipy.sparse.spmatrix`, (n_features, n_samples)
+        The feature abundances.
+
+    Returns
+    -------
+    `numpy.ndarray`, (n_samples,)
+        The scaling factor of each sample. Normalised values are the values divided by the scaling factors.
+    """
+    # steps 3, 1 and 2: average log values of the rows without zeros 
+    features_without_zeros, row_avg = compute_log_means_of_features_without_zeros(values)
+
+    # steps 4 and 5: median of the ratios of each sample
+    if sparse.issparse(values):
+        values = sparse.csr_matrix(values)[np.flatnonzero(features_without_zeros)]
+    else:
+        values = np.asarray(values)[features_without_zeros]
+    medians = compute_median_of_log_ratios(values, row_avg=row_avg)
+
+    # step 6: median -> base number
+    scaling_factors = np.e ** medians
+    return scaling_factors
+
+def calculate_percentile(df, my_percentile=50, sketch_k=None, chunksize=100000):
     '''
     Compute the q-th percentile of data.
     Returns the q-th percentile of the array elements.
 
     Parameters
     ----------
+    df: pandas.core.DataFrame, pandas.core.Series, numpy.ndarray, scipy sparse matrix or quantile_sketch.KLLSketch
+        The values. The percentile is computed over all values (flattened).
+        A KLLSketch (e.g. merged from sketches of chunks of data) gives its approximate percentile.
     my_percentile: float, optional
         Percentile which must be between 0 and 100.
+    sketch_k: int, optional
+        If given, the percentile is approximated with a KLL quantile sketch of size parameter sketch_k 
+        updated chunk by chunk (bounded rank error, see quantile_sketch.KLLSketch). 
+        Default is None: exact percentile.
+    chunksize: int, optional
+        Number of rows added to the sketch at once (default is 100000).
       
     See also
     ---------
     numpy.percentile()
     https://numpy.org/doc/stable/reference/generated/numpy.percentile.html
+    quantile_sketch.KLLSketch
     '''
-    my_array = df.to_numpy()
+    if isinstance(df, KLLSketch):
+        return df.percentile(my_percentile)
+    if sketch_k is not None:
+        sketch = KLLSketch(k=sketch_k, random_state=0)
+        values = df if sparse.issparse(df) else np.asarray(df)
+        values = values.reshape(-1, 1) if values.ndim == 1 else values
+        for start in range(0, values.shape[0], chunksize):
+            sketch.update(values[start:start + chunksize])
+        return sketch.percentile(my_percentile)
+    if sparse.issparse(df):
+        return calculate_percentile_of_sparse_values(df, my_percentile=my_percentile)
+    my_array = np.asarray(df)
     percentile_of_df = np.percentile(my_array, my_percentile)
     return percentile_of_df
 
+def calculate_percentile_of_sparse_values(sparse_matrix, my_percentile=50):
+    '''
+    Compute the q-th percentile of all values of a scipy sparse matrix without densifying it. 
+    Gives the same result as numpy.percentile() (linear interpolation) on the dense matrix.
+
+    Only the stored values are sorted: the zeros that are not stored are accounted for by their number. 
+
+    Parameters
+    ----------
+    sparse_matrix: `scipy.sparse.spmatrix`
+        The values.
+    my_percentile: float, optional
+        Percentile which must be between 0 and 100.
+    '''
+    stored_values = np.sort(sparse.csr_matrix(sparse_matrix).data)
+    n_values = sparse_matrix.shape[0] * sparse_matrix.shape[1]
+    if n_values == 0:
+        raise IndexError("Cannot compute the percentile of an empty matrix.")
+    if np.isnan(stored_values).any():
+        return np.nan
+    # the sorted values are: stored negative values, zeros (stored or not), stored positive values
+    n_negatives = np.searchsorted(stored_values, 0, side='left')
+    n_positives_start = np.searchsorted(stored_values, 0, side='right')
+    n_zeros = n_values - n_negatives - (stored_values.size - n_positives_start)
+    def sorted_value(position):
+        if position < n_negatives:
+            return stored_values[position]
+        if position < n_negatives + n_zeros:
+            return 0.0
+        return stored_values[position - n_negatives - n_zeros + n_positives_start]
+    position = (n_values - 1) * my_percentile / 100
+    lower = int(np.floor(position))
+    upper = min(lower + 1, n_values - 1)
+    lower_value = sorted_value(lower)
+    return lower_value + (sorted_value(upper) - lower_value) * (position - lower)
+
 def compute_metrics_classification(y_predictions, y_trues, positive_class):
     '''
     Compute a series of metrics for classification tasks
@@ -147,7 +231,9 @@ def extract_samples_to_condition(df, name_grouping_var='genotype', separator_rep
     '''
     A utility function to extract the grouping factor (e.g. 'genotype') from sample names. 
     
-    Uses melting (wide to long) and split grouping variable from biological replicates using specified separator.
+    Splits the sample names (column names) into grouping variable and biological replicates using specified separator.
+    Only the column names are used (O(n_samples)): the feature matrix is not melted. 
+    See also sample_sheet.SampleSheet. 
     
     Parameters
     ----------
@@ -181,8 +267,538 @@ def extract_samples_to_condition(df, name_grouping_var='genotype', separator_rep
         | genotypeA_rep4     |   genotypeA    | rep4           |
         | etc.
     '''
-    melted_df = pd.melt(df.reset_index(), id_vars='feature_id', var_name="sample")
-    melted_df[[name_grouping_var, 'rep']] = melted_df["sample"].str.split(pat=separator_replicates, expand=True)
-    melted_df_parsed = melted_df.drop(["feature_id", "value"], axis=1)
-    melted_df_parsed_dedup = melted_df_parsed.drop_duplicates()
-    return melted_df_parsed_dedup
+    sample_names = pd.Index(df.columns).drop_duplicates()
+    split_sample_names = sample_names.astype(str).str.split(pat=separator_replicates, n=1)
+    samples_to_conditions = pd.DataFrame({
+        "sample": sample_names, 
+        name_grouping_var: split_sample_names.str[0], 
+        "rep": split_sample_names.str[1]})
+    return samples_to_conditions
+
+
+def get_group_codes_from_sample_names(sample_names, separator_replicates='_'):
+    '''
+    A utility function to convert sample names into integer group codes without melting the feature matrix.
+
+    The grouping factor (e.g. 'genotype') is the part of the sample name before the first separator.
+    Groups are numbered in order of first appearance.
+
+    Parameters
+    ----------
+    sample_names: list-like
+        The sample names e.g. the columns of the metabolome dataframe.
+    separator_replicates: str, optional
+        The separator between the grouping variable and the biological replicates (default is underscore '_')
+
+    Returns
+    -------
+    group_codes: `numpy.ndarray`, (n_samples,)
+        Integer code of the group of each sample. 
+    group_names: `pandas.core.indexes.base.Index`, (n_groups,)
+        The name of each group. group_names[code] gives the group of a sample. 
+
+    Example
+    -------
+    >>> get_group_codes_from_sample_names(["MM_1", "MM_2", "LA1330_1"])
+    (array([0, 0, 1]), Index(['MM', 'LA1330'], dtype='object'))
+    '''
+    groups = pd.Index(sample_names).astype(str).str.split(pat=separator_replicates, n=1).str[0]
+    group_codes, group_names = pd.factorize(groups)
+    return group_codes, pd.Index(group_names)
+
+def count_detections_per_group(values, group_codes, n_groups=None):
+    '''
+    Count, for every feature at once, the number of samples of each group in which the feature is detected (value > 0).
+
+    The counts are obtained with a grouped sum of the boolean (value > 0) mask over the sample axis.
+    Missing values (NaN) are not counted as detected. 
+
+    Parameters
+    ----------
+    values: `numpy.ndarray` or `scipy.sparse.spmatrix`, (n_features, n_samples)
+        The feature abundances. 
+    group_codes: `numpy.ndarray`, (n_samples,)
+        Integer group code of each sample (see get_group_codes_from_sample_names()).
+    n_groups: int, optional
+        The number of groups. Default is the highest group code + 1. 
+
+    Returns
+    -------
+    `numpy.ndarray`, (n_features, n_groups)
+        Number of detections per feature and group. 
+    '''
+    group_codes = np.asarray(group_codes)
+    if n_groups is None:
+        n_groups = int(group_codes.max()) + 1 if group_codes.size > 0 else 0
+    if sparse.issparse(values):
+        # product of the detection mask with a (n_samples, n_groups) group membership matrix
+        membership = sparse.csr_matrix(
+            (np.ones(group_codes.size, dtype=np.int32), (np.arange(group_codes.size), group_codes)),
+            shape=(group_codes.size, n_groups))
+        detected = sparse.csr_matrix(values > 0, dtype=np.int32)
+        return (detected @ membership).toarray().astype(np.int32)
+    detected = np.asarray(values) > 0
+    if n_groups == 0:
+        return np.zeros((detected.shape[0], 0), dtype=np.int32)
+
+    # sort samples by group so that each group is a contiguous block of columns
+    # then sum the detections of each block in one call
+    # groups without any sample get a count of 0
+    order = np.argsort(group_codes, kind='stable')
+    group_sizes = np.bincount(group_codes, minlength=n_groups)
+    non_empty_groups = np.flatnonzero(group_sizes > 0)
+    block_starts = np.searchsorted(group_codes[order], non_empty_groups)
+    counts = np.zeros((detected.shape[0], n_groups), dtype=np.int32)
+    if non_empty_groups.size > 0:
+        counts[:, non_empty_groups] = np.add.reduceat(detected[:, order], block_starts, axis=1, dtype=np.int32)
+    return counts
+
+def compute_log_means_of_features_without_zeros(values):
+    '''
+    Steps 1 to 3 of the median of ratios method (see compute_median_of_ratios_scaling_factors()): 
+    selects the features (rows) without zeros and computes the average of their log values. 
+    Works block by block of features on numpy arrays and scipy sparse matrices.
+
+    Returns
+    -------
+    features_without_zeros: `numpy.ndarray`, (n_features,)
+        Boolean mask of the features without zero values.
+    row_avg: `numpy.ndarray`, (n_features_without_zeros,)
+        Average log value of each feature without zeros (missing values ignored).
+    '''
+    if sparse.issparse(values):
+        values = sparse.csr_matrix(values)
+        values.eliminate_zeros()
+        features_without_zeros = values.getnnz(axis=1) == values.shape[1]
+        values_no_zeros = values[np.flatnonzero(features_without_zeros)].toarray()
+    else:
+        values = np.asarray(values)
+        features_without_zeros = ~np.any(values == 0, axis=1)
+        values_no_zeros = values[features_without_zeros]
+    with warnings.catch_warnings():
+        # features with only missing values give NaN 
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        row_avg = np.nanmean(np.log(values_no_zeros.astype(np.float64)), axis=1)
+    return features_without_zeros, row_avg
+
+def compute_median_of_log_ratios(values, row_avg):
+    '''
+    Steps 4 and 5 of the median of ratios method (see compute_median_of_ratios_scaling_factors()):
+    median over the features of the log ratios (log value - average log value of the feature) of each sample (column).
+    Works block by block of samples.
+
+    Parameters
+    ----------
+    values: `numpy.ndarray` or `scipy.sparse.spmatrix`, (n_features_without_zeros, n_samples)
+        The values of the features without zeros. 
+    row_avg: `numpy.ndarray`, (n_features_without_zeros,)
+        Average log value of each feature (see compute_log_means_of_features_without_zeros()).
+    '''
+    if sparse.issparse(values):
+        values = values.toarray()
+    with warnings.catch_warnings():
+        # samples with only missing values give NaN 
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        ratios = np.log(np.asarray(values).astype(np.float64)) - row_avg[:, np.newaxis]
+        return np.nanmedian(ratios, axis=0)
+
+def has_negative_values(values):
+    '''
+    Is there at least one negative value? Works on numpy arrays and scipy sparse matrices.
+    '''
+    if sparse.issparse(values):
+        return bool(np.any(values.data < 0))
+    return bool(np.any(values < 0))
+
+def sum_per_feature(values):
+    '''
+    Sum of the values of each feature (row), ignoring missing values. 
+    Works on numpy arrays and scipy sparse matrices.
+    '''
+    if sparse.issparse(values):
+        values = sparse.csr_matrix(values)
+        values.data = np.nan_to_num(values.data, nan=0.0)
+        return np.asarray(values.sum(axis=1)).ravel()
+    return np.nansum(values, axis=1)
+
+def max_per_feature(values):
+    '''
+    Maximum value of each feature (row). NaN if the feature has a missing value. 
+    Works on numpy arrays and scipy sparse matrices (zeros that are not stored are taken into account).
+    '''
+    if sparse.issparse(values):
+        values = sparse.csr_matrix(values)
+        has_missing_values = np.zeros(values.shape[0], dtype=bool)
+        nan_rows = np.repeat(np.arange(values.shape[0]), np.diff(values.indptr))[np.isnan(values.data)]
+        has_missing_values[nan_rows] = True
+        maximum = values.max(axis=1).toarray().ravel().astype(np.float64)
+        maximum[has_missing_values] = np.nan
+        return maximum
+    return np.max(values, axis=1)
+
+def max_per_group(values, group_codes, n_groups):
+    '''
+    Maximum value of each feature (row) within each group of samples. NaN if the feature has a missing value in the group. 
+    Groups without samples get -inf. Works on numpy arrays and scipy sparse matrices.
+
+    Returns
+    -------
+    `numpy.ndarray`, (n_features, n_groups)
+    '''
+    maximum = np.full((values.shape[0], n_groups), -np.inf)
+    for group_code in range(n_groups):
+        group_positions = np.flatnonzero(np.asarray(group_codes) == group_code)
+        if group_positions.size > 0:
+            maximum[:, group_code] = max_per_feature(values[:, group_positions])
+    return maximum
+
+def max_and_sketch_per_group(values, group_codes, n_groups, sketch_k=200, random_state=0):
+    '''
+    Maximum value of each feature within each group of samples (see max_per_group()) 
+    and one KLL quantile sketch of the values of each group (see quantile_sketch.sketch_per_group()).
+    Used to filter features by percentile in one pass over blocks of features, without gathering the values.
+    '''
+    return max_per_group(values, group_codes, n_groups), sketch_per_group(values, group_codes, n_groups, k=sketch_k, random_state=random_state)
+
+def median_per_sample(values, missing_values=np.nan):
+    '''
+    Median of each sample (column) ignoring the missing values. NaN for samples with only missing values.
+    '''
+    if sparse.issparse(values):
+        values = values.toarray()
+    values = np.array(values, dtype=np.float64)
+    if not pd.isna(missing_values):
+        values[values == missing_values] = np.nan
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        return np.nanmedian(values, axis=0)
+
+def count_presence_intersections(presence, group_names=None, top_k=None):
+    '''
+    Counts the features of each combination of groups (intersection) from a boolean presence matrix.
+
+    The presence of each feature is packed in a bitset (one bit per group) and read as unsigned 64-bit integer keys,
+    so that the intersections are counted with a single unique over integer keys. 
+
+    Parameters
+    ----------
+    presence: `numpy.ndarray`, (n_features, n_groups)
+        Boolean presence matrix (see statistics_cube.StatisticsCube.get_presence()).
+    group_names: list-like, optional
+        The name of each group (default is None: group codes).
+    top_k: int, optional
+        Only keep the top_k intersections with the most features (default is None: all intersections).
+
+    Returns
+    -------
+    `pandas.core.frame.DataFrame`
+        One row per intersection (sorted by decreasing number of features): one boolean column per group 
+        and the number of features in column 'n_features'.
+    '''
+    presence = np.asarray(presence, dtype=bool)
+    n_groups = presence.shape[1]
+    if group_names is None:
+        group_names = range(n_groups)
+    # pack 64 groups per key
+    n_keys = max(-(-n_groups // 64), 1)
+    packed = np.packbits(presence, axis=1, bitorder='little')
+    packed = np.pad(packed, ((0, 0), (0, n_keys * 8 - packed.shape[1])))
+    keys = np.ascontiguousarray(packed).view(np.uint64)
+    unique_keys, counts = np.unique(keys, axis=0, return_counts=True)
+    order = np.argsort(-counts, kind='stable')
+    if top_k is not None:
+        order = order[:top_k]
+    unique_presence = np.unpackbits(unique_keys[order].view(np.uint8), axis=1, count=n_groups, bitorder='little').astype(bool)
+    intersections = pd.DataFrame(unique_presence, columns=list(group_names))
+    intersections["n_features"] = counts[order]
+    return intersections
+
+def compute_group_log_histograms(values, group_codes, n_groups, log_min, log_max, nbins=1000):
+    '''
+    Histograms of the log10 values of each group of samples, computed for all groups in one vectorized pass.
+
+    The nbins bins are equally spaced between log_min and log_max (log10 scale). 
+    Zeros cannot be placed on a log scale: they are not binned but counted in n_values. Missing values are ignored.
+    Results of blocks of features can be summed. Works on numpy arrays and scipy sparse matrices (only stored values are used).
+
+    Parameters
+    ----------
+    values: `numpy.ndarray` or `scipy.sparse.spmatrix`, (n_features, n_samples)
+        The feature abundances.
+    group_codes: `numpy.ndarray`, (n_samples,)
+        Integer group code of each sample.
+    n_groups: int
+        The number of groups.
+    log_min, log_max: float
+        The log10 of the smallest and largest positive values (range of the bins).
+    nbins: int, optional
+        The number of bins (default is 1000).
+
+    Returns
+    -------
+    counts: `numpy.ndarray`, (n_groups, nbins)
+        Number of values per group and bin.
+    n_values: `numpy.ndarray`, (n_groups,)
+        Number of non-missing values (zeros included) per group.
+    sum_log: `numpy.ndarray`, (n_groups,)
+        Sum of the log10 positive values per group.
+    sum_squared_log: `numpy.ndarray`, (n_groups,)
+        Sum of the squared log10 positive values per group.
+    '''
+    group_codes = np.asarray(group_codes)
+    if sparse.issparse(values):
+        values = sparse.csr_matrix(values)
+        stored_values = values.data
+        value_groups = group_codes[values.indices]
+        missing_per_sample = np.bincount(values.indices[np.isnan(stored_values)], minlength=values.shape[1])
+        values_per_sample = values.shape[0] - missing_per_sample
+    else:
+        values = np.asarray(values)
+        stored_values = values.ravel()
+        value_groups = np.broadcast_to(group_codes, values.shape).ravel()
+        values_per_sample = values.shape[0] - np.count_nonzero(np.isnan(values), axis=0)
+    n_values = np.bincount(group_codes, weights=values_per_sample, minlength=n_groups)
+
+    is_positive = stored_values > 0
+    log_values = np.log10(stored_values[is_positive].astype(np.float64))
+    value_groups = value_groups[is_positive]
+    # same bins as numpy.histogram (the last bin includes its right edge)
+    bin_edges = np.linspace(log_min, log_max, nbins + 1)
+    bins = np.clip(np.searchsorted(bin_edges, log_values, side='right') - 1, 0, nbins - 1)
+    counts = np.bincount(value_groups * nbins + bins, minlength=n_groups * nbins).reshape(n_groups, nbins)
+    sum_log = np.bincount(value_groups, weights=log_values, minlength=n_groups)
+    sum_squared_log = np.bincount(value_groups, weights=log_values**2, minlength=n_groups)
+    return counts, n_values, sum_log, sum_squared_log
+
+def smooth_log_histogram(counts, bin_width, log_std):
+    '''
+    Approximate kernel density estimate from binned counts: the counts are convolved with a gaussian kernel
+    whose bandwidth follows Scott's rule (log_std * n ** (-1/5)) on the log10 scale. 
+    The result is in counts per bin (same scale as the histogram).
+
+    Parameters
+    ----------
+    counts: `numpy.ndarray`, (nbins,)
+        Number of values per bin.
+    bin_width: float
+        Width of the bins (log10 scale).
+    log_std: float
+        Standard deviation of the log10 values.
+    '''
+    n = counts.sum()
+    if n == 0 or not np.isfinite(log_std) or log_std == 0:
+        return counts.astype(np.float64)
+    bandwidth_in_bins = log_std * n ** (-1 / 5) / bin_width
+    half_width = int(min(np.ceil(4 * bandwidth_in_bins), counts.size))
+    kernel = np.exp(-0.5 * (np.arange(-half_width, half_width + 1) / bandwidth_in_bins) ** 2)
+    kernel /= kernel.sum()
+    return np.convolve(counts, kernel, mode='full')[half_width:half_width + counts.size]
+
+def compute_pca_with_gram_matrix(X, n_components, scale=True, block_size=10000):
+    '''
+    Principal Component Analysis computed from the (n_samples, n_samples) Gram matrix of the centered (and scaled) data.
+
+    Suited for the usual n_samples << n_features case. 
+    Centering and scaling (zero mean and unit variance, as scikit-learn StandardScaler) are fused in the computation 
+    of the Gram matrix so that neither a centered nor a scaled copy of X is made: X can be a scipy sparse matrix.
+    Dense matrices are processed by blocks of block_size features. 
+
+    Parameters
+    ----------
+    X: `numpy.ndarray` or `scipy.sparse.spmatrix`, (n_samples, n_features)
+        The data with samples in rows.
+    n_components: int
+        Number of principal components to return.
+    scale: `bool`, optional
+        Scale the features to unit variance (default is True).
+    block_size: int, optional
+        Number of features of a dense matrix processed at once (default is 10000).
+
+    Returns
+    -------
+    scores: `numpy.ndarray`, (n_samples, n_components)
+        Sample coordinates on the principal components.
+    explained_variance_ratio: `numpy.ndarray`, (n_components,)
+        Fraction of the total variance explained by each principal component.
+    '''
+    if sparse.issparse(X):
+        def iter_feature_blocks():
+            yield X
+    else:
+        X = np.asarray(X)
+        def iter_feature_blocks():
+            for start in range(0, X.shape[1], block_size):
+                yield X[:, start:start + block_size]
+    return compute_pca_from_feature_blocks(iter_feature_blocks, n_components, scale=scale)
+
+def compute_pca_from_feature_blocks(iter_feature_blocks, n_components, scale=True):
+    '''
+    Out-of-core Principal Component Analysis that streams blocks of features.
+
+    The (n_samples, n_samples) Gram matrix of the centered (and scaled) data is accumulated block by block. 
+    Each feature is centered and scaled with its own mean and standard deviation, so only one block 
+    of features has to be in memory at a time. Blocks are read twice: once for the Gram matrix and once 
+    to orient the components.
+
+    Parameters
+    ----------
+    iter_feature_blocks: callable
+        A function without arguments that returns a new iterator over blocks of features.
+        Each block is a `numpy.ndarray` or `scipy.sparse.spmatrix` of shape (n_samples, n_block_features).
+    n_components: int
+        Number of principal components to return.
+    scale: `bool`, optional
+        Scale the features to unit variance (default is True).
+
+    Returns
+    -------
+    scores: `numpy.ndarray`, (n_samples, n_components)
+        Sample coordinates on the principal components.
+    explained_variance_ratio: `numpy.ndarray`, (n_components,)
+        Fraction of the total variance explained by each principal component.
+    
+    Notes
+    -----
+    With A the (scaled) data of a block and m the (scaled) feature means, the Gram matrix of the centered data Z = A - 1m' is
+    ZZ' = AA' - (Am)1' - 1(Am)' + (m'm)11' (summed over blocks).
+    Its eigenvectors U and eigenvalues L give the scores U*sqrt(L). 
+    Signs follow scikit-learn: the largest absolute loading of each component is positive.
+    '''
+    AA = None
+    for block in iter_feature_blocks():
+        A, m = _scale_feature_block(block, scale)
+        if AA is None:
+            AA = np.zeros((block.shape[0], block.shape[0]))
+            Am = np.zeros(block.shape[0])
+            mm = 0.0
+        AA += A @ A.T if not sparse.issparse(A) else (A @ A.T).toarray()
+        Am += np.asarray(A @ m).ravel()
+        mm += m @ m
+    gram = AA - Am[:, np.newaxis] - Am[np.newaxis, :] + mm
+
+    eigenvalues, eigenvectors = np.linalg.eigh(gram)
+    order = np.argsort(eigenvalues)[::-1]
+    eigenvalues = np.maximum(eigenvalues[order], 0)
+    eigenvectors = eigenvectors[:, order]
+    total_variance = eigenvalues.sum()
+    eigenvalues = eigenvalues[:n_components]
+    eigenvectors = eigenvectors[:, :n_components]
+
+    # loadings Z'u = A'u - m(1'u) are only used to decide the sign of each component
+    largest_loadings = np.zeros(eigenvectors.shape[1])
+    for block in iter_feature_blocks():
+        A, m = _scale_feature_block(block, scale)
+        loadings = np.asarray(A.T @ eigenvectors) - np.outer(m, eigenvectors.sum(axis=0))
+        if loadings.shape[0] == 0:
+            continue
+        block_largest = loadings[np.argmax(np.abs(loadings), axis=0), np.arange(loadings.shape[1])]
+        replace = np.abs(block_largest) > np.abs(largest_loadings)
+        largest_loadings[replace] = block_largest[replace]
+    signs = np.where(largest_loadings < 0, -1.0, 1.0)
+
+    scores = eigenvectors * np.sqrt(eigenvalues) * signs
+    explained_variance_ratio = eigenvalues / total_variance if total_variance > 0 else np.zeros_like(eigenvalues)
+    return scores, explained_variance_ratio
+
+def compute_pca_with_randomized_svd(X, n_components, scale=True, n_oversamples=10, n_power_iterations=4, random_state=None):
+    '''
+    Principal Component Analysis computed with a randomized truncated SVD (Halko et al. 2011).
+    Fast when only a few components are needed.
+
+    Centering and scaling (zero mean and unit variance, as scikit-learn StandardScaler) are fused in the 
+    matrix products with the random projections: the centered and scaled data Z = (X - 1mu')D is never built
+    and X can be a scipy sparse matrix.
+      ZW = X(DW) - 1(mu'DW) 
+      Z'Q = D(X'Q) - Dmu(1'Q)
+
+    Parameters
+    ----------
+    X: `numpy.ndarray` or `scipy.sparse.spmatrix`, (n_samples, n_features)
+        The data with samples in rows.
+    n_components: int
+        Number of principal components to return.
+    scale: `bool`, optional
+        Scale the features to unit variance (default is True).
+    n_oversamples: int, optional
+        Number of additional random vectors used to capture the range of Z (default is 10).
+    n_power_iterations: int, optional
+        Number of power iterations that improve the accuracy when the spectrum decays slowly (default is 4).
+    random_state: int, optional
+        Seed of the random projections (default is None).
+
+    Returns
+    -------
+    scores: `numpy.ndarray`, (n_samples, n_components)
+        Sample coordinates on the principal components.
+    explained_variance_ratio: `numpy.ndarray`, (n_components,)
+        Fraction of the total variance explained by each principal component.
+
+    References
+    ----------
+    Halko, Martinsson and Tropp (2011) Finding structure with randomness. SIAM Review 53(2).
+    '''
+    if sparse.issparse(X):
+        X = sparse.csr_matrix(X, dtype=np.float64)
+    else:
+        X = np.asarray(X)
+    means, d = _feature_means_and_scales(X, scale)
+    m = means * d
+    A = X
+    def Z_dot(W):
+        return np.asarray(A @ (d[:, np.newaxis] * W)) - np.outer(np.ones(A.shape[0]), m @ W)
+    def Zt_dot(Q):
+        return d[:, np.newaxis] * np.asarray(A.T @ Q) - np.outer(m, Q.sum(axis=0))
+
+    rng = np.random.default_rng(random_state)
+    n_random_vectors = min(n_components + n_oversamples, min(X.shape))
+    Q, _ = np.linalg.qr(Z_dot(rng.standard_normal((X.shape[1], n_random_vectors))))
+    for _ in range(n_power_iterations):
+        Q, _ = np.linalg.qr(Zt_dot(Q))
+        Q, _ = np.linalg.qr(Z_dot(Q))
+    # SVD of the small matrix B = Q'Z (computed as (Z'Q)')
+    B = Zt_dot(Q).T
+    U_B, singular_values, Vt = np.linalg.svd(B, full_matrices=False)
+    U = Q @ U_B
+
+    # total variance = squared Frobenius norm of Z
+    if sparse.issparse(A):
+        sum_squares = np.asarray(A.multiply(A).sum(axis=0, dtype=np.float64)).ravel()
+    else:
+        sum_squares = np.einsum('ij,ij->j', A, A, dtype=np.float64)
+    total_variance = np.sum(sum_squares * d ** 2) - A.shape[0] * (m @ m)
+
+    U = U[:, :n_components]
+    singular_values = singular_values[:n_components]
+    Vt = Vt[:n_components]
+    signs = np.sign(Vt[np.arange(Vt.shape[0]), np.argmax(np.abs(Vt), axis=1)])
+    signs[signs == 0] = 1
+    scores = U * singular_values * signs
+    explained_variance_ratio = singular_values ** 2 / total_variance if total_variance > 0 else np.zeros_like(singular_values)
+    return scores, explained_variance_ratio
+
+def _feature_means_and_scales(X, scale):
+    '''
+    Returns the mean of each feature (column) of X and the factor that scales it to unit variance 
+    (1 for features with zero variance or if scale is False, same as scikit-learn StandardScaler).
+    '''
+    if sparse.issparse(X):
+        X = sparse.csr_matrix(X, dtype=np.float64)
+        means = np.asarray(X.mean(axis=0)).ravel()
+        variances = np.asarray(X.multiply(X).mean(axis=0)).ravel() - means ** 2
+    else:
+        means = X.mean(axis=0, dtype=np.float64)
+        variances = X.var(axis=0, dtype=np.float64)
+    feature_scales = np.ones(X.shape[1])
+    if scale:
+        stds = np.sqrt(np.maximum(variances, 0))
+        feature_scales[stds > 0] = 1 / stds[stds > 0]
+    return means, feature_scales
+
+def _scale_feature_block(block, scale):
+    '''
+    Returns the scaled block A (a copy of the block only) and the scaled means m of its features (see compute_pca_from_feature_blocks()). 
+    '''
+    means, feature_scales = _feature_means_and_scales(block, scale)
+    if sparse.issparse(block):
+        return sparse.csr_matrix(block, dtype=np.float64) @ sparse.diags(feature_scales), means * feature_scales
+    return np.asarray(block, dtype=np.float64) * feature_scales, means * feature_scales
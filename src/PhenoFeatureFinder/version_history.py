@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+
+import itertools
+import numpy as np
+import pandas as pd
+
+
+class MetabolomeVersion:
+    '''
+    One state of the metabolome in a VersionHistory.
+
+    The values are not copied: a version refers to a base store (the values after the last operation that changed values,
+    e.g. loading, imputation or normalisation) and keeps the features of the base that remain as a packed bit mask
+    (one bit per feature of the base) and the positions of the remaining samples.
+
+    Attributes
+    ----------
+    version_id: int
+        Number of the version (in order of creation).
+    label: str
+        The operation that created the version (e.g. 'filter_out_unreliable_features').
+    parent_id: int
+        The version the operation was applied to (None for the first version or when the parent was dropped).
+    base: object
+        The metabolome store the version refers to.
+    state: dict
+        Other attributes of the analysis restored with the version (e.g. the mask of imputed values).
+    '''
+    def __init__(self, version_id, label, parent_id, base, feature_positions, sample_positions, state):
+        self.version_id = version_id
+        self.label = label
+        self.parent_id = parent_id
+        self.base = base
+        self.n_base_features = base.shape[0]
+        features = np.zeros(self.n_base_features, dtype=bool)
+        features[feature_positions] = True
+        self.features = np.packbits(features)
+        self.sample_positions = np.asarray(sample_positions, dtype=np.int64)
+        self.state = state
+
+    @property
+    def feature_positions(self):
+        return np.flatnonzero(np.unpackbits(self.features, count=self.n_base_features))
+
+    @property
+    def shape(self):
+        return (int(np.unpackbits(self.features, count=self.n_base_features).sum()), self.sample_positions.size)
+
+    @property
+    def nbytes(self):
+        # the base is counted separately (shared by several versions)
+        return int(self.features.nbytes + self.sample_positions.nbytes)
+
+    @property
+    def index(self):
+        return self.base.index[self.feature_positions]
+
+    @property
+    def columns(self):
+        return self.base.columns[self.sample_positions]
+
+    def to_store(self):
+        '''
+        Returns the store of the version: the base itself or a selection of its features and samples.
+        '''
+        feature_positions = self.feature_positions
+        if feature_positions.size == self.n_base_features and self.sample_positions.size == self.base.shape[1]:
+            return self.base
+        features_to_keep = np.zeros(self.n_base_features, dtype=bool)
+        features_to_keep[feature_positions] = True
+        columns_to_drop = np.delete(self.base.columns, self.sample_positions)
+        return self.base.select_features(features_to_keep, columns_to_drop=columns_to_drop)
+
+
+class VersionHistory:
+    '''
+    A copy-on-write history of the states of the metabolome.
+
+    Filters record a new version that only stores a mask of the features kept (and the samples kept) against
+    the shared base matrix: the values are never duplicated by the history. Operations that change values
+    (imputation, normalisation) record a new base. Before values are modified in place, the store is copied
+    if its values are shared with a base retained by the history (see is_shared()).
+
+    Any version can be checked out; new operations applied to an older version start a new branch
+    (versions keep their parent). Named branches point to a version and follow the new versions recorded on them.
+    When the memory used by the history (masks and bases that are not the current one) exceeds max_size_gb,
+    the oldest versions are dropped.
+
+    Parameters
+    ----------
+    max_size_gb: float, optional
+        Memory cap of the history in gigabytes (default is 1).
+
+    Attributes
+    ----------
+    versions: dict
+        The retained versions by version_id.
+    head: int
+        The version_id of the current version.
+    branches: dict
+        Names of branches and the version_id they point to.
+    current_branch: str
+        The branch of the current version ('main' by default, None after checking out a version by number).
+    '''
+    def __init__(self, max_size_gb=1):
+        self.max_size_gb = max_size_gb
+        self.versions = {}
+        self.head = None
+        self.branches = {}
+        self.current_branch = "main"
+        self._version_ids = itertools.count()
+
+    def __len__(self):
+        return len(self.versions)
+
+    @property
+    def nbytes(self):
+        '''
+        Memory used by the history: masks of all versions and bases other than the one of the current version.
+        '''
+        head_base = self.versions[self.head].base if self.head in self.versions else None
+        bases = {id(version.base): version.base for version in self.versions.values() if version.base is not head_base}
+        return sum(version.nbytes for version in self.versions.values()) + sum(base.nbytes for base in bases.values())
+
+    def commit_values(self, store, label, state=None):
+        '''
+        Records a version whose values are given by store (it becomes the base of the following filter versions).
+        '''
+        return self._commit(label, store, np.arange(store.shape[0]), np.arange(store.shape[1]), state)
+
+    def commit_selection(self, features_to_keep, columns_to_drop, label, state=None):
+        '''
+        Records a version keeping the features selected by the boolean array features_to_keep
+        (in the order of the current version) and without the columns_to_drop sample names.
+        Only a mask against the base of the current version is stored.
+        '''
+        head = self.versions[self.head]
+        feature_positions = head.feature_positions[np.asarray(features_to_keep, dtype=bool)]
+        sample_positions = head.sample_positions
+        if columns_to_drop is not None:
+            sample_positions = sample_positions[~head.columns.isin(list(columns_to_drop))]
+        return self._commit(label, head.base, feature_positions, sample_positions, state)
+
+    def checkout(self, version):
+        '''
+        Makes version (a version_id or a branch name) the current version and returns it.
+        '''
+        version_id = self._resolve(version)
+        self.head = version_id
+        self.current_branch = version if isinstance(version, str) else None
+        return self.versions[version_id]
+
+    def undo(self):
+        '''
+        Makes the parent of the current version the current version (the current branch follows) and returns it.
+        '''
+        parent_id = self.versions[self.head].parent_id
+        if parent_id is None:
+            raise ValueError("The current version has no earlier version in the history.")
+        self.head = parent_id
+        if self.current_branch is not None:
+            self.branches[self.current_branch] = parent_id
+        return self.versions[parent_id]
+
+    def branch(self, name, version=None):
+        '''
+        Creates a branch named name pointing to version (default is None: the current version) and checks it out.
+        '''
+        if name in self.branches:
+            raise ValueError("The branch '{0}' already exists.".format(name))
+        self.branches[name] = self._resolve(self.head if version is None else version)
+        return self.checkout(name)
+
+    def diff(self, version_a, version_b):
+        '''
+        Differences between two versions (version_id or branch name): the features and samples only present in one of them
+        and whether the values come from different bases (e.g. normalised in one of them).
+
+        Returns
+        -------
+        dict
+            'features_only_in_a', 'features_only_in_b', 'samples_only_in_a', 'samples_only_in_b' (pandas Index) and 'values_differ' (bool).
+        '''
+        a = self.versions[self._resolve(version_a)]
+        b = self.versions[self._resolve(version_b)]
+        if a.base is b.base:
+            features_a = np.unpackbits(a.features, count=a.n_base_features).astype(bool)
+            features_b = np.unpackbits(b.features, count=b.n_base_features).astype(bool)
+            features_only_in_a = a.base.index[features_a & ~features_b]
+            features_only_in_b = b.base.index[features_b & ~features_a]
+        else:
+            features_only_in_a = a.index.difference(b.index, sort=False)
+            features_only_in_b = b.index.difference(a.index, sort=False)
+        return dict(
+            features_only_in_a=features_only_in_a,
+            features_only_in_b=features_only_in_b,
+            samples_only_in_a=a.columns.difference(b.columns, sort=False),
+            samples_only_in_b=b.columns.difference(a.columns, sort=False),
+            values_differ=a.base is not b.base)
+
+    def is_shared(self, store):
+        '''
+        Are the values of store shared with a base retained by the history (then they should not be modified in place)?
+        '''
+        values = _get_value_arrays(store)
+        return any(
+            any(np.may_share_memory(array, base_array) for array in values for base_array in _get_value_arrays(version.base))
+            for version in self.versions.values())
+
+    def to_frame(self):
+        '''
+        Returns a dataframe with one row per retained version: version_id, label, parent_id, branches, n_features, n_samples and head.
+        '''
+        rows = []
+        for version_id, version in self.versions.items():
+            n_features, n_samples = version.shape
+            branches = ",".join(name for name, branch_head in self.branches.items() if branch_head == version_id)
+            rows.append((version_id, version.label, version.parent_id, branches, n_features, n_samples, version_id == self.head))
+        return pd.DataFrame(rows, columns=["version_id", "label", "parent_id", "branches", "n_features", "n_samples", "head"])
+
+    def _commit(self, label, base, feature_positions, sample_positions, state):
+        version_id = next(self._version_ids)
+        self.versions[version_id] = MetabolomeVersion(version_id, label, self.head, base, feature_positions, sample_positions, state or {})
+        self.head = version_id
+        if self.current_branch is not None:
+            self.branches[self.current_branch] = version_id
+        self._drop_oldest_versions()
+        return self.versions[version_id]
+
+    def _drop_oldest_versions(self):
+        max_nbytes = self.max_size_gb * 1024**3
+        for version_id in sorted(self.versions):
+            if self.nbytes <= max_nbytes:
+                break
+            if version_id == self.head:
+                continue
+            del self.versions[version_id]
+            self.branches = {name: branch_head for name, branch_head in self.branches.items() if branch_head != version_id}
+            for version in self.versions.values():
+                if version.parent_id == version_id:
+                    version.parent_id = None
+
+    def _resolve(self, version):
+        if isinstance(version, str):
+            if version not in self.branches:
+                raise ValueError("Unknown branch '{0}'. Branches: {1}".format(version, list(self.branches)))
+            return self.branches[version]
+        if version not in self.versions:
+            raise ValueError("Version {0} is not in the history (it may have been dropped to respect the memory cap).".format(version))
+        return version
+
+
+def _get_value_arrays(store):
+    '''
+    The numpy arrays holding the values of a metabolome store.
+    '''
+    values = store.values if hasattr(store, "values") else store.metabolome.to_numpy()
+    if hasattr(values, "data") and hasattr(values, "indices"):
+        return [values.data]
+    return [values]